@@ -0,0 +1,289 @@
+"""
+Benchmarks the processing pipeline on synthetic day files, from one day to several years of data sampled every
+1 second to 1 minute.
+
+The generator writes raw day files like the collector's, between COLLECTION_START_TIME and
+COLLECTION_END_TIME:
+    - irradiance: clear-sky (Ineichen) plane of array irradiance at the location and panel orientation in
+      config.json, with 1% noise
+    - temperature: module temperature from a seasonal and daily ambient temperature plus heating by irradiance
+    - power: pvwatts power at the module temperature, with a system efficiency and noise; voltage and
+      current to match
+    - MPPT sweeps: every 10 minutes, the power and current drop for MPPT_SWEEP_SECONDS
+    - gaps: optionally, random gaps in the data, in total about --gaps of each day
+
+The pipeline stages are then timed on each day file: csv load, preprocess_data, get_iam, compute_power, csv
+write, calibrate.linear_regression and the plot loader. The solar position tables are built before the
+pipeline runs and timed separately. The results are printed and written as JSON with -o: rows/s and seconds
+per stage, and the peak memory (RSS) of the process; with --trace_memory also the peak memory allocated in
+each stage, which slows the run down. With -b, the rows/s of each stage are compared with a saved result
+and the benchmark fails if a stage is slower by more than --tolerance.
+
+Everything runs in a work directory (a temporary one unless -w is given) with its own data/, config/ and
+cache/, so the benchmark doesn't touch ./data/.
+
+Example usage: 'python benchmark.py -n 7 -o baseline.json' benchmarks a week of 1 minute data.
+               'python benchmark.py -n 7 -b baseline.json' compares a new run with the baseline.
+               'python benchmark.py -n 365 -i 10 --gaps 0.05' benchmarks a year of 10 second data with gaps.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import pvlib
+import solar_position_cache
+from constants import *
+from calibrate import linear_regression
+from compute_power import compute_power, get_iam, utc_years_for
+from site_config import Config
+from plot import read_day_data
+from preprocess_data import preprocess_data
+
+DEFAULT_START_DATE = '2022-01-01'
+DEFAULT_DAYS = 7
+DEFAULT_INTERVAL = 60 # seconds
+DEFAULT_TOLERANCE = 0.2
+COLLECTION_START_TIME = '07:00:00'
+COLLECTION_END_TIME = '20:00:00'
+
+MPPT_SWEEP_INTERVAL = 600 # seconds
+MPPT_SWEEP_SECONDS = 33
+MPPT_SWEEP_POWER_RATIO = 0.6
+SYSTEM_EFFICIENCY = 0.9
+# Gaps are between these lengths, in seconds.
+MIN_GAP_SECONDS = 300
+MAX_GAP_SECONDS = 3600
+
+STAGES = ['csv load', 'preprocess', 'get iam', 'compute power', 'csv write', 'calibrate', 'plot load']
+
+# Returns the clear-sky plane of array irradiance at the given tz-aware times. The clear-sky model is evaluated
+# every minute and interpolated, so that 1 second data doesn't need a solar position per sample.
+def clear_sky_poa(times, config):
+    minutes = pd.date_range(times[0].floor('min'), times[-1].ceil('min'), freq='min')
+    location = pvlib.location.Location(config.location['latitude'], config.location['longitude'],
+                                       altitude=config.location['altitude'], tz=config.timezone)
+    solpos = location.get_solarposition(minutes)
+    clearsky = location.get_clearsky(minutes, solar_position=solpos)
+    poa = pvlib.irradiance.get_total_irradiance(config.pvsystem['surface_tilt'], config.pvsystem['surface_azimuth'],
+                                                solpos['apparent_zenith'], solpos['azimuth'],
+                                                clearsky['dni'], clearsky['ghi'], clearsky['dhi'])['poa_global']
+    return np.interp(times.asi8, minutes.asi8, poa.fillna(0).to_numpy())
+
+# Returns a synthetic raw day file as a DataFrame with RAW_DATA_COLUMN_NAMES.
+def generate_day(date, interval, config, rng, gaps=0.0):
+    # Samples are taken 2 seconds after the interval, like the collector's cron job.
+    times = pd.date_range(date + ' ' + COLLECTION_START_TIME, date + ' ' + COLLECTION_END_TIME,
+                          freq=pd.Timedelta(seconds=interval), tz=config.timezone) + pd.Timedelta(seconds=2)
+    n = len(times)
+    poa = clear_sky_poa(times, config)
+    irradiance = poa * rng.normal(1, 0.01, n)
+
+    day_of_year = times.dayofyear.to_numpy()
+    hour = (times.hour + times.minute / 60 + times.second / 3600).to_numpy()
+    ambient = 15 + 7 * np.sin(2 * np.pi * (day_of_year - 110) / 365) + 5 * np.sin(2 * np.pi * (hour - 9) / 24)
+    temperature = ambient + 0.03 * poa + rng.normal(0, 0.1, n)
+
+    pdc0 = config.pvsystem['pdc0']
+    power = pdc0 * poa / 1000 * (1 + config.pvsystem['gamma_pdc'] * (temperature - 25)) * SYSTEM_EFFICIENCY
+    power = np.maximum(0, power * rng.normal(1, 0.01, n))
+    voltage = np.where(power > 0.5, 17.5 - 0.04 * (temperature - 25), 13.2) + rng.normal(0, 0.05, n)
+    current = power / voltage
+    seconds_of_day = (hour * 3600).round().astype(int)
+    sweeping = seconds_of_day % MPPT_SWEEP_INTERVAL < MPPT_SWEEP_SECONDS
+    power[sweeping] *= MPPT_SWEEP_POWER_RATIO
+    current[sweeping] *= MPPT_SWEEP_POWER_RATIO
+
+    df = pd.DataFrame({
+        TIMESTAMP: (times - pd.Timestamp('1970-01-01', tz='UTC')) // pd.Timedelta(seconds=1),
+        TIME: times.strftime(TIME_FORMAT),
+        TEMPERATURE: temperature.round(2),
+        IRRADIANCE: np.maximum(0, irradiance).round(2),
+        VOLTAGE: voltage.round(2),
+        CURRENT: current.round(2),
+        POWER: power.round(2),
+    })
+    if gaps > 0:
+        keep = np.ones(n, dtype=bool)
+        while (~keep).sum() < gaps * n:
+            start = rng.integers(0, n)
+            keep[start:start + int(rng.integers(MIN_GAP_SECONDS, MAX_GAP_SECONDS) // interval) + 1] = False
+        df = df[keep]
+    return df
+
+# Writes the synthetic raw day files of days days from start_date to ./data/. Returns the dates and the number
+# of rows.
+def generate_dataset(start_date, days, interval, config, gaps=0.0, seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(DATA_FILE_RELATIVE_DIR, exist_ok=True)
+    dates = [d.strftime('%Y-%m-%d') for d in pd.date_range(start_date, periods=days)]
+    rows = 0
+    for date in dates:
+        df = generate_day(date, interval, config, rng, gaps)
+        df.to_csv(DATA_FILE_RELATIVE_DIR + date + '.csv', index=False)
+        rows += len(df)
+    return dates, rows
+
+# Accumulates the time, and optionally the peak allocated memory, of each stage.
+class StageTimes:
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.seconds = {}
+        self.peak_bytes = {}
+
+    @contextmanager
+    def stage(self, name):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+            if self.trace_memory:
+                self.peak_bytes[name] = max(self.peak_bytes.get(name, 0), tracemalloc.get_traced_memory()[1])
+
+# Runs the pipeline stages on the raw day files of dates, like compute_power.process, calibrate and plot do.
+def run_pipeline(dates, config, power_coefficient, times):
+    for date in dates:
+        with times.stage('csv load'):
+            df = pd.read_csv(DATA_FILE_RELATIVE_DIR + date + '.csv')
+        with times.stage('preprocess'):
+            df = preprocess_data(df)
+        with times.stage('get iam'):
+            get_iam(df[TIME], config)
+        with times.stage('compute power'):
+            df[IAM_FACTOR], df[PVWATTS_POWER], df[COMPUTED_POWER] = compute_power(
+                df[IRRADIANCE_SMOOTHED], df[TEMPERATURE_SMOOTHED], df[TIME], power_coefficient, config)
+        with times.stage('csv write'):
+            df.to_csv(DATA_FILE_RELATIVE_DIR + date + '_processed.csv', index=False)
+        with times.stage('calibrate'):
+            linear_regression(df)
+        with times.stage('plot load'):
+            read_day_data(date + '_processed.csv')
+
+# Returns the peak resident memory of the process in MB.
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB elsewhere.
+    return peak / 2**20 if platform.system() == 'Darwin' else peak / 2**10
+
+def run_benchmark(start_date, days, interval, gaps=0.0, seed=0, trace_memory=False):
+    config = Config()
+
+    start = time.perf_counter()
+    dates, rows = generate_dataset(start_date, days, interval, config, gaps, seed)
+    generate_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for year in sorted(utc_years_for(dates)):
+        solar_position_cache.load_table(config.location, config.pvsystem, year)
+    solar_table_seconds = time.perf_counter() - start
+
+    times = StageTimes(trace_memory)
+    if trace_memory:
+        tracemalloc.start()
+    run_pipeline(dates, config, DEFAULT_POWER_COEF, times)
+    if trace_memory:
+        tracemalloc.stop()
+
+    total = sum(times.seconds.values())
+    stages = {}
+    for name in STAGES:
+        stages[name] = {'seconds': round(times.seconds[name], 4), 'rows_per_second': round(rows / times.seconds[name])}
+        if trace_memory:
+            stages[name]['peak_allocated_mb'] = round(times.peak_bytes[name] / 2**20, 1)
+    return {
+        'parameters': {'start_date': start_date, 'days': days, 'interval': interval, 'gaps': gaps, 'seed': seed,
+                       'trace_memory': trace_memory},
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                        'pvlib': pvlib.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'rows': rows,
+        'generate_seconds': round(generate_seconds, 3),
+        'solar_table_seconds': round(solar_table_seconds, 3),
+        'stages': stages,
+        'pipeline': {'seconds': round(total, 4), 'rows_per_second': round(rows / total)},
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+def print_results(results):
+    print(f"{results['rows']} rows in {results['parameters']['days']} days at {results['parameters']['interval']}s, "
+          f"generated in {results['generate_seconds']}s, solar tables in {results['solar_table_seconds']}s")
+    for name, stage in list(results['stages'].items()) + [('pipeline', results['pipeline'])]:
+        memory = f"  {stage['peak_allocated_mb']:8.1f} MB" if 'peak_allocated_mb' in stage else ''
+        print(f"{name:14s} {stage['seconds']:10.3f}s {stage['rows_per_second']:12d} rows/s{memory}")
+    print(f"peak RSS {results['peak_rss_mb']} MB")
+
+# Compares the rows/s of each stage with a baseline result. Returns the names of the stages that are slower than
+# the baseline by more than tolerance.
+def compare_with_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    if results['parameters'] != baseline['parameters']:
+        print(f"Warning: baseline parameters {baseline['parameters']} differ from {results['parameters']}")
+    regressions = []
+    stages = dict(results['stages'], pipeline=results['pipeline'])
+    baseline_stages = dict(baseline['stages'], pipeline=baseline['pipeline'])
+    for name, stage in stages.items():
+        if name not in baseline_stages:
+            continue
+        ratio = stage['rows_per_second'] / baseline_stages[name]['rows_per_second']
+        status = 'REGRESSION' if ratio < 1 - tolerance else ''
+        if status:
+            regressions.append(name)
+        print(f"{name:14s} {baseline_stages[name]['rows_per_second']:12d} -> {stage['rows_per_second']:12d} rows/s {ratio:6.2f}x {status}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--start", default=DEFAULT_START_DATE, help="First date of the synthetic data")
+    parser.add_argument("-n", "--days", type=int, default=DEFAULT_DAYS, help="Number of days of synthetic data")
+    parser.add_argument("-i", "--interval", type=int, default=DEFAULT_INTERVAL, help="Sampling interval in seconds, 1 to 60")
+    parser.add_argument("--gaps", type=float, default=0.0, help="Fraction of each day missing in random gaps, e.g. 0.05")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the generator")
+    parser.add_argument("-w", "--workdir", help="Work directory, kept after the run. Defaults to a temporary directory")
+    parser.add_argument("-o", "--output", help="Write the results as JSON to this file")
+    parser.add_argument("-b", "--baseline", help="Compare the results with this JSON file written by -o")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Fraction of the baseline rows/s a stage may lose before it is a regression")
+    parser.add_argument("--trace_memory", action='store_true', help="If present, also measure the peak allocated memory of each stage")
+    args = parser.parse_args()
+
+    if not 1 <= args.interval <= 60:
+        raise Exception("Interval must be between 1 and 60 seconds")
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+    output = os.path.abspath(args.output) if args.output else None
+
+    # The pipeline runs in the work directory by way of the relative directories in constants.py.
+    for directory in [DATA_FILE_RELATIVE_DIR, CONFIG_DIR, CACHE_DIR]:
+        if os.path.isabs(directory):
+            raise Exception(f"{directory} is set by an environment variable, unset PVMON_DATA_DIR, PVMON_CONFIG_DIR and PVMON_CACHE_DIR to run the benchmark")
+    cwd = os.getcwd()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='pvmonitoring-benchmark-')
+    os.makedirs(os.path.join(workdir, 'config'), exist_ok=True)
+    shutil.copy(CONFIG_FILE, os.path.join(workdir, CONFIG_FILE))
+    os.chdir(workdir)
+    try:
+        results = run_benchmark(args.start, args.days, args.interval, args.gaps, args.seed, args.trace_memory)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    print_results(results)
+    if output:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if baseline and compare_with_baseline(results, baseline, args.tolerance):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,206 @@
+"""
+Calibrates the power coefficient used by compute_power.py to adjust pvwatts power for system
+inefficiencies like mppt tracking, wire loss, etc.
+
+The coefficient is the no-intercept least squares fit of measured power (power smoothed) to pvwatts power:
+    coefficient = Σ(pvwatts power * power smoothed) / Σ(pvwatts power²)
+Only data between DAY_START_TIME and DAY_END_TIME is used. The sums are computed per day from the day's
+_processed.csv and cached in ./cache/calibration_stats.json, so a fit over many days reads each day file
+only once, and adding or excluding a day doesn't read the other days again. Days labelled as soiled or
+shaded in config/anomaly_labels.json are excluded unless --include_labelled is given.
+
+The coefficient is written to config/calibration.json, where compute_power.py picks it up.
+
+Example usage: 'python calibrate.py -f 2022-09-14_processed.csv' calibrates on one day.
+               'python calibrate.py -s 2022-08-30 -e 2022-09-21' calibrates on all processed days in the range.
+               'python calibrate.py -s 2022-08-30 -e 2022-09-21 -x 2022-09-18' also excludes 2022-09-18.
+               'python calibrate.py -r 7' prints the coefficient fitted on the last 7 days for each day,
+                   without updating config/calibration.json.
+"""
+
 import pandas as pd
 from constants import *
 import argparse
-import sys, getopt
-from sklearn import datasets, linear_model
-from sklearn.metrics import mean_squared_error, r2_score,  mean_absolute_error
+import glob
+import os
 import json
+from site_config import Config
+from storage import load_day
+
+CALIBRATION_STATS_FILE = CACHE_DIR + 'calibration_stats.json'
+CALIBRATION_COLUMNS = [TIME, PVWATTS_POWER, POWER_SMOOTHED]
+
+# Returns the rows of df between DAY_START_TIME and DAY_END_TIME.
+def filter_daytime(df):
+    time_of_day = df[TIME].str[11:]
+    return df[(time_of_day >= DAY_START_TIME) & (time_of_day <= DAY_END_TIME)]
+
+# Returns the sufficient statistics of the no-intercept least squares fit for the daytime rows of df.
+def get_day_stats(df):
+    df = filter_daytime(df)
+    df = df[df[PVWATTS_POWER].notna() & df[POWER_SMOOTHED].notna()]
+    x = df[PVWATTS_POWER]
+    y = df[POWER_SMOOTHED]
+    return {'n': len(df), 'sxy': float((x * y).sum()), 'sxx': float((x * x).sum()), 'syy': float((y * y).sum())}
+
+# Returns the sums of the stats of multiple days.
+def add_stats(stats_list):
+    total = {'n': 0, 'sxy': 0.0, 'sxx': 0.0, 'syy': 0.0}
+    for stats in stats_list:
+        for key in total:
+            total[key] += stats[key]
+    return total
+
+def coefficient_from_stats(stats):
+    if stats['sxx'] == 0:
+        raise Exception("No daytime data to calibrate on")
+    return stats['sxy'] / stats['sxx']
+
+# R² of the fit without intercept, relative to the mean of zero, as reported for fits through the origin.
+def r2_from_stats(stats):
+    coef = coefficient_from_stats(stats)
+    residual = stats['syy'] - 2 * coef * stats['sxy'] + coef * coef * stats['sxx']
+    return 1 - residual / stats['syy'] if stats['syy'] else float('nan')
 
 def linear_regression(df):
-    #TODO: limit the df's time to DAY_START_TIME to DAY_END_TIME
-    regr = linear_model.LinearRegression(fit_intercept=False)
-    regr.fit(df[[PVWATTS_POWER]], df[POWER_SMOOTHED])
-    coef = regr.coef_[0]
-    return coef
+    return coefficient_from_stats(get_day_stats(df))
+
+# Caches the stats of each day, keyed by the filename and invalidated when the file changes.
+class DayStatsCache:
+    def __init__(self, fname=CALIBRATION_STATS_FILE):
+        self.fname = fname
+        self.entries = {}
+        self.changed = False
+        if os.path.exists(fname):
+            with open(fname, 'r') as file:
+                self.entries = json.load(file)
+
+    def get(self, filename):
+        path = DATA_FILE_RELATIVE_DIR + filename
+        stat = os.stat(path)
+        entry = self.entries.get(filename)
+        if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+            df = load_day(filename[:10], filename.endswith('_processed.csv'), CALIBRATION_COLUMNS)
+            entry = {'mtime': stat.st_mtime, 'size': stat.st_size, 'stats': get_day_stats(df)}
+            self.entries[filename] = entry
+            self.changed = True
+        return entry['stats']
+
+    def save(self):
+        if self.changed:
+            os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+            with open(self.fname + '.tmp', 'w') as file:
+                json.dump(self.entries, file, indent=1, sort_keys=True)
+            os.replace(self.fname + '.tmp', self.fname)
+            self.changed = False
+
+# Returns the set of dates within the labelled anomaly episodes of kinds, or of all kinds if kinds is None.
+def get_labelled_dates(kinds=None):
+    if not os.path.exists(ANOMALY_LABELS_FILE):
+        return set()
+    with open(ANOMALY_LABELS_FILE, 'r') as file:
+        labels = json.load(file)
+    dates = set()
+    for kind, episodes in labels.items():
+        if kind.startswith('_') or (kinds is not None and kind not in kinds):
+            continue
+        for first, last in episodes:
+            dates.update(d.strftime('%Y-%m-%d') for d in pd.date_range(first, last))
+    return dates
+
+# Returns the dates of the processed data files within [start_date, end_date]. Either bound may be None.
+def list_processed_dates(start_date=None, end_date=None, data_dir=DATA_FILE_RELATIVE_DIR):
+    dates = []
+    for path in sorted(glob.glob(data_dir + '*_processed.csv')):
+        date = os.path.basename(path)[:10]
+        if (start_date and date < start_date) or (end_date and date > end_date):
+            continue
+        dates.append(date)
+    return dates
+
+# Parses comma separated dates and date ranges, e.g. '2022-09-18,2022-10-01:2022-10-05'.
+def parse_dates(dates_str):
+    dates = set()
+    for item in filter(None, dates_str.split(',')):
+        first, _, last = item.partition(':')
+        dates.update(d.strftime('%Y-%m-%d') for d in pd.date_range(first, last or first))
+    return dates
+
+def calibrate(dates, cache):
+    stats = add_stats(cache.get(date + '_processed.csv') for date in dates)
+    return coefficient_from_stats(stats), stats
+
+# Returns [(date, coefficient, number of days)] where the coefficient of each date is fitted on the window
+# days ending at that date.
+def rolling_calibrate(dates, cache, window):
+    results = []
+    day_stats = [cache.get(date + '_processed.csv') for date in dates]
+    for i, date in enumerate(dates):
+        stats = add_stats(day_stats[max(0, i + 1 - window):i + 1])
+        coef = coefficient_from_stats(stats) if stats['sxx'] else float('nan')
+        results.append((date, coef, min(window, i + 1)))
+    return results
+
+def read_calibration():
+    if not os.path.exists(CALIBRATION_FILE):
+        return {}
+    with open(CALIBRATION_FILE, 'r') as file:
+        return json.load(file)
+
+# Returns the power coefficient from config/calibration.json, or default if there is none. The coefficient of an
+# array of a fleet config (PVMON_ARRAY by default) is its power_coefficient in config.json if set, else the
+# coefficient calibrated on its data, else the coefficient calibrated on ./data/.
+def read_calibrated_coefficient(default=DEFAULT_POWER_COEF, array=ARRAY):
+    if array is not None:
+        coefficient = Config(array).power_coefficient
+        if coefficient is not None:
+            return coefficient
+    calibration = read_calibration()
+    if array in calibration.get('arrays', {}):
+        return calibration['arrays'][array]['coefficient']
+    return calibration.get('coefficient', default)
+
+# Writes the coefficient of array, or of ./data/ if array is None, to config/calibration.json, keeping the
+# coefficients of the other arrays.
+def write_calibrated_coefficient(coefficient, dates, array=ARRAY):
+    calibration = read_calibration()
+    if array is None:
+        calibration.update({"coefficient": coefficient, "dates": dates})
+    else:
+        calibration.setdefault('arrays', {})[array] = {"coefficient": coefficient, "dates": dates}
+    with open(CALIBRATION_FILE + '.tmp', 'w') as file:
+        json.dump(calibration, file)
+    os.replace(CALIBRATION_FILE + '.tmp', CALIBRATION_FILE)
 
 def main():
-    filename = ''
-    argv = sys.argv[1:]
     parser = argparse.ArgumentParser()
-    parser.add_argument("-f", "--filename", help="Filename of the data file, e.g. 2022-09-14.csv")
+    parser.add_argument("-f", "--filename", help="Filename of the data file, e.g. 2022-09-14_processed.csv")
+    parser.add_argument("-s", "--start", help="First date to calibrate on, e.g. 2022-08-30")
+    parser.add_argument("-e", "--end", help="Last date to calibrate on, e.g. 2022-09-21")
+    parser.add_argument("-x", "--exclude", default='', help="Comma separated dates or date ranges to exclude, e.g. 2022-09-18,2022-10-01:2022-10-05")
+    parser.add_argument("--include_labelled", action='store_true', help="If present, don't exclude days labelled in config/anomaly_labels.json")
+    parser.add_argument("-r", "--rolling", type=int, help="Print the coefficient fitted on the last ROLLING days for each day")
     args = parser.parse_args()
+
+    cache = DayStatsCache()
     if args.filename:
-        filename = args.filename
-    fname = DATA_FILE_RELATIVE_DIR + filename
-    df = pd.read_csv(fname)
-    
-    dict = {"coefficient": linear_regression(df)}
-    with open("./config/calibration.json", "w+") as e:
-        json.dump(dict, e)
-        
-    
+        dates = [args.filename[:10]]
+    else:
+        excluded = parse_dates(args.exclude)
+        if not args.include_labelled:
+            excluded |= get_labelled_dates()
+        dates = [d for d in list_processed_dates(args.start, args.end) if d not in excluded]
+
+    if args.rolling:
+        for date, coef, ndays in rolling_calibrate(dates, cache, args.rolling):
+            print(f'{date}: {coef:.4f} ({ndays} days)')
+        cache.save()
+        return
+
+    coef, stats = calibrate(dates, cache)
+    cache.save()
+    print(f'coefficient: {coef:.4f}, R²: {r2_from_stats(stats):.4f}, {len(dates)} days, {stats["n"]} samples')
+    write_calibrated_coefficient(coef, dates)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -6,93 +6,250 @@ sensors and writes the sensor data as a row to a csv file if -w option
 is specified.
 
 The ouput csv file is named by the date, e.g. 2022-09-15.csv
+
+Daemon usage: python collect_sensor_data.py --daemon -i 10
+
+Runs as a long-running process instead of being started by cron every minute. The sensors
+are initialized once and sampled every -i seconds on a drift-free schedule. Rows are buffered
+and appended to the day file in batches, see --flush_rows and --flush_seconds. With --fake,
+sensor readings are generated so that the daemon can run on a machine without the sensors.
+
+The sensors are read concurrently and each sample records when each sensor was read. The
+sample's timestamp is the time of the voltage/current/power reading. With --sensor_timestamps,
+new day files get extra columns with the per-sensor timestamps.
+
+With --metrics_file, the time of each sensor read and file append, and the counts of samples, missed
+samples, sensor errors (by sensor and reason) and rows written are written to a Prometheus textfile collector file, every
+METRICS_FLUSH_SECONDS and when stopped in daemon mode. With --trace_file, a JSON trace of the sensor reads and file appends
+is written. See instrumentation.py. When started by cron, each run adds to the counters and the trace of the previous runs,
+and records how many seconds after its scheduled minute it started sampling, as the
+pvmonitoring_last_cron_start_delay_seconds gauge, and summed over the runs as the
+pvmonitoring_cron_start_delay_seconds_total counter. The minutes since the previous run without a run are counted
+as missed samples, so a crontab that only runs during the day counts the nights as missed.
 """
 
 from datetime import datetime, date
 import sys, getopt
 import time
 import os
-import board
-import adafruit_ads1x15
-from adafruit_ina219 import ADCResolution, BusVoltageRange, INA219
-from w1thermsensor import W1ThermSensor, Unit
+import signal
+import threading
 import csv
-import adafruit_ads1x15.ads1115 as ADS
-from adafruit_ads1x15.analog_in import AnalogIn
 from constants import *
+from sensors import (ConcurrentSensorReader, create_backend, DEFAULT_SENSOR_TIMEOUT, TEMP_SENSOR, VIP_SENSOR,
+                     IRRADIANCE_SENSOR, SENSOR_TIMESTAMP_COLUMNS)
+import instrumentation
+
+DEFAULT_SAMPLE_INTERVAL = 60 # seconds
+DEFAULT_FLUSH_ROWS = 10
+DEFAULT_FLUSH_SECONDS = 300
+# Interval of the metrics and trace writes of the daemon.
+METRICS_FLUSH_SECONDS = 60
+# Interval of the runs started by cron.
+CRON_INTERVAL = 60 # seconds
+
+# Reads the sensors through a ConcurrentSensorReader. A reading that failed is None, and so is an empty value
+# in the data file.
+def get_sensor_data(reader):
+    readings = reader.read()
+    temp = readings[TEMP_SENSOR][0]
+    volt, current, power = readings[VIP_SENSOR][0] or [None, None, None]
+    irradiance = readings[IRRADIANCE_SENSOR][0]
 
-i2c_bus = board.I2C()
-ina1 = INA219(i2c_bus,addr=0x40)
-
-ina1.bus_adc_resolution = ADCResolution.ADCRES_12BIT_32S
-ina1.shunt_adc_resolution = ADCResolution.ADCRES_12BIT_32S
-ina1.bus_voltage_range = BusVoltageRange.RANGE_32V
-
-def get_vip():
-    load_voltage = round(ina1.bus_voltage, 2) # volts
-    current = round(ina1.current / 1000, 2) # amps
-    power = round(ina1.power, 2) # watts
-    return [load_voltage, current, power]
-
-def get_temp():
-    sensor = W1ThermSensor() 
-    temp = sensor.get_temperature()
-    return round(temp, 2)
-
-def get_irradiance():
-    ads = ADS.ADS1115(i2c_bus)
-    ads.range = 16
-    chan = AnalogIn(ads, ADS.P3)
-    if chan.voltage < 0:
-        return 0.0
-    # Apogee SP-110-SS calibration factor is 5w/m^2 per mV
-    return round(chan.voltage * 1000 * 5, 2)
-    # return 300
-
-def get_sensor_data():
-    temp = get_temp()
-    volt, current, power = get_vip()
-    irradiance = get_irradiance()
-    
-    now = datetime.now()
+    now = datetime.fromtimestamp(readings[VIP_SENSOR][1] or reader.clock())
     timestamp = round(now.timestamp())
     time = now.strftime(TIME_FORMAT)
     dict = {TIMESTAMP : timestamp, TIME: time, TEMPERATURE: temp, IRRADIANCE : irradiance, VOLTAGE : volt, CURRENT : current, POWER : power}
+    for sensor, column in SENSOR_TIMESTAMP_COLUMNS.items():
+        sensor_timestamp = readings[sensor][1]
+        dict[column] = None if sensor_timestamp is None else round(sensor_timestamp, 3)
 
     return dict
 
 # format of the filename is yyyy-mm-dd, e.g., 2022-08-01.csv
-def gen_data_filename_for_date(day):
-    return DATA_FILE_RELATIVE_DIR + day.strftime("%Y-%m-%d.csv")
+def gen_data_filename_for_date(day, data_dir=DATA_FILE_RELATIVE_DIR):
+    return data_dir + day.strftime("%Y-%m-%d.csv")
 
-def write_row_to_file(dict):
-    dt = datetime.strptime(dict[TIME], TIME_FORMAT)
-    filename = gen_data_filename_for_date(dt.today())
-    write_column_names = not(os.path.exists(filename))
-    with open(filename, 'a+', newline = '', encoding='utf-8') as file:
-        writer = csv.DictWriter(file, RAW_DATA_COLUMN_NAMES)
+# Returns the column names in the header of an existing data file.
+def read_column_names(filename):
+    with open(filename, 'r', newline = '', encoding='utf-8') as file:
+        return next(csv.reader(file), RAW_DATA_COLUMN_NAMES)
+
+# Appends rows to a data file. All rows must belong to the same day. A new file is created with the given
+# columns; rows appended to an existing file are written with the columns of its header.
+def write_rows_to_file(filename, rows, sync=False, column_names=RAW_DATA_COLUMN_NAMES):
+    with instrumentation.timer('file append'):
+        write_column_names = not(os.path.exists(filename))
         if write_column_names:
-            writer.writeheader()
-        writer.writerow(dict)
-        file.close()
+            # The data directory of an array of a fleet is created by its first sample.
+            os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        else:
+            column_names = read_column_names(filename)
+        with open(filename, 'a+', newline = '', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, column_names, extrasaction='ignore')
+            if write_column_names:
+                writer.writeheader()
+            writer.writerows(rows)
+            if sync:
+                file.flush()
+                os.fsync(file.fileno())
+    instrumentation.count('rows written', len(rows))
+
+# The data file is chosen by the date of the sample, not the date when the row is written.
+def write_row_to_file(dict, column_names=RAW_DATA_COLUMN_NAMES):
+    dt = datetime.strptime(dict[TIME], TIME_FORMAT)
+    write_rows_to_file(gen_data_filename_for_date(dt), [dict], column_names=column_names)
+
+# Buffers rows in memory and appends them to the day files in batches. Rows are flushed when flush_rows rows
+# are buffered, when the oldest buffered row is older than flush_seconds, or when a row of a new day arrives.
+# The day files are written to data_dir.
+class BufferedRowWriter:
+    def __init__(self, flush_rows=DEFAULT_FLUSH_ROWS, flush_seconds=DEFAULT_FLUSH_SECONDS, column_names=RAW_DATA_COLUMN_NAMES,
+                 data_dir=DATA_FILE_RELATIVE_DIR):
+        self.flush_rows = flush_rows
+        self.data_dir = data_dir
+        self.flush_seconds = flush_seconds
+        self.column_names = column_names
+        self.rows = []
+        self.filename = None
+        self.first_row_time = None
+
+    def write(self, dict):
+        filename = gen_data_filename_for_date(datetime.strptime(dict[TIME], TIME_FORMAT), self.data_dir)
+        if filename != self.filename:
+            self.flush()
+            self.filename = filename
+        if not self.rows:
+            self.first_row_time = time.monotonic()
+        self.rows.append(dict)
+        if len(self.rows) >= self.flush_rows or time.monotonic() - self.first_row_time >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            write_rows_to_file(self.filename, self.rows, sync=True, column_names=self.column_names)
+            self.rows = []
+
+# Samples the sensors every interval seconds until stopped by SIGTERM/SIGINT, or by setting stop_event, or until
+# max_samples samples are taken. Sample times are start + k * interval, so that the schedule doesn't drift by the
+# time spent reading the sensors. If sampling falls behind, the missed sample times are skipped.
+def run_daemon(reader, interval, writer=None, max_samples=None, verbose=False, stop_event=None):
+    if stop_event is None:
+        stop_event = threading.Event()
+    def stop(signum, frame):
+        stop_event.set()
+    previous_handlers = {signum: signal.signal(signum, stop) for signum in [signal.SIGTERM, signal.SIGINT]}
+
+    start = time.monotonic()
+    metrics_flush_time = start
+    samples = 0
+    missed = 0
+    tick = 0
+    try:
+        while not stop_event.is_set() and (max_samples is None or samples < max_samples):
+            delay = start + tick * interval - time.monotonic()
+            # Unlike time.sleep, which is resumed after the signal handler runs (PEP 475), the wait returns as
+            # soon as the handler sets the event.
+            if delay > 0 and stop_event.wait(delay):
+                break
+            dict = get_sensor_data(reader)
+            samples += 1
+            instrumentation.count('samples')
+            if verbose:
+                print(dict)
+            if writer:
+                writer.write(dict)
+            next_tick = int((time.monotonic() - start) // interval) + 1
+            missed += next_tick - tick - 1
+            instrumentation.count('missed samples', next_tick - tick - 1)
+            tick = next_tick
+            if time.monotonic() - metrics_flush_time >= METRICS_FLUSH_SECONDS:
+                instrumentation.flush()
+                metrics_flush_time = time.monotonic()
+    finally:
+        if writer:
+            writer.flush()
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+    print(f'{samples} samples taken, {missed} missed, sensor errors: {reader.errors}')
+    for sensor, message in reader.last_errors.items():
+        print(f'Last {sensor} sensor error: {message}')
+    return samples, missed
+
+# Records the start of a run started by cron every minute: the delay since the scheduled minute, and the
+# minutes missed since the previous run, from the state of the previous runs.
+def record_cron_run(start):
+    minute = start // CRON_INTERVAL * CRON_INTERVAL
+    instrumentation.set_gauge('last cron start delay seconds', round(start - minute, 3))
+    instrumentation.count('cron start delay seconds', round(start - minute, 3))
+    previous_minute = instrumentation.get_gauge('last cron minute')
+    if previous_minute is not None and minute > previous_minute:
+        instrumentation.count('missed samples', int((minute - previous_minute) // CRON_INTERVAL) - 1)
+    instrumentation.set_gauge('last cron minute', int(minute))
+    instrumentation.count('samples')
 
 def main():
+    # Includes the time to import the modules.
+    start = time.time()
     write_file = False
-    
+    daemon = False
+    fake = False
+    verbose = False
+    interval = DEFAULT_SAMPLE_INTERVAL
+    flush_rows = DEFAULT_FLUSH_ROWS
+    flush_seconds = DEFAULT_FLUSH_SECONDS
+    timeout = DEFAULT_SENSOR_TIMEOUT
+    column_names = RAW_DATA_COLUMN_NAMES
+    metrics_file = None
+    trace_file = None
+
     argv = sys.argv[1:]
     try:
-        opts, args = getopt.getopt(argv, "w", ["write_file"])
+        opts, args = getopt.getopt(argv, "wi:v", ["write_file", "daemon", "interval=", "flush_rows=", "flush_seconds=", "fake", "verbose", "timeout=", "sensor_timestamps", "metrics_file=", "trace_file="])
     except:
         print("Wrong arg")
-  
+
     for opt, arg in opts:
         if opt in ['-w', '--write_file']:
             write_file = True
+        elif opt == '--daemon':
+            daemon = True
+        elif opt in ['-i', '--interval']:
+            interval = float(arg)
+        elif opt == '--flush_rows':
+            flush_rows = int(arg)
+        elif opt == '--flush_seconds':
+            flush_seconds = float(arg)
+        elif opt == '--fake':
+            fake = True
+        elif opt in ['-v', '--verbose']:
+            verbose = True
+        elif opt == '--timeout':
+            timeout = float(arg)
+        elif opt == '--sensor_timestamps':
+            column_names = RAW_DATA_COLUMN_NAMES + SENSOR_TIMESTAMP_COLUMN_NAMES
+        elif opt == '--metrics_file':
+            metrics_file = arg
+        elif opt == '--trace_file':
+            trace_file = arg
+
+    # Runs started by cron add to the metrics of the previous runs.
+    instrumentation.enable(metrics_file, trace_file, accumulate=not daemon)
+
+    reader = ConcurrentSensorReader(create_backend(fake), timeout)
+    try:
+        if daemon:
+            run_daemon(reader, interval, BufferedRowWriter(flush_rows, flush_seconds, column_names), verbose=verbose)
+            return
 
-    dict = get_sensor_data()
-    print(dict)
-    if write_file:
-        write_row_to_file(dict)
+        record_cron_run(start)
+        dict = get_sensor_data(reader)
+        print(dict)
+        if write_file:
+            write_row_to_file(dict, column_names)
+    finally:
+        reader.close()
+        instrumentation.flush()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
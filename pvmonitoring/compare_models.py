@@ -0,0 +1,165 @@
+"""
+Compares IAM and cell temperature models on the processed data of a date range, in one pass.
+
+compute_power.py uses the physical IAM model and feeds the measured temperature into pvwatts as the cell
+temperature. This script evaluates every combination of the IAM models in IAM_MODELS and the cell
+temperature models in TEMPERATURE_MODELS instead:
+    - IAM: physical, ashrae and martin_ruiz, with pvlib's default parameters
+    - cell temperature: measured (the measured temperature as is), sapm (SAPM cell temperature from the
+      measured temperature as the back-of-module temperature) and faiman (Faiman model with the measured
+      temperature as the air temperature)
+The processed data files are read once, with the smoothed irradiance, temperature and power, and the AOI
+of all samples is looked up once in the solar position cache. Each IAM model is then one vectorized
+function of the AOI and each temperature model one of the irradiance and temperature, and pvwatts is
+evaluated for all (IAM model x temperature model x sample) at once, so a model adds one array operation,
+not another read or solar position computation. To add a model, add its function to IAM_MODELS or
+TEMPERATURE_MODELS.
+
+The computed power of each variant, adjusted by the calibrated power coefficient, is written side by side with
+the measured power to one csv file. The MAE, RMSE, R² and performance ratio of each variant against the
+measured power (power smoothed) are computed for each day on the daytime samples, as in daily_metrics.py,
+written to a report csv file, and averaged over the days in the printed summary.
+
+Example usage: 'python compare_models.py -s 2022-09-01 -e 2022-09-30'
+               'python compare_models.py -s 2022-09-01 -e 2022-09-30 --iam physical,ashrae --temperature measured,sapm'
+"""
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import pvlib
+import solar_position_cache
+from constants import *
+from site_config import Config
+from storage import load_day
+from calibrate import filter_daytime, list_processed_dates, read_calibrated_coefficient
+from daily_metrics import compute_day_metrics, MAE, RMSE, R2, PERFORMANCE_RATIO, MEASURED_ENERGY, COMPUTED_ENERGY
+
+MODEL_COMPARISON_FILE = CACHE_DIR + 'model_comparison.csv'
+MODEL_REPORT_FILE = CACHE_DIR + 'model_comparison_report.csv'
+INPUT_COLUMNS = [TIME, IRRADIANCE_SMOOTHED, TEMPERATURE_SMOOTHED, POWER_SMOOTHED]
+SAPM_MOUNT = 'open_rack_glass_polymer'
+
+# IAM models, functions of AOI.
+# Details: https://pvpmc.sandia.gov/modeling-steps/1-weather-design-inputs/shading-soiling-and-reflection-losses/incident-angle-reflection-losses/
+IAM_MODELS = {
+    'physical': pvlib.iam.physical,
+    'ashrae': pvlib.iam.ashrae,
+    'martin_ruiz': pvlib.iam.martin_ruiz,
+}
+
+# Cell temperature models, functions of the plane of array irradiance and the measured temperature.
+TEMPERATURE_MODELS = {
+    'measured': lambda irradiance, temperature: temperature,
+    'sapm': lambda irradiance, temperature: pvlib.temperature.sapm_cell_from_module(
+        temperature, irradiance, pvlib.temperature.TEMPERATURE_MODEL_PARAMETERS['sapm'][SAPM_MOUNT]['deltaT']),
+    'faiman': lambda irradiance, temperature: pvlib.temperature.faiman(irradiance, temperature),
+}
+
+VARIANT = 'variant'
+DATE = 'date'
+
+def variant_name(iam_model, temperature_model):
+    return f'{COMPUTED_POWER} ({iam_model}, {temperature_model})'
+
+# Loads the daytime samples with a time of the processed data of the given dates into one DataFrame, with
+# a datetime TIME column.
+def load_samples(dates):
+    frames = [load_day(date, True, INPUT_COLUMNS) for date in dates]
+    if not frames:
+        raise Exception("No processed data files in the date range")
+    df = pd.concat(frames, ignore_index=True)
+    df = filter_daytime(df[df[TIME].notna()]).reset_index(drop=True)
+    df[TIME] = pd.to_datetime(df[TIME], format=TIME_FORMAT)
+    return df
+
+# Returns the AOI of each sample.
+def get_aoi(time, config):
+    dti = pd.DatetimeIndex(time, tz=config.timezone)
+    geometry = solar_position_cache.lookup(dti, config.location, config.pvsystem)
+    if geometry is None:
+        geometry = solar_position_cache.compute_solar_geometry(dti, config.location, config.pvsystem)
+    return geometry[solar_position_cache.AOI].to_numpy()
+
+# Returns the computed power of each (IAM model, temperature model) variant as an array with a row per
+# variant, in the order of variants.
+def compute_variants(df, config, iam_models, temperature_models, power_coefficient):
+    aoi = get_aoi(df[TIME], config)
+    irradiance = df[IRRADIANCE_SMOOTHED].to_numpy(dtype=float)
+    temperature = df[TEMPERATURE_SMOOTHED].to_numpy(dtype=float)
+    # (IAM models x samples) and (temperature models x samples)
+    iam = np.vstack([np.asarray(IAM_MODELS[model](aoi), dtype=float) for model in iam_models])
+    temp_cell = np.vstack([np.asarray(TEMPERATURE_MODELS[model](irradiance, temperature), dtype=float)
+                           for model in temperature_models])
+    # Broadcast to (IAM models x temperature models x samples).
+    pvwatts_dc = pvlib.pvsystem.pvwatts_dc(iam[:, np.newaxis, :] * irradiance, temp_cell[np.newaxis, :, :],
+                                           config.pvsystem['pdc0'], gamma_pdc=config.pvsystem['gamma_pdc'])
+    variants = [(i, t) for i in iam_models for t in temperature_models]
+    return variants, np.round(pvwatts_dc * power_coefficient, 2).reshape(len(variants), len(df))
+
+# Returns the metrics of each variant for each day, as a DataFrame with a row per (date, variant).
+def get_daily_errors(df, variants, computed):
+    rows = []
+    dates = df[TIME].dt.strftime('%Y-%m-%d').to_numpy()
+    starts = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1]])
+    ends = np.r_[starts[1:], len(df)]
+    for start, end in zip(starts, ends):
+        time = df[TIME].iloc[start:end]
+        measured = df[POWER_SMOOTHED].to_numpy(dtype=float)[start:end]
+        irradiance = df[IRRADIANCE_SMOOTHED].iloc[start:end]
+        for (iam_model, temperature_model), power in zip(variants, computed):
+            metrics = compute_day_metrics(time, measured, power[start:end], irradiance)
+            rows.append(dict({DATE: dates[start], VARIANT: variant_name(iam_model, temperature_model)}, **metrics))
+    return pd.DataFrame(rows)
+
+# Returns the mean of each metric over the days per variant, with the performance ratio of the total energy,
+# sorted by RMSE.
+def summarize(report):
+    grouped = report.groupby(VARIANT, sort=False)
+    summary = grouped[[MAE, RMSE, R2]].mean()
+    summary[PERFORMANCE_RATIO] = grouped[MEASURED_ENERGY].sum() / grouped[COMPUTED_ENERGY].sum()
+    return summary.sort_values(RMSE)
+
+def compare_models(dates, iam_models, temperature_models, power_coefficient=None):
+    config = Config()
+    power_coefficient = read_calibrated_coefficient() if power_coefficient is None else power_coefficient
+    df = load_samples(dates)
+    variants, computed = compute_variants(df, config, iam_models, temperature_models, power_coefficient)
+    output = df[[TIME, POWER_SMOOTHED]].copy()
+    for variant, power in zip(variants, computed):
+        output[variant_name(*variant)] = power
+    return output, get_daily_errors(df, variants, computed)
+
+# Returns the models of a comma separated list, all models if it is empty.
+def parse_models(models_str, models):
+    names = models_str.split(',') if models_str else list(models)
+    for name in names:
+        if name not in models:
+            raise Exception(f"Unknown model {name}, one of {', '.join(models)}")
+    return names
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--start", help="First date, e.g. 2022-09-01")
+    parser.add_argument("-e", "--end", help="Last date, e.g. 2022-09-30")
+    parser.add_argument("--iam", default='', help=f"Comma separated IAM models, of {', '.join(IAM_MODELS)}. Defaults to all")
+    parser.add_argument("--temperature", default='', help=f"Comma separated cell temperature models, of {', '.join(TEMPERATURE_MODELS)}. Defaults to all")
+    parser.add_argument("-c", "--power_coef", type=float, help="power coefficient to adjust pvwatts power, defaults to the coefficient in config/calibration.json")
+    parser.add_argument("-o", "--output", default=MODEL_COMPARISON_FILE, help="csv file for the computed power of the variants")
+    parser.add_argument("-r", "--report", default=MODEL_REPORT_FILE, help="csv file for the per-day errors of the variants")
+    args = parser.parse_args()
+
+    iam_models = parse_models(args.iam, IAM_MODELS)
+    temperature_models = parse_models(args.temperature, TEMPERATURE_MODELS)
+    output, report = compare_models(list_processed_dates(args.start, args.end), iam_models, temperature_models,
+                                    args.power_coef)
+    for df, fname in [(output, args.output), (report, args.report)]:
+        os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+        df.to_csv(fname, index=False, date_format=TIME_FORMAT)
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(summarize(report).round(3).to_string())
+    print(f'{report[DATE].nunique()} days, {len(output)} samples. Computed power written to {args.output}, per-day errors to {args.report}')
+
+if __name__ == "__main__":
+    main()
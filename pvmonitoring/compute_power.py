@@ -7,59 +7,64 @@ Computes power by:
             implemented by pvlib: https://pvlib-python.readthedocs.io/en/stable/_modules/pvlib/iam.html
     - Step 3: Adjust the pvwatts power from Step 2 with coefficient to account for system inefficiencies
         like mppt tracking, wire loss, etc.
-        - The coefficient is obtained by linear regression on calibration data.
+        - The coefficient is obtained by linear regression on calibration data, see calibrate.py. It is read
+            from config/calibration.json unless -c is given.
         
 Example usage: 'python compute_power.py -f 2022-09-14.csv' or 'python compute_power.py -d 2022-09-14'
     This would output 2022-09-14_processed.csv which copies the columns of 2022-09-14.csv and add new columns for
-    the computed results, e.g., pvwatts power, iam, and most importantly, computed power.
+    the computed results, e.g., pvwatts power, iam, and most importantly, computed power. The day is recorded in
+    the manifest like in batch mode.
+
+Batch usage: 'python compute_power.py -b' or 'python compute_power.py -b -s 2022-09-01 -e 2022-09-30'
+    This processes all raw data files (optionally limited to a date range) across a process pool. A day is
+    skipped if its _processed.csv is newer than the raw file and was built from the same config and power
+    coefficient, so changing config.json or the power coefficient only rebuilds what is affected.
+
+With --grid 60, each day is resampled onto a regular 60 second grid before preprocessing, with short gaps
+interpolated and long gaps masked, see resample.py. The grid interval is recorded in the manifest. The
+smoothing window is an odd number of grid samples, see preprocess_data.grid_window_samples.
+
+The daily metrics table (see daily_metrics.py) is updated for the processed days.
+
+With --metrics_file and --trace_file, the time spent in csv load, fixing MPPT dips, smoothing, solar position,
+pvwatts and csv write, and the number of dips fixed and rows processed, are written to a Prometheus textfile and
+a JSON trace. See instrumentation.py.
 """
 
 import argparse
+import glob
+import os
+from datetime import datetime
+from zoneinfo import ZoneInfo
+import numpy as np
 import pvlib
 import pandas as pd
+import instrumentation
+import solar_position_cache
+import storage
+from daily_metrics import update_daily_metrics
+from calibrate import read_calibrated_coefficient
+from concurrent.futures import ProcessPoolExecutor
 from constants import *
 from preprocess_data import *
+from resample import resample_day
+from site_config import Config
 import json
 
-class Config:
-    def __init__(self):
-        with open(CONFIG_FILE, 'r') as file:
-            dict = json.load(file)
-            self.pvsystem = dict['pvsystem']
-            self.location = dict['location']
+# Records which config hash and power coefficient each _processed.csv was built from.
+PROCESSED_MANIFEST_FILE = DATA_FILE_RELATIVE_DIR + 'processed_manifest.json'
 
 # Returns IAM: Incidence Angle modifier.
 # Details: https://pvpmc.sandia.gov/modeling-steps/1-weather-design-inputs/shading-soiling-and-reflection-losses/incident-angle-reflection-losses/
-# pvlib implements multiple IAM models: https://pvlib-python.readthedocs.io/en/stable/_modules/pvlib/iam.html. 
-# This function uses pvlib physical IAM model and its default params.
+# The IAM is read from the per-minute solar position cache (see solar_position_cache.py). If the cache
+# can't be used, sun position, AOI and IAM are computed by pvlib.
 def get_iam(time, config):
-    pvsystem = config.pvsystem
-    location = config.location
-    # Get sun position for the given time
-    dti = pd.DatetimeIndex(pd.to_datetime(time, format=TIME_FORMAT), tz='US/Pacific')
-    solpos = pvlib.solarposition.get_solarposition(
-        time=dti,
-        latitude=location['latitude'],
-        longitude=location['longitude'],
-        altitude=location['altitude']
-    )
- 
-    # Get AOI(angle of incident) for the current sun postion
-    aoi = pvlib.irradiance.aoi(
-        pvsystem['surface_tilt'],
-        pvsystem['surface_azimuth'],
-        solpos["apparent_zenith"],
-        solpos["azimuth"],
-    )
-    
-    # Get IAM
-    # Ashrae IAM model： https://pvpmc.sandia.gov/modeling-steps/1-weather-design-inputs/shading-soiling-and-reflection-losses/incident-angle-reflection-losses/ashre-model/
-    #iam = pvlib.iam.ashrae(aoi)
-    # Martin and Ruiz model： https://pvpmc.sandia.gov/modeling-steps/1-weather-design-inputs/shading-soiling-and-reflection-losses/incident-angle-reflection-losses/martin-and-ruiz-model/
-    #iam = pvlib.iam.martin_ruiz(aoi)
-
-    # Physical IAM model: https://pvpmc.sandia.gov/modeling-steps/1-weather-design-inputs/shading-soiling-and-reflection-losses/incident-angle-reflection-losses/physical-model-of-iam/
-    iam = pvlib.iam.physical(aoi)
+    with instrumentation.timer('solar position'):
+        dti = pd.DatetimeIndex(pd.to_datetime(time, format=TIME_FORMAT), tz=config.timezone)
+        geometry = solar_position_cache.lookup(dti, config.location, config.pvsystem)
+        if geometry is None:
+            geometry = solar_position_cache.compute_solar_geometry(dti, config.location, config.pvsystem)
+    iam = geometry[solar_position_cache.IAM]
     iam.reset_index(drop=True, inplace=True)
     return iam
 
@@ -70,37 +75,192 @@ def compute_power(irradiance, temp_cell, time, power_coefficient, config):
     effective_irradiance = iam * irradiance
     gamma_pdc = config.pvsystem['gamma_pdc']
     pdc0 = config.pvsystem['pdc0']
-    pvwatts_dc = pvlib.pvsystem.pvwatts_dc(effective_irradiance,
-                               temp_cell,
-                               pdc0, #pdc0 (numeric) – Power of the modules at 1000 W/m^2 and cell reference temperature. [W]
-                               gamma_pdc=gamma_pdc)
+    with instrumentation.timer('pvwatts'):
+        pvwatts_dc = pvlib.pvsystem.pvwatts_dc(effective_irradiance,
+                                   temp_cell,
+                                   pdc0, #pdc0 (numeric) – Power of the modules at 1000 W/m^2 and cell reference temperature. [W]
+                                   gamma_pdc=gamma_pdc)
     return iam, round(pvwatts_dc, 2), round(pvwatts_dc * power_coefficient, 2)
 
-def process(filename, power_coefficient):
-    fname = DATA_FILE_RELATIVE_DIR + filename
-    df = pd.read_csv(fname)
-    df = preprocess_data(df)
-    config = Config()
+# Returns (IAM, pvwatts power, computed power) of one sample, like compute_power for a sample, with scalar math.
+# time is a string in TIME_FORMAT.
+def compute_row_power(irradiance, temp_cell, time, power_coefficient, config):
+    local_time = datetime.strptime(time, TIME_FORMAT).replace(tzinfo=ZoneInfo(config.timezone))
+    iam = solar_position_cache.lookup_iam(local_time.timestamp(), config.location, config.pvsystem)
+    if iam is None:
+        iam, pvwatts_power, computed_power = compute_power(pd.Series([irradiance]), pd.Series([temp_cell]),
+                                                           pd.Series([time]), power_coefficient, config)
+        return iam[0], pvwatts_power[0], computed_power[0]
+    pvwatts_dc = pvlib.pvsystem.pvwatts_dc(iam * irradiance, temp_cell, config.pvsystem['pdc0'],
+                                           gamma_pdc=config.pvsystem['gamma_pdc'])
+    # np.round like compute_power, Python's round() rounds some halves the other way.
+    return iam, float(np.round(pvwatts_dc, 2)), float(np.round(pvwatts_dc * power_coefficient, 2))
 
+# Returns the processed data for the raw data of a day. With grid_interval, the data is first resampled onto a
+# regular grid of grid_interval seconds, see resample.py.
+def process_df(df, power_coefficient, config, window=SMOOTH_DATA_WINDOW_SIZE, grid_interval=None):
+    if grid_interval:
+        df = preprocess_grid(resample_day(df, grid_interval, timezone=config.timezone), grid_interval, window)
+    else:
+        df = preprocess_data(df, window)
     df[IAM_FACTOR], df[PVWATTS_POWER], df[COMPUTED_POWER] = compute_power(df[IRRADIANCE_SMOOTHED], df[TEMPERATURE_SMOOTHED], df[TIME], power_coefficient, config)
+    return df
+
+# Processes the raw data file of a day in the data directory into its _processed.csv. With store, the raw data
+# is loaded through the columnar store and the processed data is also written to it, see storage.py. Files
+# that are not day files of the data directory, like the devices' files of replay.py, are processed without.
+def process(filename, power_coefficient, config=None, grid_interval=None, store=True):
+    fname = DATA_FILE_RELATIVE_DIR + filename
+    with instrumentation.timer('csv load'):
+        df = storage.load_day(filename[:-4]) if store else pd.read_csv(fname)
+    if config is None:
+        config = Config()
+
+    df = process_df(df, power_coefficient, config, grid_interval=grid_interval)
     processed_filename = fname[:-4] + "_processed.csv"
-    df.to_csv(processed_filename, index=False)
+    with instrumentation.timer('csv write'):
+        df.to_csv(processed_filename, index=False)
+        if store:
+            storage.write_day(df, filename[:-4], processed=True, source=processed_filename)
+    instrumentation.count('rows processed', len(df))
+
+# Runs process in a worker process and returns the instrumentation recorded there.
+def process_in_worker(filename, power_coefficient, config, grid_interval):
+    process(filename, power_coefficient, config, grid_interval)
+    return instrumentation.snapshot()
+
+def processed_filename_for(filename):
+    return filename[:-4] + "_processed.csv"
+
+# Returns the manifest of the data directory, or the manifest of another directory given by fname, e.g. of an
+# array of a fleet, see fleet.py.
+def load_manifest(fname=PROCESSED_MANIFEST_FILE):
+    if not os.path.exists(fname):
+        return {}
+    with open(fname, 'r') as file:
+        return json.load(file)
+
+def save_manifest(manifest, fname=PROCESSED_MANIFEST_FILE):
+    tmp_filename = fname + '.tmp'
+    with open(tmp_filename, 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(tmp_filename, fname)
+
+# Returns the manifest entry of a day processed with the given config hash, power coefficient and grid interval.
+def manifest_entry(config_hash, power_coefficient, grid_interval=None):
+    entry = {'config_hash': config_hash, 'power_coefficient': power_coefficient}
+    if grid_interval:
+        entry['grid_interval'] = grid_interval
+    return entry
+
+# Processes one day, like a day of process_batch, and records it in the manifest, so that process_batch and
+# serve.py know it is up to date.
+def process_single(filename, power_coefficient, grid_interval=None):
+    config = Config()
+    process(filename, power_coefficient, config, grid_interval)
+    manifest = load_manifest()
+    manifest[filename] = manifest_entry(config.hash(), power_coefficient, grid_interval)
+    save_manifest(manifest)
+    update_daily_metrics([filename[:10]])
+
+# Returns the raw data filenames, e.g. 2022-09-14.csv, whose dates are within [start_date, end_date].
+# Either bound may be None.
+def list_raw_filenames(start_date=None, end_date=None):
+    filenames = []
+    for path in sorted(glob.glob(DATA_FILE_RELATIVE_DIR + '*.csv')):
+        filename = os.path.basename(path)
+        if filename.endswith('_processed.csv'):
+            continue
+        date = filename[:-4]
+        if (start_date and date < start_date) or (end_date and date > end_date):
+            continue
+        filenames.append(filename)
+    return filenames
+
+# Returns why filename in data_dir needs to be (re)processed, or None if its _processed.csv is up to date.
+def rebuild_reason(filename, manifest, config_hash, power_coefficient, grid_interval=None, data_dir=DATA_FILE_RELATIVE_DIR):
+    raw_fname = data_dir + filename
+    processed_fname = data_dir + processed_filename_for(filename)
+    if not os.path.exists(processed_fname):
+        return 'not processed'
+    if os.path.getmtime(processed_fname) < os.path.getmtime(raw_fname):
+        return 'raw data changed'
+    entry = manifest.get(filename)
+    if entry is None:
+        return 'unknown provenance'
+    if entry['config_hash'] != config_hash:
+        return 'config changed'
+    if entry['power_coefficient'] != power_coefficient:
+        return 'power coefficient changed'
+    if entry.get('grid_interval') != grid_interval:
+        return 'grid interval changed'
+    return None
+
+# Returns the UTC years spanned by the data files. Evening samples of Dec 31st fall in the next UTC year.
+def utc_years_for(filenames):
+    years = set()
+    for filename in filenames:
+        year = int(filename[:4])
+        years.add(year)
+        if filename[5:10] == '12-31':
+            years.add(year + 1)
+    return years
+
+def process_batch(filenames, power_coefficient, workers=None, force=False, grid_interval=None):
+    config = Config()
+    config_hash = config.hash()
+    manifest = load_manifest()
+
+    reasons = {}
+    for filename in filenames:
+        reason = 'forced' if force else rebuild_reason(filename, manifest, config_hash, power_coefficient, grid_interval)
+        if reason:
+            reasons[filename] = reason
+
+    failures = {}
+    if reasons:
+        # Build the solar position tables once here instead of in every worker.
+        for year in sorted(utc_years_for(reasons)):
+            solar_position_cache.load_table(config.location, config.pvsystem, year)
+        with ProcessPoolExecutor(max_workers=workers, initializer=instrumentation.enable,
+                                 initargs=instrumentation.get_outputs()) as executor:
+            futures = {filename: executor.submit(process_in_worker, filename, power_coefficient, config, grid_interval) for filename in reasons}
+            for filename, future in futures.items():
+                try:
+                    instrumentation.merge(future.result())
+                    manifest[filename] = manifest_entry(config_hash, power_coefficient, grid_interval)
+                except Exception as e:
+                    failures[filename] = e
+        save_manifest(manifest)
+        update_daily_metrics([filename[:10] for filename in reasons if filename not in failures])
+
+    for filename, reason in reasons.items():
+        status = f'FAILED: {failures[filename]}' if filename in failures else 'rebuilt'
+        print(f'{filename}: {status} ({reason})')
+    print(f'{len(reasons) - len(failures)} rebuilt, {len(filenames) - len(reasons)} up to date, {len(failures)} failed')
+    return failures
 
 def main():
     parser = argparse.ArgumentParser()
-    # Either'-f' and '-d' must be specified, but not both.
-    parser.add_argument("-f", "--filename", help="Filename of the data file, e.g. 2022-09-14.csv")
-    parser.add_argument("-d", "--date", help="The date part of the data file, e.g. 2022-09-14.")
-    parser.add_argument("-c", "--power_coef", type=float, default=0.9, help="power coefficient to adjust pvwatts power, defaluts to 0.88")
+    # One of '-f', '-d' and '-b' must be specified.
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("-f", "--filename", help="Filename of the data file, e.g. 2022-09-14.csv")
+    mode.add_argument("-d", "--date", help="The date part of the data file, e.g. 2022-09-14.")
+    mode.add_argument("-b", "--batch", action='store_true', help="If present, process all raw data files, or those between --start and --end, in parallel")
+    parser.add_argument("-c", "--power_coef", type=float, help="power coefficient to adjust pvwatts power, defaults to the coefficient in config/calibration.json, or 0.88 if there is none")
+    parser.add_argument("-s", "--start", help="Batch mode: first date to process, e.g. 2022-09-01")
+    parser.add_argument("-e", "--end", help="Batch mode: last date to process, e.g. 2022-09-30")
+    parser.add_argument("-j", "--jobs", type=int, help="Batch mode: number of worker processes, defaults to the number of CPUs")
+    parser.add_argument("--force", action='store_true', help="Batch mode: rebuild all files even if they are up to date")
+    parser.add_argument("--grid", type=int, help="Resample the data onto a regular grid of this many seconds before preprocessing, see resample.py")
+    parser.add_argument("--metrics_file", help="Write stage timings and counters to this Prometheus textfile, e.g. /var/lib/node_exporter/textfile_collector/pvmonitoring_process.prom")
+    parser.add_argument("--trace_file", help="Write a JSON trace of the stages to this file")
     args = parser.parse_args()
 
-    filenames = ''
     if args.filename:
         filename = args.filename
     elif args.date:
         filename = args.date + '.csv'
-    else:
-         raise Exception("Option -f or -d must be specified")
 
     # Power efficiency coefficient. It relfects power loss due to MPPT tracking and
     # pyranometer calibration. 1.0 represents no power loss, and 0.9 represents 10%
@@ -112,10 +272,25 @@ def main():
     # power. After calibration, the computed power is the pvwatts power adjusted by this coefficient.
     # The computed power is used as the reference baseline for detecting anomolies.
     
-    #TODO: remove this. Instead, read calibrated coef from file outputted by calibriate.py
-    power_coefficient = args.power_coef
+    # The calibrated coefficient is written to config/calibration.json by calibrate.py.
+    power_coefficient = args.power_coef if args.power_coef is not None else read_calibrated_coefficient()
+
+    if args.grid:
+        window_samples = grid_window_samples(SMOOTH_DATA_WINDOW_SIZE, args.grid)
+        if window_samples * args.grid != SMOOTH_DATA_WINDOW_SIZE * 60:
+            print(f'Note: the {SMOOTH_DATA_WINDOW_SIZE} minute smoothing window is {window_samples} samples of '
+                  f'{args.grid} seconds ({window_samples * args.grid / 60:g} minutes), to be centered on a sample')
 
-    process(filename, power_coefficient)
+    instrumentation.enable(args.metrics_file, args.trace_file)
+    try:
+        if args.batch:
+            failures = process_batch(list_raw_filenames(args.start, args.end), power_coefficient, args.jobs, args.force, args.grid)
+            if failures:
+                raise SystemExit(1)
+        else:
+            process_single(filename, power_coefficient, args.grid)
+    finally:
+        instrumentation.flush()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,3 +1,4 @@
+import os as _os
 TIMESTAMP = "timestamp"
 TIME = "time"
 TEMPERATURE = "temperature"
@@ -15,11 +16,42 @@ PVWATTS_POWER = "pvwatts power"
 COMPUTED_POWER = "computed power"
 SIM_POWER = "sim_power" #TODO: remove this after simulate_power.py is decommisioned
 RAW_DATA_COLUMN_NAMES = [TIMESTAMP, TIME, TEMPERATURE,IRRADIANCE, VOLTAGE, CURRENT, POWER]
+# Optional columns with the time each sensor was read, in seconds since the epoch.
+TEMPERATURE_TIMESTAMP = "temperature timestamp"
+VIP_TIMESTAMP = "vip timestamp"
+IRRADIANCE_TIMESTAMP = "irradiance timestamp"
+SENSOR_TIMESTAMP_COLUMN_NAMES = [TEMPERATURE_TIMESTAMP, VIP_TIMESTAMP, IRRADIANCE_TIMESTAMP]
+DERIVED_DATA_COLUMN_NAMES = [TEMPERATURE_SMOOTHED, IRRADIANCE_SMOOTHED, VOLTAGE_SMOOTHED, CURRENT_SMOOTHED, POWER_SMOOTHED,
+                             IAM_FACTOR, PVWATTS_POWER, COMPUTED_POWER]
+PROCESSED_DATA_COLUMN_NAMES = RAW_DATA_COLUMN_NAMES + DERIVED_DATA_COLUMN_NAMES
 
 SMOOTH_DATA_WINDOW_SIZE = 5
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
-DATA_FILE_RELATIVE_DIR = './data/'
-CONFIG_FILE = './config/config.json'
+# The directories are relative to the current directory unless they are set by the environment variables,
+# e.g. by the --data_dir etc. options of pvmon.py.
+DATA_DIR_VARIABLE = 'PVMON_DATA_DIR'
+CONFIG_DIR_VARIABLE = 'PVMON_CONFIG_DIR'
+CACHE_DIR_VARIABLE = 'PVMON_CACHE_DIR'
+STORE_DIR_VARIABLE = 'PVMON_STORE_DIR'
+# With PVMON_ARRAY set to the name of an array of a fleet config (see fleet.py), the scripts work on that array:
+# its data, cache and store are the subdirectories named after it, and site_config.Config is its site and
+# pvsystem. The config directory is shared by the arrays.
+ARRAY_VARIABLE = 'PVMON_ARRAY'
+ARRAY = _os.environ.get(ARRAY_VARIABLE) or None
+def _dir_from_env(variable, default):
+    return _os.path.join(_os.environ.get(variable) or default, '')
+def array_dir(base_dir, array):
+    return base_dir + array + '/' if array else base_dir
+BASE_DATA_DIR = _dir_from_env(DATA_DIR_VARIABLE, './data/')
+BASE_CACHE_DIR = _dir_from_env(CACHE_DIR_VARIABLE, './cache/')
+BASE_STORE_DIR = _dir_from_env(STORE_DIR_VARIABLE, './store/')
+DATA_FILE_RELATIVE_DIR = array_dir(BASE_DATA_DIR, ARRAY)
+CONFIG_DIR = _dir_from_env(CONFIG_DIR_VARIABLE, './config/')
+CONFIG_FILE = CONFIG_DIR + 'config.json'
+CALIBRATION_FILE = CONFIG_DIR + 'calibration.json'
+ANOMALY_LABELS_FILE = CONFIG_DIR + 'anomaly_labels.json'
+CACHE_DIR = array_dir(BASE_CACHE_DIR, ARRAY)
+STORE_DIR = array_dir(BASE_STORE_DIR, ARRAY)
 
 DEFAULT_POWER_COEF = 0.88
 
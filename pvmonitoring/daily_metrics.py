@@ -0,0 +1,186 @@
+"""
+Materialized table of daily metrics, one row per processed day, computed on the data between DAY_START_TIME
+and DAY_END_TIME:
+    - measured and computed energy (Wh), from power smoothed and computed power
+    - mean measured power (W)
+    - MAE, RMSE and R² of computed power vs. power smoothed
+    - performance ratio: measured energy / computed energy
+    - peak irradiance (W/m^2), from irradiance smoothed
+    - coverage: the fraction of the daytime window covered by measured samples, at the day's median sample
+      interval, as defined by resample.daytime_coverage. The interpolated and missing points of a day
+      processed with --grid are not counted.
+
+The table is kept in ./cache/daily_metrics.csv. Each row records the mtime and size of the _processed.csv it
+was computed from and is recomputed when the file changes, so rows are only computed for new or re-processed
+days. compute_power.py updates the rows of the days it processes. Queries over many days read this small
+table instead of the processed data files.
+
+Example usage: 'python daily_metrics.py -s 2022-09-01 -e 2022-09-30' prints the metrics of September 2022.
+"""
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from constants import *
+from calibrate import filter_daytime, list_processed_dates
+from resample import daytime_coverage, SAMPLE_FLAG, MEASURED
+from storage import load_day, load_day_columns
+
+DAILY_METRICS_FILE = CACHE_DIR + 'daily_metrics.csv'
+METRICS_INPUT_COLUMNS = [TIME, POWER_SMOOTHED, COMPUTED_POWER, IRRADIANCE_SMOOTHED]
+# Longest gap between samples that is counted as sampled time, in seconds.
+MAX_SAMPLE_INTERVAL = 300
+
+DATE = 'date'
+SAMPLES = 'samples'
+COVERAGE = 'coverage'
+MEASURED_ENERGY = 'measured energy (Wh)'
+COMPUTED_ENERGY = 'computed energy (Wh)'
+POWER_MEAN = 'power mean'
+MAE = 'mae'
+RMSE = 'rmse'
+R2 = 'r2'
+PERFORMANCE_RATIO = 'performance ratio'
+PEAK_IRRADIANCE = 'peak irradiance'
+METRICS_COLUMNS = [SAMPLES, COVERAGE, MEASURED_ENERGY, COMPUTED_ENERGY, POWER_MEAN, MAE, RMSE, R2,
+                   PERFORMANCE_RATIO, PEAK_IRRADIANCE]
+# Version of the metrics definitions. Rows computed by another version are recomputed.
+METRICS_VERSION = 2
+VERSION = 'version'
+TABLE_COLUMNS = [DATE, 'mtime_ns', 'size', VERSION] + METRICS_COLUMNS
+
+# Returns the hours covered by each sample: the time since the previous sample, capped at MAX_SAMPLE_INTERVAL.
+# The first sample covers the median interval.
+def get_sample_hours(time):
+    interval = pd.Series(time).diff().dt.total_seconds()
+    median = interval.median() if interval.notna().any() else 60
+    return interval.clip(upper=MAX_SAMPLE_INTERVAL).fillna(median).to_numpy() / 3600
+
+# Returns the metrics of one day. time is the datetime of each sample; all samples are within the daytime window.
+# sample_time is the datetime of the measured samples of the whole day, from which the coverage is computed, by
+# default time.
+def compute_day_metrics(time, measured, computed, irradiance, sample_time=None):
+    metrics = dict.fromkeys(METRICS_COLUMNS, float('nan'))
+    metrics[SAMPLES] = len(time)
+    if len(time) == 0:
+        metrics[COVERAGE] = 0.0
+        return metrics
+    measured = np.asarray(measured, dtype=float)
+    computed = np.asarray(computed, dtype=float)
+    hours = get_sample_hours(time)
+    sample_time = pd.DatetimeIndex(time if sample_time is None else sample_time)
+    # Unique, as some days have duplicated rows.
+    seconds = np.unique(sample_time.to_numpy(dtype='datetime64[s]').astype(np.int64))
+    interval = max(1, round(np.median(np.diff(seconds)))) if len(seconds) > 1 else 60
+    metrics[COVERAGE] = daytime_coverage(seconds, pd.DatetimeIndex(time)[0].strftime('%Y-%m-%d'), interval)
+    valid = ~(np.isnan(measured) | np.isnan(computed))
+    if valid.any():
+        error = computed[valid] - measured[valid]
+        metrics[MEASURED_ENERGY] = float(np.sum(measured[valid] * hours[valid]))
+        metrics[COMPUTED_ENERGY] = float(np.sum(computed[valid] * hours[valid]))
+        metrics[POWER_MEAN] = float(np.mean(measured[valid]))
+        metrics[MAE] = float(np.mean(np.abs(error)))
+        metrics[RMSE] = float(np.sqrt(np.mean(error * error)))
+        ss_tot = np.sum((measured[valid] - measured[valid].mean()) ** 2)
+        if ss_tot > 0:
+            metrics[R2] = float(1 - np.sum(error * error) / ss_tot)
+        if metrics[COMPUTED_ENERGY] > 0:
+            metrics[PERFORMANCE_RATIO] = metrics[MEASURED_ENERGY] / metrics[COMPUTED_ENERGY]
+    if np.any(~np.isnan(np.asarray(irradiance, dtype=float))):
+        metrics[PEAK_IRRADIANCE] = float(np.nanmax(np.asarray(irradiance, dtype=float)))
+    return metrics
+
+# Returns the metrics of the processed data file of date in data_dir.
+def read_day_metrics(date, data_dir=DATA_FILE_RELATIVE_DIR):
+    # Days processed with --grid also have the sample flag.
+    columns = METRICS_INPUT_COLUMNS + [SAMPLE_FLAG]
+    if data_dir == DATA_FILE_RELATIVE_DIR:
+        df = load_day(date, True, [c for c in load_day_columns(date, True) if c in columns])
+    else:
+        df = pd.read_csv(data_dir + date + '_processed.csv', usecols=lambda c: c in columns)
+    df = df[df[TIME].notna()]
+    sampled = df[df[SAMPLE_FLAG] == MEASURED] if SAMPLE_FLAG in df else df
+    sample_time = pd.to_datetime(sampled[TIME], format=TIME_FORMAT)
+    df = filter_daytime(df)
+    time = pd.to_datetime(df[TIME], format=TIME_FORMAT)
+    return compute_day_metrics(time, df[POWER_SMOOTHED], df[COMPUTED_POWER], df[IRRADIANCE_SMOOTHED], sample_time)
+
+# The daily metrics table, keyed by date. A row is recomputed when the mtime or size of the day's
+# _processed.csv differs from the one it was computed from. The processed files are in data_dir, e.g. the data
+# directory of an array of a fleet, see fleet.py.
+class DailyMetricsTable:
+    def __init__(self, fname=DAILY_METRICS_FILE, data_dir=DATA_FILE_RELATIVE_DIR):
+        self.fname = fname
+        self.data_dir = data_dir
+        self.rows = {}
+        self.changed = False
+        if os.path.exists(fname):
+            df = pd.read_csv(fname, dtype={DATE: str})
+            self.rows = {row[DATE]: row for row in df.to_dict('records')}
+
+    # Returns the metrics row of date, recomputing it if it is missing or stale. Returns None if the day has
+    # no processed data file.
+    def get(self, date):
+        path = self.data_dir + date + '_processed.csv'
+        if not os.path.exists(path):
+            if self.rows.pop(date, None) is not None:
+                self.changed = True
+            return None
+        stat = os.stat(path)
+        row = self.rows.get(date)
+        if (row is None or row['mtime_ns'] != stat.st_mtime_ns or row['size'] != stat.st_size
+                or row.get(VERSION) != METRICS_VERSION):
+            row = {DATE: date, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, VERSION: METRICS_VERSION}
+            row.update(read_day_metrics(date, self.data_dir))
+            self.rows[date] = row
+            self.changed = True
+        return row
+
+    def update(self, dates):
+        for date in dates:
+            self.get(date)
+
+    # Returns the metrics of the processed days within [start_date, end_date] as a DataFrame indexed by date.
+    # Either bound may be None.
+    def query(self, start_date=None, end_date=None):
+        dates = list_processed_dates(start_date, end_date, self.data_dir)
+        rows = [row for row in (self.get(date) for date in dates) if row is not None]
+        return pd.DataFrame(rows, columns=TABLE_COLUMNS).set_index(DATE)[METRICS_COLUMNS]
+
+    def save(self):
+        if self.changed:
+            os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+            df = pd.DataFrame([self.rows[date] for date in sorted(self.rows)], columns=TABLE_COLUMNS)
+            df.to_csv(self.fname + '.tmp', index=False)
+            os.replace(self.fname + '.tmp', self.fname)
+            self.changed = False
+
+# Updates the rows of dates in the metrics table.
+def update_daily_metrics(dates, fname=DAILY_METRICS_FILE, data_dir=DATA_FILE_RELATIVE_DIR):
+    table = DailyMetricsTable(fname, data_dir)
+    table.update(dates)
+    table.save()
+
+# Returns the metrics of the processed days within [start_date, end_date], updating stale rows.
+def query_daily_metrics(start_date=None, end_date=None):
+    table = DailyMetricsTable()
+    df = table.query(start_date, end_date)
+    table.save()
+    return df
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--start", help="First date, e.g. 2022-09-01")
+    parser.add_argument("-e", "--end", help="Last date, e.g. 2022-09-30")
+    parser.add_argument("--rebuild", action='store_true', help="If present, recompute all rows of the table")
+    args = parser.parse_args()
+
+    if args.rebuild and os.path.exists(DAILY_METRICS_FILE):
+        os.remove(DAILY_METRICS_FILE)
+    df = query_daily_metrics(args.start, args.end)
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(df.round(3).to_string())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Lightweight index of the csv data files, used by query.py to find the rows of a time range without parsing
+whole files.
+
+For each data file the index records the row count, the first and last time, and whether the times are in
+ascending order. It is kept in ./cache/data_index.json. An entry is validated against the size and mtime of
+its file when it is queried: when a file has grown and its header and last indexed row are unchanged, it was
+appended to, e.g. by the collector, and only the appended bytes are scanned. A file that changed in any other
+way, e.g. a processed file written again with other columns, is scanned again. An empty file, which the
+collector may have just created, has no entry.
+
+Within a file whose times are in ascending order, find_offset binary searches the bytes of the file for a row
+boundary by time. This module only uses the standard library, so that the collector doesn't import pandas.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+from constants import *
+
+DATA_INDEX_FILE = CACHE_DIR + 'data_index.json'
+# Byte ranges shorter than this are not split further by the binary search.
+MIN_SEARCH_BYTES = 8192
+
+# Returns the time field of a data row, or '' if it is empty.
+def row_time(line, time_column):
+    fields = line.split(b',')
+    if len(fields) <= time_column:
+        return ''
+    return fields[time_column].strip(b'\r\n"').decode('utf-8')
+
+# Scans the rows in data[start:] and updates the row count, first/last time and ascending order of entry, and
+# the byte offsets of the last row and the end of the scanned rows. data starts at byte offset of the file.
+def scan_rows(entry, data, start, offset=0):
+    time_column = entry['time_column']
+    pos = start
+    while pos < len(data):
+        end = data.find(b'\n', pos)
+        if end < 0:
+            break # an incomplete last row is scanned when it is complete
+        time = row_time(data[pos:end], time_column)
+        entry['last_row'] = offset + pos
+        pos = end + 1
+        entry['rows'] += 1
+        if not time:
+            continue
+        if entry['first'] is None:
+            entry['first'] = time
+        elif time < entry['last']:
+            entry['ascending'] = False
+        entry['last'] = time if entry['last'] is None else max(entry['last'], time)
+    entry['scanned'] = offset + pos
+
+# Returns a hash of the header and the last indexed row of a file, which appending rows leaves unchanged.
+def prefix_hash(header, last_row):
+    return hashlib.sha256(header + last_row).hexdigest()
+
+# Returns a new index entry for the file at path, scanning all of it.
+def build_entry(path, data):
+    header_end = data.find(b'\n') + 1
+    header = data[:header_end].strip(b'\r\n').decode('utf-8').split(',')
+    if header_end == 0 or TIME not in header:
+        raise Exception(f"{path} has no {TIME} column")
+    entry = {'header_bytes': header_end, 'time_column': header.index(TIME), 'rows': 0, 'first': None,
+             'last': None, 'ascending': True, 'last_row': header_end}
+    scan_rows(entry, data, header_end)
+    entry['prefix_hash'] = prefix_hash(data[:header_end], data[entry['last_row']:entry['scanned']])
+    return entry
+
+# Returns the header of a file and the bytes appended after the rows of entry, or None instead of the appended
+# bytes if the header or the last indexed row changed, i.e. the file was not only appended to.
+def read_appended(file, entry):
+    header = file.read(entry['header_bytes'])
+    file.seek(entry['last_row'])
+    last_row = file.read(entry['scanned'] - entry['last_row'])
+    if prefix_hash(header, last_row) != entry.get('prefix_hash'):
+        return header, None
+    return header, file.read()
+
+class DataIndex:
+    def __init__(self, fname=DATA_INDEX_FILE):
+        self.fname = fname
+        self.entries = {}
+        self.changed = False
+        if os.path.exists(fname):
+            with open(fname, 'r') as file:
+                self.entries = json.load(file)
+
+    # Returns the index entry of a data file, e.g. 2022-09-14.csv, updating it if the file changed. Returns None
+    # if the file doesn't exist.
+    def get(self, filename):
+        path = DATA_FILE_RELATIVE_DIR + filename
+        if not os.path.exists(path):
+            if self.entries.pop(filename, None) is not None:
+                self.changed = True
+            return None
+        stat = os.stat(path)
+        if stat.st_size == 0:
+            # A file just created, e.g. by the collector, has no header yet and is indexed once it has one.
+            if self.entries.pop(filename, None) is not None:
+                self.changed = True
+            return None
+        entry = self.entries.get(filename)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry
+        appended = None
+        if entry is not None and stat.st_size > entry['size']:
+            with open(path, 'rb') as file:
+                header, appended = read_appended(file, entry)
+        if appended is not None:
+            # Only scan the appended rows.
+            offset = entry['scanned']
+            scan_rows(entry, appended, 0, offset)
+            if entry['last_row'] >= offset:
+                entry['prefix_hash'] = prefix_hash(header, appended[entry['last_row'] - offset:entry['scanned'] - offset])
+        else:
+            with open(path, 'rb') as file:
+                entry = build_entry(path, file.read())
+        entry['size'] = stat.st_size
+        entry['mtime_ns'] = stat.st_mtime_ns
+        self.entries[filename] = entry
+        self.changed = True
+        return entry
+
+    def save(self):
+        if self.changed:
+            os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+            with open(self.fname + '.tmp', 'w') as file:
+                json.dump(self.entries, file, indent=1, sort_keys=True)
+            os.replace(self.fname + '.tmp', self.fname)
+            self.changed = False
+
+# Returns the time of the first row with a time at or after the row starting at pos, or None if there is none
+# before end.
+def next_row_time(data, pos, end, time_column):
+    while pos < end:
+        line_end = data.find(b'\n', pos, end)
+        if line_end < 0:
+            return None
+        time = row_time(data[pos:line_end], time_column)
+        if time:
+            return time
+        pos = line_end + 1
+    return None
+
+# Binary searches the rows of a file with ascending times for the boundary where before(time) stops being
+# true. Returns (lo, hi), byte offsets of row starts such that the rows before lo all satisfy before(time) and
+# the rows from hi on don't. Rows without a time can fall on either side.
+def find_offset(data, entry, before):
+    lo = entry['header_bytes']
+    hi = entry['scanned']
+    while hi - lo > MIN_SEARCH_BYTES:
+        mid = data.find(b'\n', (lo + hi) // 2, hi) + 1
+        if mid <= lo or mid >= hi:
+            break
+        time = next_row_time(data, mid, hi, entry['time_column'])
+        if time is not None and before(time):
+            lo = mid
+        else:
+            hi = mid
+    return lo, hi
+
+# Returns the bytes of the file's rows that may have a time within [start, end), and the header row. start and
+# end are strings in TIME_FORMAT. If the times in the file are not ascending, all rows are returned. Returns
+# empty bytes if the file was emptied since entry was updated, as an empty file can't be mapped.
+def read_rows_between(filename, entry, start, end):
+    with open(DATA_FILE_RELATIVE_DIR + filename, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b'', b''
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            header = data[:entry['header_bytes']]
+            if not entry['ascending']:
+                return header, data[entry['header_bytes']:entry['scanned']]
+            lo = entry['header_bytes'] if start <= entry['first'] else find_offset(data, entry, lambda t: t < start)[0]
+            hi = entry['scanned'] if end > entry['last'] else find_offset(data, entry, lambda t: t < end)[1]
+            return header, data[lo:max(lo, hi)]
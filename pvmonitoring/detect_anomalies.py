@@ -0,0 +1,177 @@
+"""
+Detects soiling and shading from the residual between measured power (power smoothed) and computed power.
+
+The computed power is the calibrated baseline of a clean, unshaded panel, so the ratio of measured to
+computed power stays close to 1 unless something blocks the light. All days of a date range are loaded at
+once and analysed in one vectorized pass:
+    - Shading is localized in time of day: it causes a deep power deficit while the sun is behind the
+      obstacle. Shading events are runs of at least SHADING_MIN_MINUTES where the rolling median of the
+      ratio is below SHADING_RATIO.
+    - Soiling causes a moderate deficit spread over the whole day, which persists for days. The daily
+      performance ratio of the samples outside shading events is trended with a rolling median over
+      SOILING_TREND_DAYS days, and consecutive days where it is below SOILING_RATIO form a soiling event.
+Only samples between DAY_START_TIME and DAY_END_TIME with a computed power of at least
+MIN_COMPUTED_POWER_FRACTION of pdc0 are used, the ratio is meaningless at low light.
+
+The output is an events table with one row per event.
+
+Example usage: 'python detect_anomalies.py -s 2022-08-30 -e 2022-11-14' prints the events of the range.
+               'python detect_anomalies.py -k' also scores the detected events against the labelled days in
+                   config/anomaly_labels.json.
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+from constants import *
+from site_config import Config
+from calibrate import get_labelled_dates, list_processed_dates
+from storage import load_day
+
+SOILING = 'soiling'
+SHADING = 'shading'
+ANOMALY_KINDS = [SOILING, SHADING]
+
+MIN_COMPUTED_POWER_FRACTION = 0.1
+RATIO_MEDIAN_WINDOW = 15            # samples
+SHADING_RATIO = 0.8
+SHADING_MIN_MINUTES = 20
+SOILING_RATIO = 0.95
+SOILING_TREND_DAYS = 3
+MIN_SAMPLES_PER_DAY = 60
+# Longest gap between samples that is counted as sampled time, in seconds.
+MAX_SAMPLE_INTERVAL = 300
+
+DATE = 'date'
+RATIO = 'ratio'
+RATIO_MEDIAN = 'ratio median'
+INTERVAL = 'interval'
+
+EVENT_COLUMNS = ['kind', 'start', 'end', 'duration (min)', 'mean ratio', 'energy lost (Wh)']
+
+# Loads the processed data of the given dates into one DataFrame with a datetime TIME column.
+def load_processed_days(dates, columns=[TIME, POWER_SMOOTHED, COMPUTED_POWER]):
+    frames = [load_day(date, True, columns) for date in dates]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(frames, ignore_index=True)
+    df[TIME] = pd.to_datetime(df[TIME], format=TIME_FORMAT)
+    return df
+
+# Returns the daytime samples that are bright enough to compare measured with computed power, with the columns
+# DATE, RATIO, RATIO_MEDIAN (rolling median of the ratio within each day) and INTERVAL (seconds covered by
+# each sample).
+def prepare_samples(df, pdc0):
+    df = df.sort_values(TIME, ignore_index=True)
+    df[DATE] = df[TIME].dt.strftime('%Y-%m-%d')
+    time_of_day = df[TIME].dt.strftime('%H:%M:%S')
+    df = df[(time_of_day >= DAY_START_TIME) & (time_of_day <= DAY_END_TIME)
+            & (df[COMPUTED_POWER] >= MIN_COMPUTED_POWER_FRACTION * pdc0) & df[POWER_SMOOTHED].notna()]
+    df = df.reset_index(drop=True)
+    df[RATIO] = df[POWER_SMOOTHED] / df[COMPUTED_POWER]
+    df[RATIO_MEDIAN] = df.groupby(DATE)[RATIO].transform(
+        lambda ratio: ratio.rolling(RATIO_MEDIAN_WINDOW, min_periods=1, center=True).median())
+    interval = df[TIME].diff().dt.total_seconds()
+    interval[df[DATE] != df[DATE].shift()] = np.nan
+    df[INTERVAL] = interval.clip(upper=MAX_SAMPLE_INTERVAL).fillna(interval.median() if interval.notna().any() else 60)
+    return df
+
+# Returns the shading events, and a boolean mask of the samples within them.
+def find_shading(df):
+    deficit = df[RATIO_MEDIAN] < SHADING_RATIO
+    run_id = ((deficit != deficit.shift()) | (df[DATE] != df[DATE].shift())).cumsum()
+    runs = df[deficit].assign(run=run_id[deficit], lost=(df[COMPUTED_POWER] - df[POWER_SMOOTHED]) * df[INTERVAL] / 3600)
+    runs = runs.groupby('run').agg(start=(TIME, 'first'), end=(TIME, 'last'), seconds=(INTERVAL, 'sum'),
+                                   ratio=(RATIO, 'mean'), lost=('lost', 'sum'))
+    runs = runs[runs['seconds'] >= SHADING_MIN_MINUTES * 60]
+    in_event = run_id.isin(runs.index) & deficit
+    events = pd.DataFrame({'kind': SHADING, 'start': runs['start'], 'end': runs['end'],
+                           'duration (min)': (runs['seconds'] / 60).round(), 'mean ratio': runs['ratio'].round(3),
+                           'energy lost (Wh)': runs['lost'].round(1)})
+    return events.reset_index(drop=True), in_event
+
+# Returns the daily performance ratio of the samples outside shading events, and its trend.
+def get_daily_performance(df, shaded):
+    unshaded = df[~shaded]
+    daily = unshaded.groupby(DATE).agg(measured=(POWER_SMOOTHED, 'sum'), computed=(COMPUTED_POWER, 'sum'),
+                                       samples=(RATIO, 'size'), start=(TIME, 'first'), end=(TIME, 'last'))
+    daily = daily[daily['samples'] >= MIN_SAMPLES_PER_DAY]
+    daily['performance ratio'] = daily['measured'] / daily['computed']
+    daily['trend'] = daily['performance ratio'].rolling(SOILING_TREND_DAYS, min_periods=1, center=True).median()
+    return daily
+
+# Returns the soiling events: runs of consecutive days with data whose performance ratio trend is low.
+def find_soiling(daily, df):
+    soiled = (daily['trend'] < SOILING_RATIO) & (daily['performance ratio'] < SOILING_RATIO)
+    run_id = (soiled != soiled.shift()).cumsum()
+    days = daily[soiled].assign(run=run_id[soiled])
+    day_lost = (df[COMPUTED_POWER] - df[POWER_SMOOTHED]) * df[INTERVAL] / 3600
+    days['lost'] = day_lost.groupby(df[DATE]).sum().reindex(days.index)
+    days['minutes'] = df.groupby(DATE)[INTERVAL].sum().reindex(days.index) / 60
+    runs = days.groupby('run').agg(start=('start', 'first'), end=('end', 'last'), minutes=('minutes', 'sum'),
+                                   ratio=('performance ratio', 'mean'), lost=('lost', 'sum'))
+    events = pd.DataFrame({'kind': SOILING, 'start': runs['start'], 'end': runs['end'],
+                           'duration (min)': runs['minutes'].round(), 'mean ratio': runs['ratio'].round(3),
+                           'energy lost (Wh)': runs['lost'].round(1)})
+    return events.reset_index(drop=True)
+
+# Returns the events table for the processed data in df.
+def detect_anomalies(df, pdc0):
+    samples = prepare_samples(df, pdc0)
+    if samples.empty:
+        return pd.DataFrame(columns=EVENT_COLUMNS)
+    shading_events, shaded = find_shading(samples)
+    soiling_events = find_soiling(get_daily_performance(samples, shaded), samples)
+    events = pd.concat([soiling_events, shading_events], ignore_index=True)
+    return events.sort_values(['start', 'kind'], ignore_index=True)[EVENT_COLUMNS]
+
+# Returns the dates covered by the events of kind.
+def get_event_dates(events, kind):
+    dates = set()
+    for _, event in events[events['kind'] == kind].iterrows():
+        dates.update(d.strftime('%Y-%m-%d') for d in pd.date_range(event['start'].normalize(), event['end'].normalize()))
+    return dates
+
+# Scores the events against the labelled dates, day by day, for each kind of anomaly and for any anomaly.
+# Returns a DataFrame with the true/false positives/negatives, precision, recall and F1 of each.
+def evaluate(events, dates):
+    dates = set(dates)
+    scores = {}
+    predicted_any, labelled_any = set(), set()
+    for kind in ANOMALY_KINDS + ['any']:
+        if kind == 'any':
+            predicted, labelled = predicted_any, labelled_any
+        else:
+            predicted = get_event_dates(events, kind) & dates
+            labelled = get_labelled_dates([kind]) & dates
+            predicted_any |= predicted
+            labelled_any |= labelled
+        tp = len(predicted & labelled)
+        fp = len(predicted - labelled)
+        fn = len(labelled - predicted)
+        precision = tp / (tp + fp) if tp + fp else float('nan')
+        recall = tp / (tp + fn) if tp + fn else float('nan')
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else float('nan')
+        scores[kind] = {'tp': tp, 'fp': fp, 'fn': fn, 'precision': round(precision, 3),
+                        'recall': round(recall, 3), 'f1': round(f1, 3)}
+    return pd.DataFrame(scores).T
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--start", help="First date to scan, e.g. 2022-08-30. Defaults to the first processed day.")
+    parser.add_argument("-e", "--end", help="Last date to scan, e.g. 2022-11-14. Defaults to the last processed day.")
+    parser.add_argument("-o", "--output", help="If present, write the events table to this csv file")
+    parser.add_argument("-k", "--evaluate", action='store_true', help="If present, score the events against config/anomaly_labels.json")
+    args = parser.parse_args()
+
+    dates = list_processed_dates(args.start, args.end)
+    events = detect_anomalies(load_processed_days(dates), Config().pvsystem['pdc0'])
+    print(events.to_string(index=False))
+    if args.output:
+        events.to_csv(args.output, index=False)
+    if args.evaluate:
+        print()
+        print(evaluate(events, dates).to_string())
+
+if __name__ == "__main__":
+    main()
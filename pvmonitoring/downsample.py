@@ -0,0 +1,55 @@
+"""
+Downsampling of series for display with the Largest Triangle Three Buckets algorithm (Sveinn Steinarsson,
+"Downsampling Time Series for Visual Representation", 2013), used by plot.py and serve.py. It keeps the peaks
+and dips that a plain decimation would drop.
+
+This module doesn't import matplotlib, so that serve.py can use it without loading the plotting libraries.
+
+Example usage: 'x, y = downsample(df, POWER_SMOOTHED, 500)' with df indexed by time.
+"""
+
+import numpy as np
+from resample import find_runs
+
+MAX_PLOT_POINTS = 1000
+
+# Returns the indices of the n_out points of (x, y) selected by the Largest Triangle Three Buckets algorithm.
+# The first and last points are always kept; of each bucket in between, the point that forms the largest
+# triangle with the point selected in the previous bucket and the mean of the next bucket is kept.
+def lttb(x, y, n_out):
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.floor(np.linspace(1, n - 1, n_out - 1)).astype(int)
+    selected = np.empty(n_out, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+        prev_x, prev_y = x[selected[i]], y[selected[i]]
+        areas = np.abs((prev_x - next_x) * (y[start:end] - prev_y) - (prev_x - x[start:end]) * (next_y - prev_y))
+        selected[i + 1] = start + np.argmax(areas)
+    return selected
+
+# Returns the x and y values to plot for column of df, with about max_points points. Each run of values
+# between NaN, e.g. a day of a range, is downsampled separately with a share of the points by its length, and
+# the NaN after it is kept, so that the lines are not joined across the gaps.
+def downsample(df, column, max_points=MAX_PLOT_POINTS):
+    y = df[column]
+    if len(y) <= max_points:
+        return df.index, y
+    values = y.to_numpy(float)
+    x = df.index.asi8.astype(float)
+    starts, ends = find_runs(~np.isnan(values))
+    valid = (ends - starts).sum()
+    selected = []
+    for start, end in zip(starts, ends):
+        n_out = max(3, round(max_points * (end - start) / valid))
+        selected.append(start + lttb(x[start:end], values[start:end], n_out))
+        if end < len(values):
+            selected.append([end])
+    selected = np.concatenate(selected) if selected else np.array([], dtype=int)
+    return df.index[selected], y.iloc[selected]
@@ -0,0 +1,265 @@
+"""
+Processes the data of a fleet of PV arrays at one or more sites, like compute_power.py does for one array.
+
+The arrays are listed in config.json, each with its own geometry, pdc0, gamma_pdc and, optionally, power
+coefficient (defaults to its coefficient in config/calibration.json, see calibrate.read_calibrated_coefficient),
+and the site it is at:
+
+    "sites": {
+        "cupertino": {"latitude": 37.322998, "longitude": -122.032181, "altitude": 100, "timezone": "US/Pacific"}
+    },
+    "arrays": [
+        {"name": "roof-south", "site": "cupertino", "surface_tilt": 20, "surface_azimuth": 180, "pdc0": 30,
+         "gamma_pdc": -0.0023, "power_coefficient": 0.9},
+        ...
+    ]
+
+The day files of an array are in a subdirectory of ./data/ named after the array, e.g.
+./data/roof-south/2022-09-14.csv, with the columns of the collector's day files, and its processed files are
+written next to them, with the processed manifest of compute_power.py. The daily metrics of an array are kept
+in ./cache/<array name>/daily_metrics.csv. A config without "arrays" is a fleet of one array, named after its
+directory ./data/, with the location and pvsystem of the config. Its days are processed by
+compute_power.process_batch, exactly as by 'compute_power.py -b'.
+
+The other scripts work on one array with PVMON_ARRAY=<array name>, or 'pvmon.py --array <array name>', which
+sets their data, cache and store directories to the array's subdirectories and site_config.Config to the
+array, e.g. to collect an array's data, or to calibrate its power coefficient, which calibrate.py then writes
+to config/calibration.json under "arrays". Without it, they use the first array of the config.
+
+The arrays of a site are processed together, one day at a time. The arrays whose day files have the same
+timestamps share one solar position lookup, from the cache of solar_position_cache.py, and their AOI, IAM and
+pvwatts power are computed as one NumPy operation on (arrays x samples) matrices, so the cost of the solar
+geometry and power models barely grows with the number of arrays. The days of each site are sharded across
+worker processes. A day is processed again if compute_power.rebuild_reason gives a reason for any of its
+arrays: a missing processed file, a raw file that changed, or a changed site, array or power coefficient.
+
+Example usage: 'python fleet.py -s 2022-09-01 -e 2022-09-30' processes the days of September 2022 of all arrays.
+               'python fleet.py --site cupertino --force' reprocesses all days of the arrays at one site.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pvlib
+import instrumentation
+import solar_position_cache
+from calibrate import read_calibrated_coefficient
+from compute_power import PROCESSED_MANIFEST_FILE, list_raw_filenames, load_manifest, manifest_entry, process_batch, rebuild_reason, save_manifest
+from constants import *
+from daily_metrics import DAILY_METRICS_FILE, update_daily_metrics
+from preprocess_data import preprocess_data
+from site_config import Config, DEFAULT_TIMEZONE
+
+# Site geometry of the solar position lookup. Solar position doesn't depend on the panel orientation, so the
+# arrays of a site share the cached table of a horizontal panel.
+HORIZONTAL = {'surface_tilt': 0, 'surface_azimuth': 180}
+ARRAY_FIELDS = ['name', 'site', 'surface_tilt', 'surface_azimuth', 'pdc0', 'gamma_pdc']
+
+# Returns (sites, arrays) from config.json: sites by name, and the list of arrays. Each array gets its data
+# directory, power coefficient (see calibrate.read_calibrated_coefficient), config hash, processed manifest and
+# daily metrics file.
+def read_fleet_config():
+    if ARRAY:
+        raise Exception(f"fleet.py processes all arrays, unset {ARRAY_VARIABLE}")
+    with open(CONFIG_FILE, 'r') as file:
+        config = json.load(file)
+    if 'arrays' not in config:
+        # The single array of the config, with the day files in ./data/.
+        name = os.path.basename(os.path.normpath(DATA_FILE_RELATIVE_DIR))
+        sites = {name: config['location']}
+        arrays = [dict(config['pvsystem'], name=name, site=name, data_dir=DATA_FILE_RELATIVE_DIR,
+                       power_coefficient=read_calibrated_coefficient(array=None))]
+        return sites, arrays
+    sites = config['sites']
+    arrays = [dict(array) for array in config['arrays']]
+    for array in arrays:
+        missing = [field for field in ARRAY_FIELDS if field not in array]
+        if missing:
+            raise Exception(f"Array {array.get('name')} has no {', '.join(missing)} in {CONFIG_FILE}")
+        if array['site'] not in sites:
+            raise Exception(f"Array {array['name']} is at unknown site {array['site']}")
+        array['data_dir'] = array_dir(BASE_DATA_DIR, array['name'])
+        array['power_coefficient'] = read_calibrated_coefficient(array=array['name'])
+        array['config_hash'] = Config(array['name']).hash()
+        array['manifest_file'] = array['data_dir'] + os.path.basename(PROCESSED_MANIFEST_FILE)
+        array['metrics_file'] = array_dir(BASE_CACHE_DIR, array['name']) + os.path.basename(DAILY_METRICS_FILE)
+    return sites, arrays
+
+# Returns the dates of the raw data files of the arrays within [start_date, end_date]. Either bound may be None.
+def list_array_dates(arrays, start_date=None, end_date=None):
+    dates = set()
+    for array in arrays:
+        for path in glob.glob(array['data_dir'] + '*.csv'):
+            date = os.path.basename(path)[:-4]
+            if date.endswith('_processed') or (start_date and date < start_date) or (end_date and date > end_date):
+                continue
+            dates.add(date)
+    return sorted(dates)
+
+# Returns whether any array with a raw data file of date needs to be (re)processed, by the rules of
+# compute_power.rebuild_reason. manifests are the processed manifests of the arrays by name.
+def needs_processing(arrays, date, manifests):
+    for array in arrays:
+        if not os.path.exists(array['data_dir'] + date + '.csv'):
+            continue
+        if rebuild_reason(date + '.csv', manifests[array['name']], array['config_hash'], array['power_coefficient'],
+                          data_dir=array['data_dir']):
+            return True
+    return False
+
+# Returns a key that is the same for day files with the same timestamps.
+def timestamp_grid_key(time):
+    return hashlib.sha256(pd.util.hash_pandas_object(time, index=False).to_numpy().tobytes()).hexdigest()
+
+# Returns the apparent zenith and azimuth of the sun at the timestamps of a site.
+def get_solar_position(time, site):
+    with instrumentation.timer('solar position'):
+        dti = pd.DatetimeIndex(pd.to_datetime(time, format=TIME_FORMAT), tz=site.get('timezone', DEFAULT_TIMEZONE))
+        geometry = solar_position_cache.lookup(dti, site, HORIZONTAL)
+        if geometry is None:
+            geometry = solar_position_cache.compute_solar_geometry(dti, site, HORIZONTAL)
+    return (geometry[solar_position_cache.APPARENT_ZENITH].to_numpy(),
+            geometry[solar_position_cache.AZIMUTH].to_numpy())
+
+# Returns the IAM and the pvwatts power of arrays with the same timestamps. irradiance and temp_cell are
+# (arrays x samples) matrices; each array parameter is a column vector so that the models broadcast over them.
+def compute_arrays_power(zenith, azimuth, irradiance, temp_cell, arrays):
+    def parameter(field):
+        return np.array([array[field] for array in arrays], dtype=float)[:, np.newaxis]
+    with instrumentation.timer('pvwatts'):
+        aoi = pvlib.irradiance.aoi(parameter('surface_tilt'), parameter('surface_azimuth'), zenith, azimuth)
+        iam = solar_position_cache.iam_model(aoi)
+        pvwatts_dc = pvlib.pvsystem.pvwatts_dc(iam * irradiance, temp_cell, parameter('pdc0'),
+                                               gamma_pdc=parameter('gamma_pdc'))
+    return iam, pvwatts_dc
+
+# Processes the day files of date of the arrays of a site. Returns the names of the arrays processed.
+def process_site_day(site, arrays, date):
+    frames = {}
+    groups = {}
+    for array in arrays:
+        fname = array['data_dir'] + date + '.csv'
+        if not os.path.exists(fname):
+            continue
+        with instrumentation.timer('csv load'):
+            df = pd.read_csv(fname)
+        frames[array['name']] = preprocess_data(df)
+        groups.setdefault(timestamp_grid_key(df[TIME]), []).append(array)
+
+    for group in groups.values():
+        group_frames = [frames[array['name']] for array in group]
+        zenith, azimuth = get_solar_position(group_frames[0][TIME], site)
+        irradiance = np.vstack([df[IRRADIANCE_SMOOTHED].to_numpy(dtype=float) for df in group_frames])
+        temp_cell = np.vstack([df[TEMPERATURE_SMOOTHED].to_numpy(dtype=float) for df in group_frames])
+        iam, pvwatts_dc = compute_arrays_power(zenith, azimuth, irradiance, temp_cell, group)
+        for i, (array, df) in enumerate(zip(group, group_frames)):
+            df[IAM_FACTOR] = iam[i]
+            df[PVWATTS_POWER] = np.round(pvwatts_dc[i], 2)
+            df[COMPUTED_POWER] = np.round(pvwatts_dc[i] * array['power_coefficient'], 2)
+            with instrumentation.timer('csv write'):
+                df.to_csv(array['data_dir'] + date + '_processed.csv', index=False)
+            instrumentation.count('rows processed', len(df), array=array['name'])
+    return list(frames)
+
+# Runs process_site_day in a worker process and returns the arrays processed and the instrumentation
+# recorded there.
+def process_site_day_in_worker(site, arrays, date):
+    return process_site_day(site, arrays, date), instrumentation.snapshot()
+
+# Returns whether arrays is the single array of a config without "arrays", whose day files are in the data
+# directory.
+def is_data_dir_array(arrays):
+    return len(arrays) == 1 and os.path.abspath(arrays[0]['data_dir']) == os.path.abspath(DATA_FILE_RELATIVE_DIR)
+
+# Records the days processed of each array in its manifest, and updates its daily metrics.
+def record_processed_days(arrays, manifests, processed_dates):
+    for array in arrays:
+        dates = processed_dates.get(array['name'])
+        if not dates:
+            continue
+        manifest = manifests[array['name']]
+        for date in dates:
+            manifest[date + '.csv'] = manifest_entry(array['config_hash'], array['power_coefficient'])
+        save_manifest(manifest, array['manifest_file'])
+        update_daily_metrics(dates, array['metrics_file'], array['data_dir'])
+
+# Processes the days within [start_date, end_date] of the arrays of the sites, or all sites, across a process
+# pool. Returns the failed (site, date) tasks.
+def process_fleet(sites, arrays, site_names=None, start_date=None, end_date=None, workers=None, force=False):
+    tasks = []
+    failures = {}
+    manifests = {array['name']: load_manifest(array['manifest_file']) for array in arrays if 'manifest_file' in array}
+    for site_name in site_names or sorted(sites):
+        site_arrays = [array for array in arrays if array['site'] == site_name]
+        if is_data_dir_array(site_arrays):
+            batch_failures = process_batch(list_raw_filenames(start_date, end_date),
+                                           site_arrays[0]['power_coefficient'], workers, force)
+            failures.update({(site_name, filename[:10]): e for filename, e in batch_failures.items()})
+            continue
+        for date in list_array_dates(site_arrays, start_date, end_date):
+            if force or needs_processing(site_arrays, date, manifests):
+                tasks.append((site_name, site_arrays, date))
+
+    # Build the solar position tables once here instead of in every worker.
+    years = {}
+    for site_name, _, date in tasks:
+        years.setdefault(site_name, set()).update([int(date[:4])] + ([int(date[:4]) + 1] if date[5:] == '12-31' else []))
+    for site_name, site_years in years.items():
+        for year in sorted(site_years):
+            solar_position_cache.load_table(sites[site_name], HORIZONTAL, year)
+
+    if not tasks:
+        return failures
+    processed = 0
+    processed_dates = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=instrumentation.enable,
+                             initargs=instrumentation.get_outputs()) as executor:
+        futures = {(site_name, date): executor.submit(process_site_day_in_worker, sites[site_name], site_arrays, date)
+                   for site_name, site_arrays, date in tasks}
+        for (site_name, date), future in futures.items():
+            try:
+                names, snapshot = future.result()
+                instrumentation.merge(snapshot)
+                processed += len(names)
+                for name in names:
+                    processed_dates.setdefault(name, []).append(date)
+                print(f'{site_name} {date}: {len(names)} arrays')
+            except Exception as e:
+                failures[(site_name, date)] = e
+                print(f'{site_name} {date}: FAILED: {e}')
+    record_processed_days(arrays, manifests, processed_dates)
+    failed = sum(1 for site_name, _, date in tasks if (site_name, date) in failures)
+    print(f'{len(tasks) - failed} site days processed ({processed} array days), {failed} failed')
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--start", help="First date to process, e.g. 2022-09-01")
+    parser.add_argument("-e", "--end", help="Last date to process, e.g. 2022-09-30")
+    parser.add_argument("--site", help="Comma separated sites to process, defaults to all sites")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of worker processes, defaults to the number of CPUs")
+    parser.add_argument("--force", action='store_true', help="Process all days even if they are up to date")
+    parser.add_argument("--metrics_file", help="Write stage timings and counters to this Prometheus textfile")
+    parser.add_argument("--trace_file", help="Write a JSON trace of the stages to this file")
+    args = parser.parse_args()
+
+    sites, arrays = read_fleet_config()
+    site_names = args.site.split(',') if args.site else None
+    for site_name in site_names or []:
+        if site_name not in sites:
+            raise Exception(f"Unknown site {site_name}")
+
+    instrumentation.enable(args.metrics_file, args.trace_file)
+    try:
+        if process_fleet(sites, arrays, site_names, args.start, args.end, args.jobs, args.force):
+            raise SystemExit(1)
+    finally:
+        instrumentation.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+"""
+Lightweight timers and counters for the collector and the processing pipeline.
+
+    with timer('csv load'):
+        df = pd.read_csv(fname)
+
+    @timed('smoothing')
+    def add_smoothed_data(df, window): ...
+
+    count('mppt dips fixed', int(dips.sum()))
+
+Instrumentation is disabled by default: timer() then returns a shared no-op context manager, timed functions
+are called directly and count() returns immediately, so the instrumented code costs about a function call
+more. enable() turns it on with one or both outputs:
+    - a Prometheus textfile collector file (https://github.com/prometheus/node_exporter#textfile-collector)
+      with the total seconds and count of each timer as pvmonitoring_stage_duration_seconds_sum/_count, and
+      each counter as pvmonitoring_<counter>_total
+    - a JSON trace in the Chrome trace event format, one event per timed call, which can be opened in
+      chrome://tracing or https://ui.perfetto.dev
+Both are written by flush(), the Prometheus file atomically, so that node_exporter never reads a partial file.
+flush() rewrites the whole trace, so a long running process calls it every so often rather than after every
+unit of work, see collect_sensor_data.run_daemon. Gauges set with set_gauge() are written to the Prometheus
+file with their last value.
+
+A process that runs briefly and often, like the collector started by cron every minute, enables with
+accumulate=True: flush() then adds the timers, counters and gauges recorded since the last flush to those of
+the previous runs, kept in a state file next to the Prometheus file (<file>.state.json, which node_exporter
+ignores), and the trace events to those of the trace file, so that the counters keep growing across runs, as
+Prometheus expects of counters, instead of restarting at every run. The state is read, added to and written
+while holding an exclusive lock on <file>.lock, so that runs that overlap don't lose each other's counts.
+The gauges of the previous runs are loaded by enable(), for get_gauge().
+
+Timers and counters take labels, e.g. timer('sensor read', sensor='vip'). Instrumentation is thread-safe.
+Worker processes return snapshot() to the parent, which adds it with merge().
+
+This module only uses the standard library, so that the collector can use it without importing pandas.
+"""
+
+import fcntl
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+METRIC_PREFIX = 'pvmonitoring_'
+# The trace keeps the most recent events, so that a long running collector doesn't grow it without bound.
+MAX_TRACE_EVENTS = 100000
+
+_enabled = False
+_prometheus_file = None
+_trace_file = None
+_accumulate = False
+_lock = threading.Lock()
+# {(name, labels): [count, total seconds]}
+_timers = {}
+# {(name, labels): value}
+_counters = {}
+# {(name, labels): value}
+_gauges = {}
+_trace_events = deque(maxlen=MAX_TRACE_EVENTS)
+# {(name, labels): value} of the gauges saved by the previous runs, with accumulate.
+_previous_gauges = {}
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class _Timer:
+    def __init__(self, name, labels):
+        self.key = (name, labels)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        record_time(self.key, self.start, end)
+        return False
+
+def enable(prometheus_file=None, trace_file=None, accumulate=False):
+    global _enabled, _prometheus_file, _trace_file, _accumulate
+    _prometheus_file = prometheus_file
+    _trace_file = trace_file
+    _enabled = bool(prometheus_file or trace_file)
+    _accumulate = accumulate and _enabled
+    _previous_gauges.clear()
+    if _accumulate:
+        _previous_gauges.update(read_state()['gauges'])
+
+def is_enabled():
+    return _enabled
+
+# Returns the arguments of enable() that were used, e.g. to enable instrumentation in worker processes.
+def get_outputs():
+    return (_prometheus_file, _trace_file)
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _gauges.clear()
+        _trace_events.clear()
+
+def labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+# Returns a context manager that times the code it wraps.
+def timer(name, **labels):
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name, labels_key(labels))
+
+# Decorator that times each call of a function.
+def timed(name, **labels):
+    key = (name, labels_key(labels))
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record_time(key, start, time.perf_counter())
+        return wrapper
+    return decorator
+
+def record_time(key, start, end):
+    with _lock:
+        entry = _timers.setdefault(key, [0, 0.0])
+        entry[0] += 1
+        entry[1] += end - start
+        if _trace_file:
+            # The trace uses the wall clock so that events of different processes line up.
+            wall_end = time.time()
+            _trace_events.append({'name': key[0], 'ph': 'X', 'ts': round((wall_end - (end - start)) * 1e6),
+                                  'dur': round((end - start) * 1e6), 'pid': os.getpid(),
+                                  'tid': threading.get_ident(), 'args': dict(key[1])})
+
+def count(name, value=1, **labels):
+    if not _enabled:
+        return
+    key = (name, labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def set_gauge(name, value, **labels):
+    if not _enabled:
+        return
+    with _lock:
+        _gauges[(name, labels_key(labels))] = value
+
+# Returns the value of a gauge, or with accumulate its value saved by the previous runs, or None if it is not set.
+def get_gauge(name, **labels):
+    key = (name, labels_key(labels))
+    with _lock:
+        return _gauges.get(key, _previous_gauges.get(key))
+
+# Returns the timers, counters and trace events recorded so far in a form that can be pickled, and resets them.
+def snapshot():
+    with _lock:
+        data = {'timers': list(_timers.items()), 'counters': list(_counters.items()), 'gauges': list(_gauges.items()),
+                'trace_events': list(_trace_events)}
+    reset()
+    return data
+
+# Adds a snapshot taken in another process.
+def merge(data):
+    if not _enabled:
+        return
+    with _lock:
+        for key, (calls, seconds) in data['timers']:
+            entry = _timers.setdefault((key[0], tuple(map(tuple, key[1]))), [0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+        for key, value in data['counters']:
+            key = (key[0], tuple(map(tuple, key[1])))
+            _counters[key] = _counters.get(key, 0) + value
+        for key, value in data.get('gauges', []):
+            _gauges[(key[0], tuple(map(tuple, key[1])))] = value
+        _trace_events.extend(data['trace_events'])
+
+def metric_name(name):
+    return METRIC_PREFIX + ''.join(c if c.isalnum() else '_' for c in name.lower())
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+# Returns the timers and counters in the Prometheus text exposition format.
+def prometheus_text():
+    lines = []
+    with _lock:
+        timers = sorted(_timers.items())
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+    stage_metric = METRIC_PREFIX + 'stage_duration_seconds'
+    if timers:
+        lines.append(f'# HELP {stage_metric} Time spent in each stage.')
+        lines.append(f'# TYPE {stage_metric} summary')
+    for (name, labels), (calls, seconds) in timers:
+        stage_labels = format_labels((('stage', name),) + labels)
+        lines.append(f'{stage_metric}_sum{stage_labels} {seconds:.6f}')
+        lines.append(f'{stage_metric}_count{stage_labels} {calls}')
+    typed = set()
+    for (name, labels), value in counters:
+        metric = metric_name(name) + '_total'
+        if metric not in typed:
+            lines.append(f'# TYPE {metric} counter')
+            typed.add(metric)
+        lines.append(f'{metric}{format_labels(labels)} {value}')
+    for (name, labels), value in gauges:
+        metric = metric_name(name)
+        if metric not in typed:
+            lines.append(f'# TYPE {metric} gauge')
+            typed.add(metric)
+        lines.append(f'{metric}{format_labels(labels)} {value}')
+    lines.append(f'# TYPE {METRIC_PREFIX}last_flush_timestamp_seconds gauge')
+    lines.append(f'{METRIC_PREFIX}last_flush_timestamp_seconds {time.time():.3f}')
+    return '\n'.join(lines) + '\n'
+
+def state_filename():
+    return _prometheus_file + '.state.json'
+
+def lock_filename():
+    return (_prometheus_file or _trace_file) + '.lock'
+
+# Returns the timers, counters and gauges saved by the previous flush() with accumulate, and the events of the
+# trace file, in the form of snapshot(). A missing or unreadable file is skipped, which restarts the counters
+# like a restarted process would.
+def read_state():
+    state = {'timers': [], 'counters': [], 'gauges': [], 'trace_events': []}
+    try:
+        if _prometheus_file and os.path.exists(state_filename()):
+            with open(state_filename(), 'r') as file:
+                state.update(json.load(file))
+        if _trace_file and os.path.exists(_trace_file):
+            with open(_trace_file, 'r') as file:
+                state['trace_events'] = json.load(file)['traceEvents']
+    except (OSError, ValueError, KeyError):
+        return {'timers': [], 'counters': [], 'gauges': [], 'trace_events': []}
+    state['gauges'] = [((key[0], tuple(map(tuple, key[1]))), value) for key, value in state['gauges']]
+    return state
+
+# Writes the Prometheus textfile and the JSON trace, if enabled, and with accumulate the state file.
+def flush():
+    if not _enabled:
+        return
+    if not _accumulate:
+        write_outputs()
+        return
+    fname = lock_filename()
+    directory = os.path.dirname(fname)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(fname, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # Add what was recorded since the last flush to the state saved by all the runs up to now, including
+        # runs that flushed after this one started.
+        recorded = snapshot()
+        merge(read_state())
+        merge(recorded)
+        write_outputs()
+        # The state file has it all now, the next flush only adds what is recorded after this one.
+        with _lock:
+            _previous_gauges.update(_gauges)
+        reset()
+
+def write_outputs():
+    if _prometheus_file:
+        if _accumulate:
+            with _lock:
+                state = {'timers': list(_timers.items()), 'counters': list(_counters.items()),
+                         'gauges': list(_gauges.items())}
+            write_atomically(state_filename(), json.dumps(state))
+        write_atomically(_prometheus_file, prometheus_text())
+    if _trace_file:
+        with _lock:
+            events = list(_trace_events)
+        write_atomically(_trace_file, json.dumps({'traceEvents': events}))
+
+def write_atomically(fname, text):
+    directory = os.path.dirname(fname)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(fname + '.tmp', 'w') as file:
+        file.write(text)
+    os.replace(fname + '.tmp', fname)
@@ -4,16 +4,42 @@ Utility to plot for a list of data files or a list of dates. It plots in 2 modes
         including irradiance, temperature, voltage, current, power, etc. The plots
         usually use time as the x-axis.
     - simple mode: plots one figure for all data files or dates. Only power is plotted.
+
+With -o, the figures are rendered without a display and saved to files in the output directory instead of
+being shown, one file per day in full mode. The days are rendered in parallel worker processes.
+
+With --range, plots an overview of measured vs. computed power for a date range: the mean power of every
+AGGREGATE_INTERVAL, and the daily energy. It is plotted from per-day aggregates, so a range of months
+doesn't plot every sample. With --range and -m, plots the daily MAE and mean power of the range from the
+daily metrics table (see daily_metrics.py), without reading the data files.
+
+Series with more than MAX_PLOT_POINTS points are downsampled for display with the Largest Triangle Three
+Buckets algorithm, which keeps the peaks and dips that a plain decimation would drop. Each run of values
+between gaps (NaN), e.g. each day of a range, is downsampled separately, so lines don't cross the nights.
+See downsample.py.
+The daytime data of each file and the per-day aggregates are cached under ./cache/plot/ and rebuilt when the
+data file changes.
+
+Example usage: 'python plot.py -d 2022-08-27 -o plots' saves plots/2022-08-27.png.
+               'python plot.py --range 2022-08-27:2022-11-14 -o plots --format svg' saves an overview.
 """
 
 import argparse
+import os
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 from math import ceil, floor
 from matplotlib.dates import DateFormatter, AutoDateLocator
 from constants import *
-from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+from daily_metrics import DailyMetricsTable, compute_day_metrics, get_sample_hours, MAE, POWER_MEAN
+from downsample import downsample, MAX_PLOT_POINTS
+from storage import load_day
+
+AGGREGATE_INTERVAL = '15min'
+PLOT_CACHE_DIR = CACHE_DIR + 'plot/'
+DAILY_ENERGY = 'daily energy'
 
 # Format time to display as x-axis 
 def format_time_xaxis(ax):
@@ -26,19 +52,19 @@ def plot_irradiance(ax, plot_raw_data, df):
     ax.set_title("Irradiance vs. Time")
     ax.set_ylabel("Irradiance (W/m^2)")
     if plot_raw_data:
-        ax.plot(df.index, df.loc[:,IRRADIANCE], label='irradiance raw')
+        ax.plot(*downsample(df, IRRADIANCE), label='irradiance raw')
     if IRRADIANCE_SMOOTHED in df.columns:
-        ax.plot(df.index, df.loc[:,IRRADIANCE_SMOOTHED], label='irradiance')
+        ax.plot(*downsample(df, IRRADIANCE_SMOOTHED), label='irradiance')
     ax.legend()
     ax.grid(True)
 
 def plot_temperature(ax, plot_raw_data, df):
     format_time_xaxis(ax)
     if plot_raw_data:
-        ax.plot(df.index, df.loc[:,TEMPERATURE], label='temperature raw')
+        ax.plot(*downsample(df, TEMPERATURE), label='temperature raw')
         ax.legend()
     if TEMPERATURE_SMOOTHED in df.columns:
-        ax.plot(df.index, df.loc[:,TEMPERATURE_SMOOTHED], label='temperature')
+        ax.plot(*downsample(df, TEMPERATURE_SMOOTHED), label='temperature')
     ax.set_title("Temperature vs. Time")
     ax.set_ylabel("Temperature (°C)")
     ax.grid(True)
@@ -48,10 +74,10 @@ def plot_voltage(ax, plot_raw_data, df):
     ax.set_title("Voltage vs. Time")
     ax.set_ylabel("Voltage (V)")
     if plot_raw_data:
-        ax.plot(df.index, df.loc[:,VOLTAGE], label='voltage raw')
+        ax.plot(*downsample(df, VOLTAGE), label='voltage raw')
         ax.legend()
     if VOLTAGE_SMOOTHED in df.columns:
-        ax.plot(df.index, df.loc[:,VOLTAGE_SMOOTHED], label='voltage')
+        ax.plot(*downsample(df, VOLTAGE_SMOOTHED), label='voltage')
     ax.grid(True)
     
 def plot_current(ax, plot_raw_data, df):
@@ -59,10 +85,10 @@ def plot_current(ax, plot_raw_data, df):
     ax.set_title("Current vs. Time")
     ax.set_ylabel("Current (A)")
     if plot_raw_data:
-        ax.plot(df.index, df.loc[:,CURRENT], label = 'current raw')
+        ax.plot(*downsample(df, CURRENT), label = 'current raw')
         ax.legend()
     if CURRENT_SMOOTHED in df.columns:
-        ax.plot(df.index, df.loc[:,CURRENT_SMOOTHED], label='current')
+        ax.plot(*downsample(df, CURRENT_SMOOTHED), label='current')
     ax.legend()
     ax.grid(True)
     
@@ -70,33 +96,37 @@ def plot_iam(ax, plot_raw_data, df):
     format_time_xaxis(ax)
     ax.set_title("IAM: Incident Angle Modifier")
     ax.set_ylabel("IAM: Incident Angle Modifier")
-    ax.plot(df.index, df.loc[:,IAM_FACTOR])
+    ax.plot(*downsample(df, IAM_FACTOR))
     ax.grid(True)
     
 def plot_power(ax, plot_raw_data, df):
-    dt = df.index
     format_time_xaxis(ax)
     if plot_raw_data:
-        ax.plot(dt, df.loc[:,POWER], label='measured power raw')
-    ax.plot(dt, df.loc[:,POWER_SMOOTHED], label='measured power')
+        ax.plot(*downsample(df, POWER), label='measured power raw')
+    ax.plot(*downsample(df, POWER_SMOOTHED), label='measured power')
     ax.set_title("Power vs. Time")
     ax.set_ylabel("Power (W)")
     if COMPUTED_POWER in df.columns:
-        ax.plot(dt, df.loc[:,COMPUTED_POWER], label='computed power')
+        ax.plot(*downsample(df, COMPUTED_POWER), label='computed power')
 #    if PVWATTS_POWER in df.columns:
 #        ax.plot(dt, df.loc[:,PVWATTS_POWER], label='pvwatts power')
 
     ax.legend()
     ax.grid(True)
 
-#TODO: 
+# df has 3 colums: 'date', 'mae', 'power mean'. For each row, draws 2 bars: 'mae' and 'power mean'.
 def plot_metrics(ax, df):
-    print('plot metrics')
-    # df has 3 colums: 'date', 'mae', 'power mean'.
-    # for each row, draw 2 bars: 'mae' and 'power mean'. Add legend for the 2 bars
-    # xticks is date, yticks
-    # xlabel is 'date', ylabel is 'Power (w)'
-    # Hint: Use the same way as Example 3 in https://www.geeksforgeeks.org/create-a-grouped-bar-plot-in-matplotlib/ 
+    x = np.arange(len(df))
+    width = 0.4
+    ax.bar(x - width / 2, df['mae'], width, label='mae')
+    ax.bar(x + width / 2, df['power mean'], width, label='power mean')
+    step = max(1, len(df) // 30)
+    ax.set_xticks(x[::step], list(df['date'])[::step], rotation=90 if len(df) > 6 else 0)
+    ax.set_title("Metrics")
+    ax.set_xlabel('date')
+    ax.set_ylabel('Power (W)')
+    ax.legend()
+    ax.grid(True, axis='y')
     
 def get_df_for_time_range(df, start_time, end_time):
     date_str = df.index[0].strftime("%Y-%m-%d ");    
@@ -104,18 +134,55 @@ def get_df_for_time_range(df, start_time, end_time):
     end = date_str + end_time
     return df[start:end]
 
-def get_metrics_dict(df):
-    print('return a dict containing metrics related data for the given df')
-    # TODO: return a dict like this: {'date': '2022-09-24', 'mae': 0.3, 'power mean': 20}
+# Returns a dict containing metrics related data for the given df, e.g. {'date': '2022-09-24', 'mae': 0.3,
+# 'power mean': 20}. The metrics are read from the daily metrics table if df is the data of a processed day.
+def get_metrics_dict(df, table=None):
+    date_str = df.index[0].strftime("%Y-%m-%d")
+    row = (table or DailyMetricsTable()).get(date_str)
+    if row is None:
+        row = compute_day_metrics(df.index, df[POWER_SMOOTHED], df[COMPUTED_POWER], df[IRRADIANCE_SMOOTHED])
+    return {'date': date_str, 'mae': row[MAE], 'power mean': row[POWER_MEAN]}
 
+# Returns the cached DataFrame built by build(filename), rebuilding it if the data file is newer than the cache.
+def load_cached(kind, filename, build):
+    cache_fname = PLOT_CACHE_DIR + kind + '/' + filename + '.pkl'
+    if os.path.exists(cache_fname) and os.path.getmtime(cache_fname) >= os.path.getmtime(DATA_FILE_RELATIVE_DIR + filename):
+        return pd.read_pickle(cache_fname)
+    df = build(filename)
+    os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
+    df.to_pickle(cache_fname + '.tmp')
+    os.replace(cache_fname + '.tmp', cache_fname)
+    return df
+
+# Reads a data file, with a datetime index, and only keeps data between DAY_START_TIME and DAY_END_TIME.
+def read_day_data(filename):
+    df = load_day(filename[:10], filename.endswith('_processed.csv'))
+    df = df[df[TIME].notna()]
+    df.index = pd.DatetimeIndex(pd.to_datetime(df.pop(TIME), format=TIME_FORMAT), name=TIME)
+    return get_df_for_time_range(df, DAY_START_TIME, DAY_END_TIME)
+
+def load_day_data(filename):
+    return load_cached('day', filename, read_day_data)
+
+# Returns the mean measured and computed power of every AGGREGATE_INTERVAL of a processed data file, and the
+# daily energy in Wh in the DAILY_ENERGY column of the first row. A file without daytime data has no rows.
+def aggregate_day_data(filename):
+    df = load_day_data(filename)[[POWER_SMOOTHED, COMPUTED_POWER]]
+    aggregate = df.resample(AGGREGATE_INTERVAL).mean()
+    energy_columns = [DAILY_ENERGY + ' ' + column for column in [POWER_SMOOTHED, COMPUTED_POWER]]
+    if aggregate.empty:
+        return aggregate.reindex(columns=list(aggregate.columns) + energy_columns)
+    energy = df.mul(get_sample_hours(df.index), axis=0).sum()
+    for column, energy_column in zip([POWER_SMOOTHED, COMPUTED_POWER], energy_columns):
+        aggregate.loc[aggregate.index[0], energy_column] = energy[column]
+    return aggregate
+
+def load_day_aggregate(filename):
+    return load_cached('aggregate', filename, aggregate_day_data)
 
 def plot_full_for_file(filename, plot_raw_data):
-    fname = DATA_FILE_RELATIVE_DIR + filename
-    df = pd.read_csv(fname, index_col=TIME, parse_dates=True)
-    # only use data between start and end time
+    df = load_day_data(filename)
         
-    df = get_df_for_time_range(df, DAY_START_TIME, DAY_END_TIME)
-    
     # create a figure which contains 2x3 plots
     fig, ax = plt.subplots(2, 3, figsize=(20, 15))
     date_str = df.index[0].strftime("%Y-%m-%d");
@@ -126,6 +193,7 @@ def plot_full_for_file(filename, plot_raw_data):
     plot_current(ax[1,0], plot_raw_data, df)
     plot_iam(ax[1,1], plot_raw_data, df)
     plot_power(ax[1,2], plot_raw_data, df)
+    return fig
 
 # Plot figures for filenames, one figure per filename. Each figure contains all plots.
 def plot_full_mode(filenames, plot_raw_data):
@@ -135,34 +203,138 @@ def plot_full_mode(filenames, plot_raw_data):
 
 # One fig for all days in filenames.
 def plot_simple_mode(filenames, plot_raw_data):
-    nplots = len(filenames)
+    nplots = len(filenames) + 1 # the last plot is the metrics of all days
     ncols = 3
     nrows = ceil(nplots / ncols)
     fig = plt.figure(1, figsize=(18,10))
-    metrics_df = pd.DataFrame(columns=['date', 'mae', 'power mean'])
+    table = DailyMetricsTable()
+    metrics = []
     for i in range(len(filenames)):
-        fname = DATA_FILE_RELATIVE_DIR + filenames[i]
-        df = pd.read_csv(fname, index_col=TIME, parse_dates=True)
-        df = get_df_for_time_range(df, DAY_START_TIME, DAY_END_TIME)
-        # call get
+        df = load_day_data(filenames[i])
+        metrics.append(get_metrics_dict(df, table))
         subplot_pos = i+1 # subplot position starts at 1
         ax = fig.add_subplot(nrows, ncols, subplot_pos)
         plot_power(ax, plot_raw_data, df)
         date_str = df.index[0].strftime("%Y-%m-%d"); 
         ax.set_title(date_str)
+    table.save()
+    plot_metrics(fig.add_subplot(nrows, ncols, nplots), pd.DataFrame(metrics, columns=['date', 'mae', 'power mean']))
+    return fig
 
-    plt.show()
+# Plots the metrics of the processed days within [start_date, end_date] from the daily metrics table.
+def plot_metrics_mode(start_date, end_date):
+    table = DailyMetricsTable()
+    df = table.query(start_date, end_date)
+    table.save()
+    if df.empty:
+        raise Exception(f"No processed data files from {start_date} to {end_date}")
+    fig, ax = plt.subplots(figsize=(20, 8))
+    plot_metrics(ax, df.reset_index()[['date', MAE, POWER_MEAN]])
+    fig.tight_layout()
+    return fig
+
+# Plots the mean power of every AGGREGATE_INTERVAL and the daily energy of the processed data files.
+def plot_range_overview(filenames):
+    aggregates = [a for a in (load_day_aggregate(fname) for fname in filenames) if not a.empty]
+    if not aggregates:
+        raise Exception("No daytime data in the processed data files")
+    fig, ax = plt.subplots(2, 1, figsize=(20, 12))
+    # A row of NaN after each day, so that the lines are not joined over the nights.
+    df = pd.concat([pd.concat([a, pd.DataFrame(index=[a.index[-1] + pd.Timedelta(AGGREGATE_INTERVAL)])]) for a in aggregates])
+    ax[0].plot(*downsample(df, POWER_SMOOTHED, 5 * MAX_PLOT_POINTS), label='measured power')
+    ax[0].plot(*downsample(df, COMPUTED_POWER, 5 * MAX_PLOT_POINTS), label='computed power')
+    ax[0].set_title(f"Power vs. Time ({AGGREGATE_INTERVAL} mean)")
+    ax[0].set_ylabel("Power (W)")
+    ax[0].legend()
+    ax[0].grid(True)
+
+    dates = [a.index[0].normalize() for a in aggregates]
+    measured = [a[DAILY_ENERGY + ' ' + POWER_SMOOTHED].iloc[0] for a in aggregates]
+    computed = [a[DAILY_ENERGY + ' ' + COMPUTED_POWER].iloc[0] for a in aggregates]
+    x = np.arange(len(dates))
+    ax[1].bar(x - 0.2, measured, 0.4, label='measured energy')
+    ax[1].bar(x + 0.2, computed, 0.4, label='computed energy')
+    step = max(1, len(dates) // 30)
+    ax[1].set_xticks(x[::step], [d.strftime('%Y-%m-%d') for d in dates[::step]], rotation=90)
+    ax[1].set_title("Daily Energy")
+    ax[1].set_ylabel("Energy (Wh)")
+    ax[1].legend()
+    ax[1].grid(True, axis='y')
+    fig.suptitle(f"{dates[0].strftime('%Y-%m-%d')} to {dates[-1].strftime('%Y-%m-%d')}", fontsize = 30)
+    fig.tight_layout()
+    return fig
+
+def use_headless_backend():
+    plt.switch_backend('Agg')
+
+def save_figure(fig, output_dir, name, fmt):
+    fname = os.path.join(output_dir, name + '.' + fmt)
+    fig.savefig(fname)
+    plt.close(fig)
+    return fname
+
+def render_full_for_file(filename, plot_raw_data, output_dir, fmt):
+    return save_figure(plot_full_for_file(filename, plot_raw_data), output_dir, filename.split('.')[0], fmt)
+
+# Renders the full mode figure of each filename to a file in output_dir, in parallel worker processes.
+def render_full_mode(filenames, plot_raw_data, output_dir, fmt, workers=None):
+    os.makedirs(output_dir, exist_ok=True)
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=use_headless_backend) as executor:
+        futures = {fname: executor.submit(render_full_for_file, fname, plot_raw_data, output_dir, fmt) for fname in filenames}
+        for fname, future in futures.items():
+            try:
+                print(future.result())
+            except Exception as e:
+                failed += 1
+                print(f'{fname}: FAILED: {e}')
+    print(f'{len(filenames) - failed} rendered, {failed} failed')
+    return failed
+
+# Returns the processed data filenames of the dates in 'start:end'.
+def get_range_filenames(date_range):
+    start, _, end = date_range.partition(':')
+    filenames = []
+    for date in pd.date_range(start, end or start):
+        fname = date.strftime('%Y-%m-%d') + '_processed.csv'
+        if os.path.exists(DATA_FILE_RELATIVE_DIR + fname):
+            filenames.append(fname)
+    if not filenames:
+        raise Exception("No processed data files in " + date_range)
+    return filenames
 
 def main():
     parser = argparse.ArgumentParser()
-    # Either'-f' and '-d' must be specified, but not both.
+    # One of '-f', '-d' and '--range' must be specified.
     parser.add_argument("-f", "--filenames", default='', help="Comma separated data filenames. E.g. 2022-09-01_processed.csv,2022-09-02_processed.csv")
     parser.add_argument("-d", "--dates", default='',
                         help="The dates to plot, specified as comma separated list of date strings. E.g. 2022-09-01,2022-09-02")    
     parser.add_argument("-r", "--plot_raw", action='store_true', help="If present, plot for raw (i.e., not smoothed) data")
     parser.add_argument("-s", "--simple", action='store_true', help="If present, plot in simple mode, one fig for all days; otherwise, one fig each day with all plots for that day.")
+    parser.add_argument("--range", help="Plot an overview of measured vs. computed power for a date range, e.g. 2022-09-01:2022-10-31")
+    parser.add_argument("-o", "--output_dir", help="If present, save the figures to files in this directory instead of showing them")
+    parser.add_argument("--format", default='png', choices=['png', 'svg'], help="File format of the saved figures")
+    parser.add_argument("-m", "--metrics", action='store_true', help="With --range, plot the daily mae and mean power of the range instead of the power overview")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of worker processes rendering figures, defaults to the number of CPUs")
     args = parser.parse_args()
 
+    if args.output_dir:
+        use_headless_backend()
+
+    if args.range:
+        if args.metrics:
+            start, _, end = args.range.partition(':')
+            fig = plot_metrics_mode(start, end or start)
+        else:
+            fig = plot_range_overview(get_range_filenames(args.range))
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+            name = ('metrics_' if args.metrics else 'overview_') + args.range.replace(':', '_')
+            print(save_figure(fig, args.output_dir, name, args.format))
+        else:
+            plt.show()
+        return
+
     filenames = ''
     if args.filenames:
         filenames = args.filenames.split(',')
@@ -171,16 +343,25 @@ def main():
         suffix = '_processed.csv'
         filenames = [date + suffix for date in dates]
     else:
-         raise Exception("Option -f or -d must be specified")
+         raise Exception("Option -f, -d or --range must be specified")
 
     plot_raw_data = args.plot_raw
     simple_mode = args.simple
 
     #get_mppt_fixed_points(filename)
     if simple_mode:
-        plot_simple_mode(filenames, plot_raw_data)
+        fig = plot_simple_mode(filenames, plot_raw_data)
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+            name = 'simple_' + filenames[0].split('.')[0] + '_' + filenames[-1].split('.')[0]
+            print(save_figure(fig, args.output_dir, name, args.format))
+        else:
+            plt.show()
+    elif args.output_dir:
+        if render_full_mode(filenames, plot_raw_data, args.output_dir, args.format, args.jobs):
+            raise SystemExit(1)
     else:
         plot_full_mode(filenames, plot_raw_data)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -2,10 +2,59 @@
  Preprocess data to:
      - fix power dips caused by MPPT charge controller sweeping
      - smooth sensor data by using the moving average of a window. Window size is 5 minutes by default.
+
+ The preprocessing is vectorized with NumPy so that months of history, or data sampled faster than once
+ a minute, can be processed quickly. The smoothed value of a row is the mean of the values of its window added
+ in order (smoothed_mean), rather than pandas' rolling mean, whose running sum makes the last bits of a mean
+ depend on the rows before the window. So it only depends on the rows of the window, and stream_processor.py,
+ which calls smoothed_mean and neighbour_mean with the rows it holds, outputs exactly the same values.
+ Per-row implementations are kept as fix_mppt_dips_loop and add_smoothed_data_loop and serve as the
+ reference for the parity check:
+
+    Example usage: 'python preprocess_data.py -p' checks all raw data files in ./data/
+                   'python preprocess_data.py -p -d 2022-09-14,2022-09-15' checks the given dates
 """
+import argparse
+import glob
+import math
+import os
+import numpy as np
 import pandas as pd
 from constants import *
-import sys, getopt
+from instrumentation import timed, count
+from resample import SAMPLE_FLAG, MISSING
+
+# Irradiance of a sample must be above this ratio of its neighbours' mean, and power below
+# MPPT_DIP_POWER_RATIO of its neighbours' mean, for the sample to be considered an MPPT dip.
+MPPT_DIP_IRRADIANCE_RATIO = 0.9
+MPPT_DIP_POWER_RATIO = 0.85
+
+SMOOTHED_COLUMNS = {
+    TEMPERATURE: TEMPERATURE_SMOOTHED,
+    IRRADIANCE: IRRADIANCE_SMOOTHED,
+    VOLTAGE: VOLTAGE_SMOOTHED,
+    CURRENT: CURRENT_SMOOTHED,
+    POWER: POWER_SMOOTHED,
+}
+
+# Returns the mean of the values offset elements before and after each element of a 1D array.
+# The first and the last offset elements have no neighbours on both sides and get NaN.
+def neighbour_mean(values, offset=1):
+    means = np.full(len(values), np.nan)
+    if len(values) > 2 * offset:
+        means[offset:-offset] = (values[:-2 * offset] + values[2 * offset:]) / 2
+    return means
+
+# Returns a boolean mask of the samples taken during MPPT sweeping. A sample is a dip if the irradiance
+# is about the same as its neighbours, offset samples before and after, while the power drops significantly.
+def find_mppt_dips(irradiance, power, offset=1):
+    irradiance_mean = neighbour_mean(irradiance, offset)
+    power_mean = neighbour_mean(power, offset)
+    valid = (irradiance_mean != 0) & (power_mean != 0) & ~np.isnan(irradiance_mean) & ~np.isnan(power_mean)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        irradiance_ratio = irradiance / irradiance_mean
+        power_ratio = power / power_mean
+    return valid & (irradiance_ratio > MPPT_DIP_IRRADIANCE_RATIO) & (power_ratio < MPPT_DIP_POWER_RATIO)
 
 # The Victron MPPT charge controller sweeps every 10 minutes to find the maximum power point lasts about 33 seconds.
 # During sweeping the power drops significantly.
@@ -13,7 +62,18 @@ import sys, getopt
 # This function finds the data sampled during sweeping and fixes the data. For POWER, VOLTAGE and CURRENT columns,
 # the data sampled during sweeping is replaced with the mean of the two values sampled at 1 minute before sweeping
 # and 1 minute after sweeping.
+@timed('fix mppt dips')
 def fix_mppt_dips(df):
+    df_copy = df.copy()
+    dips = find_mppt_dips(df[IRRADIANCE].to_numpy(dtype=float), df[POWER].to_numpy(dtype=float))
+    count('mppt dips fixed', int(dips.sum()))
+    for column in [POWER, VOLTAGE, CURRENT]:
+        values = df[column].to_numpy(dtype=float)
+        df_copy[column] = np.where(dips, neighbour_mean(values), values)
+    return df_copy
+
+# Per-row implementation of fix_mppt_dips. Kept as the reference for the parity check.
+def fix_mppt_dips_loop(df):
     df_copy = df.copy()
     for i in range(1, len(df)-1):
         voltage_mean = (df.at[i-1,VOLTAGE] + df.at[i+1,VOLTAGE]) / 2
@@ -23,26 +83,143 @@ def fix_mppt_dips(df):
 
         if irradiance_mean != 0 and power_mean != 0:
             irradiance_ratio = df.at[i,IRRADIANCE] / irradiance_mean
-            power_ratio = df.at[i,POWER] / power_mean     
-            if irradiance_ratio > 0.9 and power_ratio < 0.85:
+            power_ratio = df.at[i,POWER] / power_mean
+            if irradiance_ratio > MPPT_DIP_IRRADIANCE_RATIO and power_ratio < MPPT_DIP_POWER_RATIO:
                 df_copy.at[i,POWER] = power_mean
                 df_copy.at[i,VOLTAGE] = voltage_mean
                 df_copy.at[i,CURRENT] = current_mean
 
     return df_copy
 
+# Number of decimals of the smoothed values.
+SMOOTHED_DECIMALS = 2
+
+# Returns the elementwise mean of the terms (arrays of the same shape) that are not NaN, or NaN where all are
+# NaN, rounded to SMOOTHED_DECIMALS. The terms are added one at a time, in order, so the result only depends on
+# the values of the terms.
+def smoothed_mean(terms):
+    total = np.float64(0)
+    counts = np.int64(0)
+    for values in terms:
+        values = np.asarray(values, dtype=float)
+        valid = ~np.isnan(values)
+        total = np.where(valid, total + values, total)
+        counts = counts + valid
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.round(total / counts, SMOOTHED_DECIMALS)
+
+# Returns the number of samples of a centered window before and after its center, with the same alignment as
+# pandas rolling(window, center=True).
+def window_extent(window):
+    after = (window - 1) // 2
+    return window - 1 - after, after
+
+# Returns the smoothed_mean of the centered window of each row of a 2D array (rows are samples), for all
+# columns at once. Windows are truncated at both ends and NaN values are ignored.
+def centered_moving_average(values, window):
+    values = np.asarray(values, dtype=float)
+    before, after = window_extent(window)
+    padding = values.shape[1:]
+    padded = np.concatenate([np.full((before,) + padding, np.nan), values, np.full((after,) + padding, np.nan)])
+    return smoothed_mean(padded[k:k + len(values)] for k in range(window))
+
 # Smooth TEMPERATURE, IRRADIANCE, VOLTAGE, CURRENT and POWER data by the using moving average of
-# a window size of SMOOTH_DATA_WINDOW_SIZE. The data after smoothing are added as new columns.
+# a window size of window samples. The data after smoothing are added as new columns.
 #  Original df columns are unchanged.
-def add_smoothed_data(df):
-    window = SMOOTH_DATA_WINDOW_SIZE
-    df[TEMPERATURE_SMOOTHED] = df[TEMPERATURE].rolling(window, min_periods=1, center=True).mean().round(2)
-    df[IRRADIANCE_SMOOTHED] = df[IRRADIANCE].rolling(window, min_periods=1, center=True).mean().round(2)
-    df[VOLTAGE_SMOOTHED] = df[VOLTAGE].rolling(window, min_periods=1, center=True).mean().round(2)
-    df[CURRENT_SMOOTHED] = df[CURRENT].rolling(window, min_periods=1, center=True).mean().round(2)
-    df[POWER_SMOOTHED] = df[POWER].rolling(window, min_periods=1, center=True).mean().round(2)
-
-def preprocess_data(df):
+@timed('smoothing')
+def add_smoothed_data(df, window=SMOOTH_DATA_WINDOW_SIZE):
+    block = df[list(SMOOTHED_COLUMNS)].to_numpy(dtype=float)
+    smoothed = centered_moving_average(block, window)
+    for i, column in enumerate(SMOOTHED_COLUMNS.values()):
+        df[column] = smoothed[:, i]
+
+# Per-row implementation of add_smoothed_data. Kept as the reference for the parity check.
+def add_smoothed_data_loop(df, window=SMOOTH_DATA_WINDOW_SIZE):
+    before, after = window_extent(window)
+    for column, smoothed_column in SMOOTHED_COLUMNS.items():
+        values = df[column].to_numpy(dtype=float)
+        smoothed = []
+        for i in range(len(values)):
+            total = 0.0
+            count = 0
+            for value in values[max(0, i - before):i + after + 1]:
+                if not math.isnan(value):
+                    total += value
+                    count += 1
+            smoothed.append(np.round(total / count, SMOOTHED_DECIMALS) if count else np.nan)
+        df[smoothed_column] = smoothed
+
+def preprocess_data(df, window=SMOOTH_DATA_WINDOW_SIZE):
     df = fix_mppt_dips(df)
-    add_smoothed_data(df)
+    add_smoothed_data(df, window)
+    return df
+
+# Returns the number of samples of interval seconds of the smoothing window of window minutes on a grid. The
+# window is centered on a sample, so it is an odd number of samples: when window minutes are an even number of
+# samples, the window is one sample longer, e.g. a 5 minute window of 30 second samples is 11 samples, 5.5
+# minutes. compute_power.py prints a note when that is the case.
+def grid_window_samples(window, interval):
+    samples = max(1, round(window * 60 / interval))
+    return samples if samples % 2 else samples + 1
+
+# Preprocesses a day resampled onto a regular grid of interval seconds by resample.resample_day. The rows are
+# evenly spaced, so the neighbours of the MPPT dip fix are the samples 1 minute before and after, and the
+# smoothing window is window minutes (see grid_window_samples), as fixed strides. Samples whose neighbours or
+# whole window are missing are not fixed or smoothed, and the smoothed values of missing samples are NaN.
+def preprocess_grid(df, interval, window=SMOOTH_DATA_WINDOW_SIZE):
+    offset = max(1, round(60 / interval))
+    df = df.copy()
+    dips = find_mppt_dips(df[IRRADIANCE].to_numpy(dtype=float), df[POWER].to_numpy(dtype=float), offset)
+    count('mppt dips fixed', int(dips.sum()))
+    for column in [POWER, VOLTAGE, CURRENT]:
+        values = df[column].to_numpy(dtype=float)
+        df[column] = np.where(dips, neighbour_mean(values, offset), values)
+    add_smoothed_data(df, grid_window_samples(window, interval))
+    df.loc[df[SAMPLE_FLAG] == MISSING, list(SMOOTHED_COLUMNS.values())] = np.nan
+    return df
+
+def preprocess_data_loop(df, window=SMOOTH_DATA_WINDOW_SIZE):
+    df = fix_mppt_dips_loop(df)
+    add_smoothed_data_loop(df, window)
     return df
+
+# Returns the names of the columns on which the vectorized and the reference preprocessing differ.
+def check_parity(df, window=SMOOTH_DATA_WINDOW_SIZE):
+    expected = preprocess_data_loop(df, window)
+    actual = preprocess_data(df, window)
+    mismatched = []
+    for column in expected.columns:
+        if not expected[column].equals(actual[column]):
+            mismatched.append(column)
+    return mismatched
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--parity", action='store_true',
+                        help="Check that the vectorized preprocessing matches the per-row implementation")
+    parser.add_argument("-d", "--dates", default='',
+                        help="Comma separated dates to check, e.g. 2022-09-14,2022-09-15. Defaults to all raw data files.")
+    parser.add_argument("-w", "--window", type=int, default=SMOOTH_DATA_WINDOW_SIZE,
+                        help="Size of the smoothing window in samples, defaults to SMOOTH_DATA_WINDOW_SIZE")
+    args = parser.parse_args()
+
+    if not args.parity:
+        raise Exception("Option -p must be specified")
+
+    if args.dates:
+        fnames = [DATA_FILE_RELATIVE_DIR + date + '.csv' for date in args.dates.split(',')]
+    else:
+        fnames = [f for f in sorted(glob.glob(DATA_FILE_RELATIVE_DIR + '*.csv')) if not f.endswith('_processed.csv')]
+
+    failed = 0
+    for fname in fnames:
+        mismatched = check_parity(pd.read_csv(fname), args.window)
+        if mismatched:
+            failed += 1
+            print(os.path.basename(fname), 'MISMATCH', mismatched)
+    print(f'{len(fnames) - failed}/{len(fnames)} files match')
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Single entry point for the scripts, with a subcommand for each:
+    collect    collect_sensor_data.py
+    process    compute_power.py
+    calibrate  calibrate.py
+    plot       plot.py
+    metrics    daily_metrics.py
+    fleet      fleet.py
+    serve      serve.py
+    replay     replay.py
+The arguments after the subcommand are passed to the script, e.g. 'python pvmon.py process -b' is
+'python compute_power.py -b'.
+
+pvmon.py itself only imports the standard library, and the module of a subcommand is imported when the
+subcommand runs, so 'collect', which cron may start every minute, doesn't pay for pandas, pvlib or matplotlib.
+
+The data, config, cache and store directories are set by the options before the subcommand, or by the
+environment variables PVMON_DATA_DIR, PVMON_CONFIG_DIR, PVMON_CACHE_DIR and PVMON_STORE_DIR (see constants.py).
+Those not set default to the data/, config/, cache/ and store/ subdirectories of the directory of pvmon.py, so
+pvmon.py can be run from any directory. --array runs a subcommand on one array of a fleet config, with its data,
+cache and store in the subdirectories named after the array (sets PVMON_ARRAY, see fleet.py).
+
+The 'startup' subcommand measures the startup time of each subcommand: the median wall time, over several
+runs, of a new Python process that imports the subcommand's module. It fails if a subcommand exceeds its
+budget in STARTUP_BUDGETS, and with --importtime prints the slowest imports of each subcommand.
+
+Example usage: 'python pvmon.py --data_dir /srv/pv/data collect -w'
+               'python pvmon.py --array roof-south calibrate -s 2022-09-01 -e 2022-09-30'
+               'python pvmon.py process -b -s 2022-09-01 -e 2022-09-30'
+               'python pvmon.py startup'
+"""
+
+import argparse
+import importlib
+import os
+import subprocess
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SUBCOMMANDS = {
+    'collect': 'collect_sensor_data',
+    'process': 'compute_power',
+    'calibrate': 'calibrate',
+    'plot': 'plot',
+    'metrics': 'daily_metrics',
+    'fleet': 'fleet',
+    'serve': 'serve',
+    'replay': 'replay',
+}
+# Options for the directories, the environment variables they set and their default subdirectories. The
+# variables are read by constants.py when it is imported, so they are set before any subcommand module is.
+DIRECTORY_OPTIONS = {
+    'data_dir': ('PVMON_DATA_DIR', 'data'),
+    'config_dir': ('PVMON_CONFIG_DIR', 'config'),
+    'cache_dir': ('PVMON_CACHE_DIR', 'cache'),
+    'store_dir': ('PVMON_STORE_DIR', 'store'),
+}
+# Startup time budgets in seconds. collect may be started by cron every minute, on a Raspberry Pi.
+STARTUP_BUDGETS = {
+    'collect': 0.5,
+    'process': 5.0,
+    'calibrate': 5.0,
+    'plot': 5.0,
+    'metrics': 5.0,
+    'fleet': 5.0,
+    'serve': 5.0,
+    'replay': 5.0,
+}
+DEFAULT_STARTUP_RUNS = 5
+# Number of imports listed per subcommand with --importtime.
+SLOWEST_IMPORTS = 10
+
+# Sets the environment variables of the directories from the options, or to their defaults if neither is set.
+def set_directories(args):
+    for option, (variable, subdirectory) in DIRECTORY_OPTIONS.items():
+        value = getattr(args, option)
+        if value:
+            os.environ[variable] = os.path.abspath(value)
+        elif not os.environ.get(variable):
+            os.environ[variable] = os.path.join(SCRIPT_DIR, subdirectory)
+
+# Imports and returns the module of a subcommand.
+def load_subcommand(name):
+    if SCRIPT_DIR not in sys.path:
+        sys.path.insert(0, SCRIPT_DIR)
+    return importlib.import_module(SUBCOMMANDS[name])
+
+# Runs the main() of a subcommand's module with the arguments.
+def run_subcommand(name, args):
+    module = load_subcommand(name)
+    sys.argv = [f'pvmon.py {name}'] + args
+    return module.main()
+
+# Returns the wall time of a new Python process that imports the module of a subcommand, and its stderr.
+def time_startup(name, importtime=False):
+    code = f'import sys; sys.path.insert(0, {SCRIPT_DIR!r}); import pvmon; pvmon.load_subcommand({name!r})'
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+    start = time.perf_counter()
+    result = subprocess.run(command, capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        raise Exception(f"Failed to import subcommand {name}:\n{result.stderr}")
+    return seconds, result.stderr
+
+# Returns the (cumulative microseconds, module) of the slowest imports in the output of -X importtime.
+def slowest_imports(importtime_output, n):
+    imports = []
+    for line in importtime_output.splitlines():
+        fields = line.split('|')
+        if not line.startswith('import time:') or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        # Nested imports are indented by 2 spaces per level. Only top level imports are listed, so that a
+        # module isn't listed along with the modules it imports.
+        if not fields[2].startswith('  '):
+            imports.append((int(fields[1]), fields[2].strip()))
+    return sorted(imports, reverse=True)[:n]
+
+# Measures the median startup time of each subcommand and compares it with its budget. Returns the subcommands
+# over budget.
+def check_startup(names, runs, budget=None, importtime=False):
+    over_budget = []
+    for name in names:
+        median = sorted(time_startup(name)[0] for _ in range(runs))[runs // 2]
+        limit = STARTUP_BUDGETS[name] if budget is None else budget
+        status = 'ok' if median <= limit else 'OVER BUDGET'
+        print(f'{name:10s} {median:7.3f} s   budget {limit:5.2f} s   {status}')
+        if median > limit:
+            over_budget.append(name)
+        if importtime:
+            for microseconds, module in slowest_imports(time_startup(name, True)[1], SLOWEST_IMPORTS):
+                print(f'    {microseconds / 1e6:7.3f} s  {module}')
+    return over_budget
+
+def startup_main(argv):
+    parser = argparse.ArgumentParser(prog='pvmon.py startup', description='Measures the startup time of the subcommands')
+    parser.add_argument("commands", nargs='*', help=f"Subcommands to measure, of {', '.join(SUBCOMMANDS)}. Defaults to all")
+    parser.add_argument("-n", "--runs", type=int, default=DEFAULT_STARTUP_RUNS, help="Number of runs per subcommand")
+    parser.add_argument("--budget", type=float, help="Budget in seconds for all subcommands, instead of STARTUP_BUDGETS")
+    parser.add_argument("--importtime", action='store_true', help="If present, print the slowest imports of each subcommand")
+    args = parser.parse_args(argv)
+
+    for name in args.commands:
+        if name not in SUBCOMMANDS:
+            parser.error(f"unknown subcommand {name}")
+    if check_startup(args.commands or list(SUBCOMMANDS), args.runs, args.budget, args.importtime):
+        raise SystemExit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description='PV monitoring. The arguments after the subcommand are passed to its script.')
+    for option, (variable, subdirectory) in DIRECTORY_OPTIONS.items():
+        parser.add_argument(f"--{option}", help=f"Directory of the {subdirectory} files. Defaults to ${variable}, or {subdirectory}/ next to pvmon.py")
+    parser.add_argument("--array", help="Name of the array of a fleet config to work on. Defaults to $PVMON_ARRAY")
+    parser.add_argument("command", choices=list(SUBCOMMANDS) + ['startup'], help="Subcommand")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="Arguments of the subcommand")
+    args = parser.parse_args()
+
+    set_directories(args)
+    if args.array:
+        os.environ['PVMON_ARRAY'] = args.array
+    if args.command == 'startup':
+        startup_main(args.args)
+    else:
+        run_subcommand(args.command, args.args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Loads the data of an arbitrary time range, which may span several day files, as one DataFrame.
+
+    load_range('2022-10-07 14:00', '2022-10-09 16:00', [POWER_SMOOTHED, COMPUTED_POWER], processed=True)
+
+returns the rows with a time within [start, end) from 2022-10-07_processed.csv, 2022-10-08_processed.csv and
+2022-10-09_processed.csv. An end given as a date only, e.g. '2022-10-09', includes the whole day.
+
+Only the day files of the range are opened. The index of data_index.py records the first and last time of
+each file: files entirely within the range are read whole, and within the first and last file the rows at
+the range boundaries are found by binary search, so only the bytes of the needed rows and the requested
+columns are parsed. The time column is always returned, as datetime, and the other columns as float.
+
+Example usage: 'python query.py -s "2022-10-07 14:00" -e "2022-10-09 16:00" -c "power smoothed,computed power" -p'
+"""
+
+import argparse
+import io
+import pandas as pd
+from constants import *
+from data_index import DataIndex, read_rows_between
+
+# Returns (start, end) as strings in TIME_FORMAT. An end without a time of day is the end of that day.
+def normalize_range(start, end):
+    start_time = pd.Timestamp(start)
+    end_time = pd.Timestamp(end)
+    if len(end.strip()) <= 10:
+        end_time += pd.Timedelta(days=1)
+    return start_time.strftime(TIME_FORMAT), end_time.strftime(TIME_FORMAT)
+
+# Returns the day filenames of the dates from start to end, in order.
+def range_filenames(start, end, processed):
+    suffix = '_processed.csv' if processed else '.csv'
+    # end is exclusive, so a range ending at midnight doesn't include the file of that day.
+    last = (pd.Timestamp(end) - pd.Timedelta(seconds=1)).normalize()
+    return [date.strftime('%Y-%m-%d') + suffix for date in pd.date_range(pd.Timestamp(start).normalize(), last)]
+
+# Parses the rows of a data file with a header row, keeping the rows with a time within [start, end).
+def parse_rows(header, rows, start, end, columns):
+    usecols = None if columns is None else [TIME] + [c for c in columns if c != TIME]
+    df = pd.read_csv(io.BytesIO(header + rows), usecols=usecols)
+    df = df[(df[TIME] >= start) & (df[TIME] < end)]
+    df = df if columns is None else df[usecols]
+    # All columns but time are numbers. As float, their dtype doesn't depend on whether the rows loaded have
+    # missing values.
+    return df.astype({column: float for column in df.columns if column != TIME})
+
+# Returns the rows of the raw (or processed) data files with a time within [start, end) as one DataFrame, with
+# the time column as datetime. columns defaults to all columns. The index is updated for files that changed.
+def load_range(start, end, columns=None, processed=False, index=None):
+    start, end = normalize_range(start, end)
+    index = DataIndex() if index is None else index
+    frames = []
+    for filename in range_filenames(start, end, processed):
+        entry = index.get(filename)
+        if entry is None or entry['first'] is None or entry['last'] < start or entry['first'] >= end:
+            continue
+        header, rows = read_rows_between(filename, entry, start, end)
+        if not header:
+            continue
+        frames.append(parse_rows(header, rows, start, end, columns))
+    index.save()
+    if not frames:
+        return pd.DataFrame(columns=[TIME] + [c for c in (columns or []) if c != TIME])
+    df = pd.concat(frames, ignore_index=True)
+    df[TIME] = pd.to_datetime(df[TIME], format=TIME_FORMAT)
+    return df
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--start", required=True, help="Start of the range, e.g. '2022-10-07 14:00'")
+    parser.add_argument("-e", "--end", required=True, help="End of the range, exclusive, e.g. '2022-10-09 16:00'. A date only includes that day.")
+    parser.add_argument("-c", "--columns", default='', help="Comma separated columns to load, defaults to all columns")
+    parser.add_argument("-p", "--processed", action='store_true', help="If present, load the processed data files")
+    args = parser.parse_args()
+
+    columns = args.columns.split(',') if args.columns else None
+    df = load_range(args.start, args.end, columns, args.processed)
+    print(df.to_string(index=False))
+    print(f'{len(df)} rows')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+"""
+Replays historical data files through the collector and the stream processor, for end-to-end load testing
+without the sensors.
+
+ReplaySensorBackend stands in for the sensors: it returns the values of the replayed data at the time of
+ReplayClock, which runs --speed times faster than real time over the samples of the replayed days, skipping
+the nights between them. The samples are optionally interpolated to 1 Hz (linearly, between samples up to
+MAX_INTERPOLATED_GAP apart), and fanned out to -n virtual devices. For each sample time, each device goes
+through the real path:
+    - ConcurrentSensorReader and collect_sensor_data.get_sensor_data read the backend
+    - a BufferedRowWriter appends the rows to the device's day files with write_rows_to_file, in
+      <output dir>/device-<n>/, every --flush_rows rows
+    - the new complete rows of the day file are read back, as stream_processor.py -t does, and processed by a
+      StreamProcessor, which outputs the derived values with a lag of 3 rows
+With --batch, compute_power.process then processes the written day files of each device.
+
+The report gives the sustained ingest rate (rows written per second of wall time, and the target rate), the
+end-to-end latency from reading a sample to its derived values being computed, the sample times that were
+late (started more than half a sample interval after their scheduled time) or dropped (skipped because the
+replay had fallen a whole interval behind, like the missed samples of the daemon), and sensor errors.
+
+Sample times are converted with the time zone of the machine, so that the replayed day files have the
+local times of the original files.
+
+Example usage: 'python replay.py -s 2022-09-14 -e 2022-09-14 --speed 60 -n 10' replays a day in 13 minutes
+                   on 10 devices.
+               'python replay.py -s 2022-09-14 -e 2022-09-14 --one_hz --speed 10 -n 5 --duration 60 -o replay.json'
+"""
+
+import argparse
+import csv
+import json
+import os
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from constants import *
+from sensors import SensorBackend, ConcurrentSensorReader, DEFAULT_SENSOR_TIMEOUT
+from collect_sensor_data import BufferedRowWriter, get_sensor_data, DEFAULT_FLUSH_ROWS
+from compute_power import list_raw_filenames, process
+from site_config import Config
+from calibrate import read_calibrated_coefficient
+from resample import resample_day, SAMPLE_FLAG, MISSING
+from stream_processor import StreamProcessor, parse_row
+
+REPLAY_OUTPUT_DIR = DATA_FILE_RELATIVE_DIR + 'replay/'
+# Samples further apart than this are not interpolated to 1 Hz.
+MAX_INTERPOLATED_GAP = 180  # seconds
+# A sample time is late if it starts more than this fraction of the sample interval after its schedule.
+LATE_FRACTION = 0.5
+STREAM_COLUMNS = [TEMPERATURE, IRRADIANCE, VOLTAGE, CURRENT, POWER]
+
+# Returns the local times of the TIME column as seconds since the epoch, in the time zone of the machine.
+def to_local_epoch(time_column):
+    return np.array([datetime.strptime(t, TIME_FORMAT).timestamp() for t in time_column])
+
+# The samples of the replayed days in time order: times (seconds since the epoch), the STREAM_COLUMNS values and
+# the replay time of each sample, in which the nights between days take one sample interval.
+class ReplayStream:
+    def __init__(self, filenames, one_hz=False):
+        times, values, replay_times = [], [], []
+        for filename in filenames:
+            df = pd.read_csv(DATA_FILE_RELATIVE_DIR + filename)
+            if one_hz:
+                df = resample_day(df, 1, MAX_INTERPOLATED_GAP)
+                df = df[df[SAMPLE_FLAG] != MISSING]
+            else:
+                df = df[df[TIME].notna()].sort_values(TIME, kind='stable').drop_duplicates(TIME)
+            if df.empty:
+                continue
+            day_times = to_local_epoch(df[TIME])
+            interval = float(np.median(np.diff(day_times))) if len(day_times) > 1 else 60.0
+            start = replay_times[-1][-1] + interval if replay_times else day_times[0]
+            times.append(day_times)
+            replay_times.append(day_times - day_times[0] + start)
+            values.append(df[STREAM_COLUMNS].to_numpy(dtype=float))
+        if not times:
+            raise Exception("No samples to replay")
+        self.times = np.concatenate(times)
+        self.replay_times = np.concatenate(replay_times)
+        self.values = np.concatenate(values)
+
+    def __len__(self):
+        return len(self.times)
+
+# The time of the replayed data, running speed times faster than the wall clock from start(). Returns the
+# sample time, in seconds since the epoch, at the current replay time.
+class ReplayClock:
+    def __init__(self, stream, speed):
+        self.stream = stream
+        self.speed = speed
+        self.wall_start = None
+
+    def start(self):
+        self.wall_start = time.time()
+
+    def replay_time(self):
+        return self.stream.replay_times[0] + (time.time() - self.wall_start) * self.speed
+
+    # Returns the wall time at which the replay time of sample i is reached.
+    def wall_time(self, i):
+        return self.wall_start + (self.stream.replay_times[i] - self.stream.replay_times[0]) / self.speed
+
+    def __call__(self):
+        replay_time = self.replay_time()
+        i = max(0, np.searchsorted(self.stream.replay_times, replay_time, side='right') - 1)
+        return self.stream.times[i] + replay_time - self.stream.replay_times[i]
+
+# Returns the values of the replayed sample at the time of the clock.
+class ReplaySensorBackend(SensorBackend):
+    def __init__(self, stream, clock):
+        self.stream = stream
+        self.clock = clock
+
+    def current(self):
+        i = max(0, np.searchsorted(self.stream.replay_times, self.clock.replay_time(), side='right') - 1)
+        return [None if np.isnan(v) else round(float(v), 2) for v in self.stream.values[i]]
+
+    def get_temp(self):
+        return self.current()[0]
+
+    def get_irradiance(self):
+        return self.current()[1]
+
+    def get_vip(self):
+        return self.current()[2:]
+
+# Reads the complete rows appended to a data file since the last call.
+class DataFileTail:
+    def __init__(self, filename):
+        self.filename = filename
+        self.position = 0
+        self.header = None
+
+    def read_rows(self):
+        if not os.path.exists(self.filename):
+            return []
+        rows = []
+        with open(self.filename, 'r', newline='', encoding='utf-8') as file:
+            file.seek(self.position)
+            for line in iter(file.readline, ''):
+                # Only complete lines, the writer may be appending the current one.
+                if not line.endswith('\n'):
+                    break
+                self.position = file.tell()
+                values = next(csv.reader([line]))
+                if self.header is None:
+                    self.header = values
+                else:
+                    rows.append(parse_row(dict(zip(self.header, values))))
+        return rows
+
+# A virtual device: its reader, the writer of its day files, and the stream processing of the rows written.
+class VirtualDevice:
+    def __init__(self, name, stream, clock, data_dir, flush_rows, power_coefficient, config):
+        self.name = name
+        self.data_dir = data_dir
+        self.reader = ConcurrentSensorReader(ReplaySensorBackend(stream, clock), DEFAULT_SENSOR_TIMEOUT, clock=clock)
+        self.writer = BufferedRowWriter(flush_rows, data_dir=data_dir)
+        self.processor = StreamProcessor(power_coefficient, config)
+        self.tail = None
+        self.filenames = []
+        # {timestamp: wall time of the read} of the samples waiting for their derived values
+        self.read_times = {}
+        self.latencies = []
+
+    def sample(self):
+        dict = get_sensor_data(self.reader)
+        self.read_times[dict[TIMESTAMP]] = time.time()
+        self.writer.write(dict)
+        return dict
+
+    # Processes the rows written since the last call. With final, the rows still buffered are written and the
+    # stream processor outputs its last rows.
+    def process_written(self, final=False):
+        if final:
+            self.writer.flush()
+        if self.writer.filename and (self.tail is None or self.tail.filename != self.writer.filename):
+            if self.tail is not None:
+                self.add_processed(self.tail.read_rows())
+            self.tail = DataFileTail(self.writer.filename)
+            self.filenames.append(self.writer.filename)
+        if self.tail is not None:
+            self.add_processed(self.tail.read_rows())
+        if final:
+            self.record_latencies(self.processor.flush())
+
+    def add_processed(self, rows):
+        for row in rows:
+            self.record_latencies(self.processor.update(row))
+
+    def record_latencies(self, processed_rows):
+        now = time.time()
+        for row in processed_rows:
+            read_time = self.read_times.pop(row[TIMESTAMP], None)
+            if read_time is not None:
+                self.latencies.append(now - read_time)
+
+    def close(self):
+        self.reader.close()
+
+# Replays the stream on devices. Stops after duration seconds of wall time, if given. Returns the results.
+def run_replay(stream, devices, clock, duration=None):
+    late = 0
+    dropped = 0
+    samples = 0
+    clock.start()
+    for i in range(len(stream)):
+        scheduled = clock.wall_time(i)
+        if duration is not None and scheduled - clock.wall_start > duration:
+            break
+        delay = scheduled - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        next_scheduled = clock.wall_time(i + 1) if i + 1 < len(stream) else None
+        # The replay fell behind past the next sample time: drop this one, like the daemon skips missed samples.
+        if next_scheduled is not None and time.time() > next_scheduled:
+            dropped += 1
+            continue
+        if next_scheduled is not None and time.time() - scheduled > LATE_FRACTION * (next_scheduled - scheduled):
+            late += 1
+        for device in devices:
+            device.sample()
+        for device in devices:
+            device.process_written()
+        samples += 1
+    for device in devices:
+        device.process_written(final=True)
+    wall_seconds = time.time() - clock.wall_start
+
+    latencies = np.concatenate([device.latencies for device in devices]) * 1000
+    replayed = clock.stream.replay_times[min(samples + dropped, len(stream)) - 1] - clock.stream.replay_times[0]
+    rows = samples * len(devices)
+    return {
+        'devices': len(devices),
+        'speed': clock.speed,
+        'wall_seconds': round(wall_seconds, 3),
+        'sample_times': samples + dropped,
+        'rows_written': rows,
+        'rows_processed': int(len(latencies)),
+        'ingest_rows_per_second': round(rows / wall_seconds, 1) if wall_seconds else None,
+        'target_rows_per_second': round((samples + dropped) * len(devices) * clock.speed / replayed, 1) if replayed else None,
+        'late_sample_times': late,
+        'dropped_sample_times': dropped,
+        'dropped_samples': dropped * len(devices),
+        'sensor_errors': sum(sum(device.reader.errors.values()) for device in devices),
+        'latency_ms': {name: round(float(np.percentile(latencies, q)), 2) if len(latencies) else None
+                       for name, q in [('p50', 50), ('p95', 95), ('p99', 99), ('max', 100)]},
+    }
+
+# Processes the day files written by the devices with compute_power.process. Returns the rows/s.
+def run_batch(devices, power_coefficient, config):
+    start = time.time()
+    rows = 0
+    for device in devices:
+        for fname in device.filenames:
+            process(os.path.relpath(fname, DATA_FILE_RELATIVE_DIR), power_coefficient, config, store=False)
+            rows += sum(1 for _ in open(fname)) - 1
+    seconds = time.time() - start
+    return {'batch_seconds': round(seconds, 3), 'batch_rows_per_second': round(rows / seconds, 1) if seconds else None}
+
+def print_results(results):
+    for name, value in results.items():
+        if isinstance(value, dict):
+            value = '  '.join(f'{k} {v}' for k, v in value.items())
+        print(f'{name:24s} {value}')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--start", help="First date to replay, e.g. 2022-09-14")
+    parser.add_argument("-e", "--end", help="Last date to replay, e.g. 2022-09-14")
+    parser.add_argument("-n", "--devices", type=int, default=1, help="Number of virtual devices")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed, 1 is real time")
+    parser.add_argument("--one_hz", action='store_true', help="If present, interpolate the data to 1 sample per second")
+    parser.add_argument("--duration", type=float, help="Stop after this many seconds of wall time")
+    parser.add_argument("--flush_rows", type=int, default=DEFAULT_FLUSH_ROWS, help="Rows buffered by each device's writer before they are written")
+    parser.add_argument("--output_dir", default=REPLAY_OUTPUT_DIR, help="Directory for the devices' day files, must not exist or be empty")
+    parser.add_argument("--batch", action='store_true', help="If present, process the written day files with compute_power.process after the replay")
+    parser.add_argument("-o", "--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    if args.speed <= 0 or args.devices < 1:
+        raise Exception("Speed must be positive and there must be at least one device")
+    output_dir = os.path.join(args.output_dir, '')
+    if os.path.exists(output_dir) and os.listdir(output_dir):
+        raise Exception(f"{output_dir} is not empty, remove it or choose another --output_dir")
+    filenames = list_raw_filenames(args.start, args.end)
+    stream = ReplayStream(filenames, args.one_hz)
+    print(f'Replaying {len(stream)} samples of {len(filenames)} days on {args.devices} devices at {args.speed}x')
+
+    config = Config()
+    power_coefficient = read_calibrated_coefficient()
+    clock = ReplayClock(stream, args.speed)
+    devices = []
+    for i in range(args.devices):
+        data_dir = output_dir + f'device-{i}/'
+        os.makedirs(data_dir, exist_ok=True)
+        devices.append(VirtualDevice(f'device-{i}', stream, clock, data_dir, args.flush_rows, power_coefficient, config))
+    try:
+        results = run_replay(stream, devices, clock, args.duration)
+        if args.batch:
+            results.update(run_batch(devices, power_coefficient, config))
+    finally:
+        for device in devices:
+            device.close()
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Aligns the samples of a day onto a regular time grid.
+
+The collector's timestamps jitter by a few seconds around the sampling interval, and the data has gaps when
+the collector or a sensor was down, e.g. about an hour on 2022-09-14. Preprocessing by row index assumes
+evenly spaced rows, so across a gap the "1 minute before and after" neighbours of the MPPT dip fix and the
+smoothing window span much more time. resample_day puts the samples on a grid of fixed interval instead:
+    - each grid point takes the values of the nearest sample within half an interval; the raw values are
+      kept as they are, so MPPT dips stay intact
+    - grid points without a sample are flagged; runs of them no longer than max_gap seconds are linearly
+      interpolated in time if interpolate is set, and longer runs are masked with NaN
+The SAMPLE_FLAG column records for each grid point whether it was MEASURED, INTERPOLATED or MISSING.
+Rows are then evenly spaced, so preprocess_data.preprocess_grid can use fixed strides for the neighbours and
+the smoothing window, and compute_power.py uses it with --grid.
+
+TIMESTAMP of each grid point is its local time converted with the site's time zone (site_config.py), so
+the days DST starts or ends get the right UTC offset on each side of the change.
+
+The coverage of a day is the fraction of the grid points between DAY_START_TIME and DAY_END_TIME with a
+measured sample (daytime_coverage). get_coverage reports it with the longest gap, and daily_metrics.py
+reports it for the processed days, on a grid of their median sample interval.
+
+Example usage: 'python resample.py -s 2022-09-01 -e 2022-09-30' prints the coverage of each day.
+               'python resample.py -s 2022-09-14 -e 2022-09-14 -i 30 -o 2022-09-14_grid.csv' writes the resampled day.
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+from constants import *
+from site_config import Config
+
+DEFAULT_GRID_INTERVAL = 60          # seconds
+DEFAULT_MAX_INTERPOLATED_GAP = 300  # seconds
+
+SAMPLE_FLAG = 'sample flag'
+MEASURED = 0
+INTERPOLATED = 1
+MISSING = 2
+
+GRID_POINTS = 'grid points'
+MEASURED_POINTS = 'measured'
+INTERPOLATED_POINTS = 'interpolated'
+MISSING_POINTS = 'missing'
+COVERAGE = 'coverage'
+LONGEST_GAP = 'longest gap (min)'
+
+# Returns the local time of each sample in seconds, like TIMESTAMP but without the UTC offset, and the mask of
+# the samples with a time.
+def local_seconds(df):
+    time = pd.to_datetime(df[TIME], format=TIME_FORMAT)
+    valid = time.notna().to_numpy()
+    seconds = np.zeros(len(df), dtype=np.int64)
+    seconds[valid] = time[valid].to_numpy(dtype='datetime64[s]').astype(np.int64)
+    return seconds, valid
+
+# Returns the grid points, in seconds, from the first multiple of interval at or after the first sample to the
+# last multiple at or before the last sample.
+def grid_times(seconds, interval):
+    first = -(-seconds.min() // interval) * interval
+    last = seconds.max() // interval * interval
+    return np.arange(first, last + 1, interval, dtype=np.int64)
+
+# Returns the index of the sample nearest to each grid point, or -1 if there is none within half an interval.
+# seconds must be sorted.
+def nearest_samples(seconds, grid, interval):
+    after = np.searchsorted(seconds, grid).clip(max=len(seconds) - 1)
+    before = (after - 1).clip(min=0)
+    nearest = np.where(np.abs(seconds[before] - grid) <= np.abs(seconds[after] - grid), before, after)
+    return np.where(np.abs(seconds[nearest] - grid) * 2 <= interval, nearest, -1)
+
+# Returns the local times, in seconds, of the grid points of interval seconds between DAY_START_TIME and
+# DAY_END_TIME of day, e.g. '2022-09-14'.
+def daytime_grid(day, interval):
+    start, end = pd.to_datetime([day + ' ' + DAY_START_TIME, day + ' ' + DAY_END_TIME]).to_numpy(dtype='datetime64[s]').astype(np.int64)
+    return np.arange(-(-start // interval) * interval, end // interval * interval + 1, interval, dtype=np.int64)
+
+# Returns the coverage of day: the fraction of the daytime_grid points with a sample within half an interval.
+# seconds are the local times of the samples, in seconds like local_seconds.
+def daytime_coverage(seconds, day, interval):
+    grid = daytime_grid(day, interval)
+    if len(seconds) == 0 or len(grid) == 0:
+        return 0.0
+    return float(np.mean(nearest_samples(np.sort(seconds), grid, interval) >= 0))
+
+# Returns the (start, end) indices of the runs of True in a boolean array.
+def find_runs(mask):
+    edges = np.diff(np.r_[0, mask.astype(np.int8), 0])
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+# Interpolates the values of the missing grid points in runs no longer than max_gap seconds, between the
+# measured points around them. Updates values and flags in place.
+def fill_gaps(values, flags, interval, max_gap):
+    measured = np.flatnonzero(flags == MEASURED)
+    if len(measured) < 2:
+        return
+    fill = np.zeros(len(flags), dtype=bool)
+    for start, end in zip(*find_runs(flags == MISSING)):
+        # Runs at the ends of the grid have no measured point on one side and stay missing.
+        if start > 0 and end < len(flags) and (end - start) * interval <= max_gap:
+            fill[start:end] = True
+    if not fill.any():
+        return
+    positions = np.flatnonzero(fill)
+    for column in range(values.shape[1]):
+        known = measured[~np.isnan(values[measured, column])]
+        if len(known) >= 2:
+            values[positions, column] = np.interp(positions, known, values[known, column])
+    flags[fill] = INTERPOLATED
+
+# Returns the unix time of each grid point, from its local time in timezone. A local time that doesn't exist
+# or that is repeated when DST starts or ends takes the UTC offset of its nearest sample, or else the median
+# offset of the samples.
+def grid_timestamps(grid, nearest, offsets, timezone):
+    local = pd.DatetimeIndex(pd.to_datetime(grid, unit='s'))
+    utc = local.tz_localize(timezone, ambiguous='NaT', nonexistent='NaT')
+    seconds = utc.tz_convert(None).to_numpy(dtype='datetime64[s]').astype(np.int64)
+    timestamps = np.where(utc.isna(), 0, seconds)
+    unresolved = np.flatnonzero(utc.isna())
+    if len(unresolved):
+        median = np.nanmedian(offsets) if np.any(~np.isnan(offsets)) else 0
+        sample_offsets = np.where(nearest[unresolved] >= 0, offsets[nearest[unresolved].clip(min=0)], np.nan)
+        timestamps[unresolved] = grid[unresolved] + np.where(np.isnan(sample_offsets), median, sample_offsets)
+    return timestamps.astype(np.int64)
+
+# Returns the samples of a day's DataFrame with the raw data columns on a regular grid of interval seconds,
+# with the SAMPLE_FLAG column. Missing runs up to max_gap seconds are interpolated if interpolate is set, the
+# others are NaN. timezone is the time zone of the local times, by default the site's.
+def resample_day(df, interval=DEFAULT_GRID_INTERVAL, max_gap=DEFAULT_MAX_INTERPOLATED_GAP, interpolate=True,
+                 timezone=None):
+    if timezone is None:
+        timezone = Config().timezone
+    seconds, valid = local_seconds(df)
+    if not valid.any():
+        raise Exception("No samples with a time")
+    df = df[valid]
+    seconds = seconds[valid]
+    order = np.argsort(seconds, kind='stable')
+    seconds = seconds[order]
+    value_columns = [c for c in df.columns if c not in [TIMESTAMP, TIME]]
+    raw = df[value_columns].to_numpy(dtype=float)[order]
+
+    grid = grid_times(seconds, interval)
+    nearest = nearest_samples(seconds, grid, interval)
+    values = np.where((nearest >= 0)[:, np.newaxis], raw[nearest.clip(min=0)], np.nan)
+    flags = np.where(nearest >= 0, MEASURED, MISSING).astype(np.int8)
+    if interpolate:
+        fill_gaps(values, flags, interval, max_gap)
+
+    offsets = df[TIMESTAMP].to_numpy(dtype=float)[order] - seconds
+    result = pd.DataFrame({TIMESTAMP: grid_timestamps(grid, nearest, offsets, timezone),
+                           TIME: pd.to_datetime(grid, unit='s').strftime(TIME_FORMAT)})
+    for i, column in enumerate(value_columns):
+        result[column] = values[:, i]
+    result[SAMPLE_FLAG] = flags
+    return result
+
+# Returns the coverage of a resampled day between DAY_START_TIME and DAY_END_TIME: the counts of grid points by
+# flag, the fraction that is measured and the longest run without a measured sample. Grid points of the window
+# before the first or after the last sample count as missing.
+def get_coverage(resampled, interval=DEFAULT_GRID_INTERVAL):
+    day = resampled[TIME].iloc[0][:10]
+    seconds, _ = local_seconds(resampled)
+    all_flags = resampled[SAMPLE_FLAG].to_numpy()
+    flags = pd.Series(all_flags, index=seconds).reindex(daytime_grid(day, interval), fill_value=MISSING).to_numpy()
+    measured = int((flags == MEASURED).sum())
+    interpolated = int((flags == INTERPOLATED).sum())
+    starts, ends = find_runs(flags != MEASURED)
+    longest = int((ends - starts).max()) if len(starts) else 0
+    return {GRID_POINTS: len(flags), MEASURED_POINTS: measured, INTERPOLATED_POINTS: interpolated,
+            MISSING_POINTS: len(flags) - measured - interpolated,
+            COVERAGE: daytime_coverage(seconds[all_flags == MEASURED], day, interval),
+            LONGEST_GAP: longest * interval / 60}
+
+def main():
+    # Imported here, compute_power uses this module.
+    from compute_power import list_raw_filenames
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--start", help="First date, e.g. 2022-09-01")
+    parser.add_argument("-e", "--end", help="Last date, e.g. 2022-09-30")
+    parser.add_argument("-i", "--interval", type=int, default=DEFAULT_GRID_INTERVAL, help="Grid interval in seconds")
+    parser.add_argument("--max_gap", type=int, default=DEFAULT_MAX_INTERPOLATED_GAP, help="Longest gap in seconds to interpolate, longer gaps are masked")
+    parser.add_argument("--no_interpolate", action='store_true', help="If present, mask all gaps")
+    parser.add_argument("-o", "--output", help="Write the resampled data of the date range to this csv file")
+    args = parser.parse_args()
+
+    rows = []
+    frames = []
+    for filename in list_raw_filenames(args.start, args.end):
+        resampled = resample_day(pd.read_csv(DATA_FILE_RELATIVE_DIR + filename), args.interval, args.max_gap,
+                                 not args.no_interpolate)
+        rows.append(dict(date=filename[:10], **get_coverage(resampled, args.interval)))
+        if args.output:
+            frames.append(resampled)
+    if not rows:
+        raise Exception("No raw data files in the date range")
+    if args.output:
+        pd.concat(frames, ignore_index=True).to_csv(args.output, index=False)
+    print(pd.DataFrame(rows).set_index('date').round(3).to_string())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+Sensor backends used by collect_sensor_data.py.
+
+A backend initializes the sensors once and is then read many times. HardwareSensorBackend reads the sensors
+of the Raspberry Pi:
+    - DS18B20 1-wire temperature sensor on the back of the module
+    - INA219 voltage/current/power sensor on I2C address 0x40
+    - Apogee SP-110-SS pyranometer read by the ADS1115 ADC on channel P3
+The hardware libraries are only imported when HardwareSensorBackend is created, so that the collector can
+run with FakeSensorBackend on a machine without I2C or 1-wire.
+
+ConcurrentSensorReader reads the sensors of a backend concurrently and records when each reading was taken.
+"""
+
+import math
+import random
+from abc import ABC, abstractmethod
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+from constants import *
+from instrumentation import timer, count
+
+# Seconds to wait for a sensor reading before giving up on it for the current sample.
+DEFAULT_SENSOR_TIMEOUT = 2.0
+# A cached temperature reading is used if it is at most this many seconds old.
+DEFAULT_TEMP_MAX_AGE = 60.0
+
+TEMP_SENSOR = 'temp'
+VIP_SENSOR = 'vip'
+IRRADIANCE_SENSOR = 'irradiance'
+SENSOR_TIMESTAMP_COLUMNS = {
+    TEMP_SENSOR: TEMPERATURE_TIMESTAMP,
+    VIP_SENSOR: VIP_TIMESTAMP,
+    IRRADIANCE_SENSOR: IRRADIANCE_TIMESTAMP,
+}
+
+# A backend must implement all three reads, a backend that misses one can't be created.
+class SensorBackend(ABC):
+    # Returns the module temperature in °C.
+    @abstractmethod
+    def get_temp(self):
+        pass
+
+    # Returns [voltage (V), current (A), power (W)].
+    @abstractmethod
+    def get_vip(self):
+        pass
+
+    # Returns the irradiance in W/m^2.
+    @abstractmethod
+    def get_irradiance(self):
+        pass
+
+class HardwareSensorBackend(SensorBackend):
+    def __init__(self):
+        import board
+        from adafruit_ina219 import ADCResolution, BusVoltageRange, INA219
+        from w1thermsensor import W1ThermSensor
+        import adafruit_ads1x15.ads1115 as ADS
+        from adafruit_ads1x15.analog_in import AnalogIn
+
+        i2c_bus = board.I2C()
+        self.ina = INA219(i2c_bus, addr=0x40)
+        self.ina.bus_adc_resolution = ADCResolution.ADCRES_12BIT_32S
+        self.ina.shunt_adc_resolution = ADCResolution.ADCRES_12BIT_32S
+        self.ina.bus_voltage_range = BusVoltageRange.RANGE_32V
+
+        self.temp_sensor = W1ThermSensor()
+
+        ads = ADS.ADS1115(i2c_bus)
+        ads.range = 16
+        self.irradiance_channel = AnalogIn(ads, ADS.P3)
+
+    def get_vip(self):
+        load_voltage = round(self.ina.bus_voltage, 2) # volts
+        current = round(self.ina.current / 1000, 2) # amps
+        power = round(self.ina.power, 2) # watts
+        return [load_voltage, current, power]
+
+    def get_temp(self):
+        temp = self.temp_sensor.get_temperature()
+        return round(temp, 2)
+
+    def get_irradiance(self):
+        voltage = self.irradiance_channel.voltage
+        if voltage < 0:
+            return 0.0
+        # Apogee SP-110-SS calibration factor is 5w/m^2 per mV
+        return round(voltage * 1000 * 5, 2)
+
+# Generates plausible readings for a clear day without any hardware, for testing the collector.
+# temp_delay simulates the conversion time of the DS18B20, which is up to 750ms.
+class FakeSensorBackend(SensorBackend):
+    def __init__(self, peak_irradiance=900, pdc0=30, seed=None, temp_delay=0.0):
+        self.peak_irradiance = peak_irradiance
+        self.pdc0 = pdc0
+        self.random = random.Random(seed)
+        self.temp_delay = temp_delay
+
+    # Irradiance follows a half sine between 06:00 and 18:00.
+    def get_irradiance(self):
+        now = datetime.now()
+        hour = now.hour + now.minute / 60 + now.second / 3600
+        irradiance = self.peak_irradiance * max(0.0, math.sin(math.pi * (hour - 6) / 12))
+        return round(irradiance * self.random.uniform(0.98, 1.02), 2)
+
+    def get_temp(self):
+        time.sleep(self.temp_delay)
+        return round(20 + self.get_irradiance() / 40 + self.random.uniform(-0.2, 0.2), 2)
+
+    def get_vip(self):
+        power = round(self.pdc0 * self.get_irradiance() / 1000 * 0.9, 2)
+        voltage = round(12 + 6 * min(1.0, power / self.pdc0) + self.random.uniform(-0.1, 0.1), 2)
+        current = round(power / voltage, 2)
+        return [voltage, current, power]
+
+# Reads the sensors of a backend in parallel threads, so that a slow sensor doesn't delay the others and the
+# readings of a sample are taken at about the same time. Each reading is timestamped with the midpoint of the
+# sensor read, in seconds since the epoch.
+#
+# The DS18B20 temperature conversion takes most of a second, while the module temperature changes slowly.
+# If cache_temp is True, the last temperature reading is returned while a new conversion runs in the
+# background, as long as it is at most temp_max_age seconds old.
+#
+# A reading that doesn't complete within timeout seconds, or that raises, is returned as None and counted in
+# errors and in the 'sensor errors' counter, labelled with the sensor and the reason (timeout or exception). The
+# message of the last exception of each sensor is kept in last_errors. Nothing is printed, so that the
+# collector's output stays one row per sample. A sensor isn't read again until its pending read completes.
+#
+# clock returns the current time in seconds since the epoch. It is replaced to replay historical data at a
+# different speed, see replay.py.
+class ConcurrentSensorReader:
+    def __init__(self, backend, timeout=DEFAULT_SENSOR_TIMEOUT, cache_temp=True, temp_max_age=DEFAULT_TEMP_MAX_AGE,
+                 clock=time.time):
+        self.timeout = timeout
+        self.clock = clock
+        self.cache_temp = cache_temp
+        self.temp_max_age = temp_max_age
+        self.read_functions = {
+            TEMP_SENSOR: backend.get_temp,
+            VIP_SENSOR: backend.get_vip,
+            IRRADIANCE_SENSOR: backend.get_irradiance,
+        }
+        self.executor = ThreadPoolExecutor(max_workers=len(self.read_functions))
+        self.pending = {}
+        self.last_temp = None
+        self.errors = {sensor: 0 for sensor in self.read_functions}
+        self.last_errors = {}
+
+    def timed_read(self, sensor, read_function):
+        with timer('sensor read', sensor=sensor):
+            start = self.clock()
+            value = read_function()
+            return value, (start + self.clock()) / 2
+
+    # Returns {sensor: (value, timestamp)} for TEMP_SENSOR, VIP_SENSOR and IRRADIANCE_SENSOR.
+    def read(self):
+        for sensor, read_function in self.read_functions.items():
+            if sensor not in self.pending:
+                self.pending[sensor] = self.executor.submit(self.timed_read, sensor, read_function)
+
+        use_cached_temp = (self.cache_temp and self.last_temp is not None
+                           and self.clock() - self.last_temp[1] <= self.temp_max_age)
+        waited = [f for sensor, f in self.pending.items() if not (sensor == TEMP_SENSOR and use_cached_temp)]
+        wait(waited, timeout=self.timeout)
+
+        readings = {}
+        for sensor in self.read_functions:
+            future = self.pending[sensor]
+            if not future.done():
+                readings[sensor] = (None, None)
+                continue
+            del self.pending[sensor]
+            try:
+                readings[sensor] = future.result()
+            except Exception as e:
+                self.last_errors[sensor] = str(e)
+                self.record_error(sensor, 'exception')
+                readings[sensor] = (None, None)
+
+        if readings[TEMP_SENSOR][0] is not None:
+            self.last_temp = readings[TEMP_SENSOR]
+        elif use_cached_temp:
+            readings[TEMP_SENSOR] = self.last_temp
+        for sensor, (value, timestamp) in readings.items():
+            if value is None and sensor in self.pending and not (sensor == TEMP_SENSOR and use_cached_temp):
+                self.record_error(sensor, 'timeout')
+        return readings
+
+    def record_error(self, sensor, reason):
+        self.errors[sensor] += 1
+        count('sensor errors', sensor=sensor, reason=reason)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+def create_backend(fake=False):
+    return FakeSensorBackend() if fake else HardwareSensorBackend()
@@ -0,0 +1,323 @@
+"""
+Local HTTP service for dashboards and scripts that need the data without parsing the csv files themselves.
+
+Endpoints:
+    /latest                      the latest sample of the collector, from the newest raw data file, as
+                                 {"<column>": value} in JSON
+    /day/<date>                  the processed series of a day, e.g. /day/2022-09-14. The service doesn't
+                                 process days: a day without a _processed.csv gets 404, and one that
+                                 compute_power.py -b would rebuild (see compute_power.rebuild_reason) gets
+                                 409. Query parameters:
+                                     columns   comma separated columns, defaults to all numeric columns
+                                     points    at most this many rows (a positive number), selected by
+                                               LTTB on each column
+    /metrics                     the daily metrics of daily_metrics.py. Query parameters: start, end (dates)
+Every endpoint takes format=json (the default) or format=binary.
+
+The other JSON responses are columnar: {"columns": [...], "data": {"<column>": [...]}}, with null for missing values.
+Binary responses are a 4 byte little-endian header length, a JSON header {"columns": [...], "rows": n} and
+then each column as n little-endian float64 values, in the order of columns, e.g. for a Float64Array. The
+series of a day always start with the timestamp column (unix seconds); rows without a timestamp are left
+out. The metrics start with the date as YYYYMMDD.
+
+Parsed days and encoded responses are kept in a memory-bounded LRU cache. An entry records the mtime and
+size of the files it was built from, including the processed manifest, config and calibration for the series
+of a day, and is rebuilt when one changes. The files are checked at most every CHECK_INTERVAL seconds, so a
+burst of requests, e.g. a dashboard refresh, is served from memory without touching the disk.
+
+Example usage: 'python serve.py -p 8080' then 'curl "localhost:8080/day/2022-09-14?columns=power%20smoothed,computed%20power&points=200"'
+"""
+
+import argparse
+import glob
+import json
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+import numpy as np
+import pandas as pd
+from constants import *
+from compute_power import PROCESSED_MANIFEST_FILE, load_manifest, rebuild_reason
+from site_config import Config
+from calibrate import read_calibrated_coefficient
+from daily_metrics import DailyMetricsTable, DATE, METRICS_COLUMNS
+import storage
+from downsample import lttb
+
+DEFAULT_PORT = 8080
+DEFAULT_CACHE_MB = 256
+# Seconds between checks of the files a cache entry was built from.
+CHECK_INTERVAL = 1.0
+# Bytes read from the end of a raw data file to find its last row.
+TAIL_BYTES = 4096
+JSON = 'json'
+BINARY = 'binary'
+CONTENT_TYPES = {JSON: 'application/json', BINARY: 'application/octet-stream'}
+
+# Raised for a request that can't be served, with the HTTP status to respond with.
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+# Returns (mtime_ns, size) of each file, None for a file that doesn't exist.
+def file_versions(paths):
+    versions = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            versions.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            versions.append(None)
+    return versions
+
+# LRU cache of values built from files, bounded by the total size of the values in bytes. Thread-safe.
+class FileCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # {key: [value, size, paths, versions, checked at]}
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Returns the value of key. build() returns (value, size in bytes, paths of the files it was built from)
+    # and is called if there is no entry, or one of the files changed.
+    def get(self, key, build):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                now = time.monotonic()
+                if now - entry[4] >= CHECK_INTERVAL and file_versions(entry[2]) == entry[3]:
+                    entry[4] = now
+                if now - entry[4] < CHECK_INTERVAL:
+                    self.entries.move_to_end(key)
+                    return entry[0]
+                self.remove(key)
+        value, size, paths = build()
+        # The versions are taken after building, so a change during the build is only caught by the next check.
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = [value, size, paths, file_versions(paths), time.monotonic()]
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                self.remove(next(iter(self.entries)))
+        return value
+
+    def remove(self, key):
+        self.total_bytes -= self.entries.pop(key)[1]
+
+class QueryService:
+    def __init__(self, cache_bytes=DEFAULT_CACHE_MB * 2**20):
+        self.cache = FileCache(cache_bytes)
+        self.metrics_lock = threading.Lock()
+        self.metrics_table = DailyMetricsTable()
+
+    # Returns the path of the newest raw data file, today's if it exists.
+    def latest_raw_path(self):
+        today = DATA_FILE_RELATIVE_DIR + date.today().strftime('%Y-%m-%d') + '.csv'
+        if os.path.exists(today):
+            return today
+        paths = [p for p in glob.glob(DATA_FILE_RELATIVE_DIR + '*.csv') if not p.endswith('_processed.csv')]
+        if not paths:
+            raise RequestError(404, "No raw data files")
+        return max(paths)
+
+    # Returns the last row of a raw data file with its header, as a dict. A last line without a newline is
+    # still being written by the collector and is ignored.
+    def read_latest(self, path):
+        with open(path, 'rb') as file:
+            header = file.readline().decode('utf-8').strip().split(',')
+            # Start at the newline before the tail, so that the rest of a line cut by the tail is skipped.
+            file.seek(max(file.tell(), os.fstat(file.fileno()).st_size - TAIL_BYTES) - 1)
+            tail = file.read()
+        tail = tail[tail.find(b'\n') + 1:tail.rfind(b'\n') + 1]
+        lines = [line for line in tail.decode('utf-8').splitlines() if line.strip()]
+        if not lines:
+            raise RequestError(404, f"{os.path.basename(path)} has no samples")
+        values = lines[-1].split(',')
+        sample = {}
+        for column, value in zip(header, values):
+            try:
+                sample[column] = value if column == TIME else float(value)
+            except ValueError:
+                sample[column] = None
+        return sample
+
+    def latest(self, fmt):
+        def build():
+            path = self.latest_raw_path()
+            sample = self.read_latest(path)
+            if fmt == JSON:
+                body = json.dumps(sample, separators=(',', ':')).encode('utf-8')
+            else:
+                columns = [c for c in sample if c != TIME]
+                body = encode_binary(columns, [np.array([np.nan if sample[c] is None else sample[c]]) for c in columns])
+            # Also rebuilt when a newer raw file appears.
+            return body, len(body), [path, DATA_FILE_RELATIVE_DIR]
+        return self.cache.get(('latest', fmt), build)
+
+    # Returns the path of the _processed.csv of a day if it is up to date, by the same rules as
+    # compute_power.py -b, with the grid interval it was built with.
+    def processed_path(self, day):
+        raw_fname = DATA_FILE_RELATIVE_DIR + day + '.csv'
+        processed_fname = DATA_FILE_RELATIVE_DIR + day + '_processed.csv'
+        if not os.path.exists(raw_fname):
+            if os.path.exists(processed_fname):
+                return processed_fname
+            raise RequestError(404, f"No data for {day}")
+        manifest = load_manifest()
+        grid_interval = manifest.get(day + '.csv', {}).get('grid_interval')
+        reason = rebuild_reason(day + '.csv', manifest, Config().hash(), read_calibrated_coefficient(), grid_interval)
+        if reason == 'not processed':
+            raise RequestError(404, f"{day} is not processed, run compute_power.py -d {day}")
+        if reason:
+            raise RequestError(409, f"{day} is out of date ({reason}), run compute_power.py -d {day}")
+        return processed_fname
+
+    # Returns the files the series of a day depend on.
+    def day_paths(self, day):
+        return [DATA_FILE_RELATIVE_DIR + day + '_processed.csv', DATA_FILE_RELATIVE_DIR + day + '.csv',
+                storage.day_filename(day, True), PROCESSED_MANIFEST_FILE, CONFIG_FILE, CALIBRATION_FILE]
+
+    # Returns the numeric columns of the processed data of a day, as {column: float64 array}, keeping the rows
+    # with a timestamp.
+    def day_columns(self, day):
+        def build():
+            self.processed_path(day)
+            df = storage.load_day(day, True)
+            df = df[df[TIMESTAMP].notna()]
+            columns = {TIMESTAMP: df[TIMESTAMP].to_numpy(dtype=np.float64)}
+            for column in df.columns:
+                if column not in [TIME, TIMESTAMP]:
+                    columns[column] = df[column].to_numpy(dtype=np.float64)
+            return columns, sum(values.nbytes for values in columns.values()), self.day_paths(day)
+        return self.cache.get(('day', day), build)
+
+    def day(self, day, columns, points, fmt):
+        check_date(day)
+        if points is not None and points <= 0:
+            raise RequestError(400, f"points must be positive, not {points}")
+        def build():
+            data = self.day_columns(day)
+            names = [TIMESTAMP] + [c for c in (columns or data) if c != TIMESTAMP]
+            unknown = [c for c in names if c not in data]
+            if unknown:
+                raise RequestError(400, f"Unknown columns: {', '.join(unknown)}")
+            values = [data[c] for c in names]
+            if points:
+                rows = select_rows(values[0], values[1:], points)
+                values = [v[rows] for v in values]
+            body = encode(names, values, fmt)
+            return body, len(body), self.day_paths(day)
+        return self.cache.get(('day', day, tuple(columns or []), points, fmt), build)
+
+    def metrics(self, start, end, fmt):
+        for value in [start, end]:
+            if value is not None:
+                check_date(value)
+        def build():
+            with self.metrics_lock:
+                df = self.metrics_table.query(start, end)
+                self.metrics_table.save()
+            dates = [float(d.replace('-', '')) for d in df.index]
+            names = [DATE] + METRICS_COLUMNS
+            values = [np.array(dates, dtype=np.float64)] + [df[c].to_numpy(dtype=np.float64) for c in METRICS_COLUMNS]
+            body = encode(names, values, fmt)
+            paths = [DATA_FILE_RELATIVE_DIR] + [DATA_FILE_RELATIVE_DIR + d + '_processed.csv' for d in df.index]
+            return body, len(body), paths
+        return self.cache.get(('metrics', start, end, fmt), build)
+
+# Raises a RequestError if value is not a date.
+def check_date(value):
+    try:
+        pd.Timestamp(value)
+    except ValueError:
+        raise RequestError(400, f"Invalid date {value}")
+
+# Returns the indices of at most points rows, the union of the rows selected by LTTB for each column.
+def select_rows(x, columns, points):
+    if len(x) <= points:
+        return np.arange(len(x))
+    per_column = max(3, points // max(1, len(columns)))
+    selected = [np.array([0, len(x) - 1])]
+    for y in columns:
+        valid = np.flatnonzero(~np.isnan(y))
+        selected.append(valid[lttb(x[valid], y[valid], per_column)])
+    return np.unique(np.concatenate(selected))
+
+def encode(columns, values, fmt):
+    if fmt == BINARY:
+        return encode_binary(columns, values)
+    data = {column: [None if np.isnan(v) else v for v in array.tolist()] for column, array in zip(columns, values)}
+    return json.dumps({'columns': columns, 'data': data}, separators=(',', ':')).encode('utf-8')
+
+def encode_binary(columns, values):
+    header = json.dumps({'columns': columns, 'rows': len(values[0]) if values else 0}).encode('utf-8')
+    return struct.pack('<I', len(header)) + header + b''.join(np.asarray(v, dtype='<f8').tobytes() for v in values)
+
+class RequestHandler(BaseHTTPRequestHandler):
+    service = None
+    verbose = False
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        fmt = query.get('format', JSON)
+        try:
+            if fmt not in CONTENT_TYPES:
+                raise RequestError(400, f"Unknown format {fmt}")
+            parts = [unquote(part) for part in url.path.strip('/').split('/')]
+            if parts == ['latest']:
+                body = self.service.latest(fmt)
+            elif len(parts) == 2 and parts[0] == 'day':
+                columns = query['columns'].split(',') if query.get('columns') else None
+                points = int(query['points']) if 'points' in query else None
+                body = self.service.day(parts[1], columns, points, fmt)
+            elif parts == ['metrics']:
+                body = self.service.metrics(query.get('start'), query.get('end'), fmt)
+            else:
+                raise RequestError(404, f"Unknown endpoint {url.path}")
+            self.respond(200, CONTENT_TYPES[fmt], body)
+        except RequestError as e:
+            self.respond(e.status, CONTENT_TYPES[JSON], json.dumps({'error': str(e)}).encode('utf-8'))
+        except ValueError as e:
+            self.respond(400, CONTENT_TYPES[JSON], json.dumps({'error': str(e)}).encode('utf-8'))
+
+    def respond(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default='127.0.0.1', help="Address to listen on, defaults to localhost only")
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument("--cache_mb", type=float, default=DEFAULT_CACHE_MB, help="Memory limit of the cache in MB")
+    parser.add_argument("-v", "--verbose", action='store_true', help="If present, log each request")
+    args = parser.parse_args()
+
+    RequestHandler.service = QueryService(int(args.cache_mb * 2**20))
+    RequestHandler.verbose = args.verbose
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    print(f'Serving on http://{args.host}:{args.port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+The site and PV system of config.json, used by the processing modules. It only depends on the standard library,
+so that modules low in the import chain, like solar_position_cache.py, can use it without importing
+compute_power.py.
+
+A fleet config (see fleet.py) lists "sites" and "arrays" instead of "location" and "pvsystem". Config is then
+the site and pvsystem of one array: the one named by PVMON_ARRAY (see constants.py), or the array given to
+Config(), or the first array of the config, so that the single array tools keep working on a fleet config.
+"""
+
+import hashlib
+import json
+from constants import *
+
+# Time zone of the local times of the data files, unless the site sets "timezone".
+DEFAULT_TIMEZONE = 'US/Pacific'
+LOCATION_FIELDS = ['latitude', 'longitude', 'altitude']
+PVSYSTEM_FIELDS = ['surface_tilt', 'surface_azimuth', 'pdc0', 'gamma_pdc']
+
+class Config:
+    def __init__(self, array=ARRAY):
+        with open(CONFIG_FILE, 'r') as file:
+            dict = json.load(file)
+        # The power coefficient of an array set in config.json, see calibrate.read_calibrated_coefficient.
+        self.power_coefficient = None
+        if 'arrays' not in dict:
+            if array is not None:
+                raise Exception(f"Array {array} is not in {CONFIG_FILE}, which has no arrays")
+            self.name = None
+            self.pvsystem = dict['pvsystem']
+            self.location = dict['location']
+            self.timezone = self.location.get('timezone', DEFAULT_TIMEZONE)
+            return
+        arrays = [a for a in dict['arrays'] if array is None or a['name'] == array]
+        if not arrays:
+            raise Exception(f"Array {array} is not in {CONFIG_FILE}")
+        site = dict['sites'][arrays[0]['site']]
+        self.name = arrays[0]['name']
+        self.pvsystem = {field: arrays[0][field] for field in PVSYSTEM_FIELDS}
+        self.location = {field: site[field] for field in LOCATION_FIELDS}
+        self.timezone = site.get('timezone', DEFAULT_TIMEZONE)
+        self.power_coefficient = arrays[0].get('power_coefficient')
+
+    # Returns a hash of the config fields that affect the computed results.
+    def hash(self):
+        fields = {'location': self.location, 'pvsystem': self.pvsystem}
+        # Only hashed when it isn't the default, so that the hash of the configs without one doesn't change.
+        if self.timezone != DEFAULT_TIMEZONE:
+            fields['timezone'] = self.timezone
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()[:16]
@@ -0,0 +1,224 @@
+"""
+Columnar binary storage for raw and processed day files.
+
+Each day is stored as one .npy file holding a structured array with one field per column, partitioned by
+month, so that loading a day doesn't parse any text and, as the file is memory-mapped, only the columns asked
+for are read:
+
+    ./store/raw/2022-09/2022-09-14.npy
+    ./store/processed/2022-09/2022-09-14.npy
+
+Writing a day only replaces that day's file, atomically, so the other days of the month are never rewritten.
+The columns are stored with the dtypes pandas reads from the csv file: int64 or float64 numbers, with NaN for
+missing values, and text columns (the time and the sample flag of resampled days) as bytes with a mask field
+of the missing values. A day read from the store is equal to the DataFrame pd.read_csv returns for the csv
+file it was converted from, including processed days resampled with --grid. The processed days written by
+compute_power.py hold the values as computed, which can differ in the last bit from the values parsed from the
+text of the _processed.csv.
+
+A stored day is given the mtime of the csv file it was built from. The loaders (load_day and read_range, used
+by compute_power.py, calibrate.py, daily_metrics.py, plot.py, serve.py, detect_anomalies.py and
+compare_models.py) read a day from the store if it is there and the csv file hasn't changed since, and from
+the csv file otherwise, e.g. today's file while the collector appends to it. compute_power.py writes each
+processed day to the store, next to its _processed.csv.
+
+Exported day files are written to ./store/export/ by default, not to ./data/, so that an export never replaces
+the original data. An existing file is never overwritten.
+
+Example usage: 'python storage.py -c' converts all csv files in ./data/ into ./store/
+               'python storage.py -x -d 2022-09-14' exports ./store/export/2022-09-14.csv from the store
+               'python storage.py -x -p -d 2022-09-14' exports ./store/export/2022-09-14_processed.csv from the store
+"""
+
+import argparse
+import csv
+import glob
+import os
+import time
+import numpy as np
+import pandas as pd
+from constants import *
+
+RAW = 'raw'
+PROCESSED = 'processed'
+
+EXPORT_DIR = STORE_DIR + 'export/'
+# Field of the mask of missing values of a text column.
+MISSING_PREFIX = '__missing__'
+
+def kind_of(processed):
+    return PROCESSED if processed else RAW
+
+def day_filename(date, processed=False):
+    return STORE_DIR + kind_of(processed) + '/' + date[:7] + '/' + date + '.npy'
+
+def csv_filename(date, processed=False):
+    return DATA_FILE_RELATIVE_DIR + date + ('_processed.csv' if processed else '.csv')
+
+# Returns the dates of the days in the store.
+def list_dates(processed=False):
+    paths = glob.glob(STORE_DIR + kind_of(processed) + '/*/*.npy')
+    return sorted(os.path.basename(path)[:-4] for path in paths)
+
+# Returns the dates of the csv files in the data directory.
+def list_csv_dates(processed=False):
+    suffix = '_processed.csv' if processed else '.csv'
+    dates = []
+    for path in glob.glob(DATA_FILE_RELATIVE_DIR + '*' + suffix):
+        filename = os.path.basename(path)
+        if processed or not filename.endswith('_processed.csv'):
+            dates.append(filename[:10])
+    return sorted(dates)
+
+# Converts a day DataFrame, as read from a csv file, to a structured array. Text is stored as utf-8.
+def to_records(df):
+    arrays = {}
+    for column in df.columns:
+        values = df[column]
+        if values.dtype.kind in 'biuf':
+            arrays[column] = values.to_numpy()
+        else:
+            missing = values.isna().to_numpy()
+            arrays[column] = np.char.encode(values.where(~missing, '').to_numpy().astype(str), 'utf-8')
+            arrays[MISSING_PREFIX + column] = missing
+    records = np.empty(len(df), dtype=[(name, values.dtype) for name, values in arrays.items()])
+    for name, values in arrays.items():
+        records[name] = values
+    return records
+
+# Returns utf-8 bytes as str, through the faster ascii conversion when the text is ascii, like times.
+def decode(values):
+    try:
+        return values.astype(str)
+    except UnicodeDecodeError:
+        return np.char.decode(values, 'utf-8')
+
+# Writes the data of a day into the store, replacing any data already stored for that date. source is the csv
+# file the data was read from or written to. The stored day is given its mtime, to detect when the store is out
+# of date.
+def write_day(df, date, processed=False, source=None):
+    fname = day_filename(date, processed)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    # Write to a temporary file first so that readers never see a partial day.
+    tmp_fname = f'{fname}.{os.getpid()}.tmp'
+    with open(tmp_fname, 'wb') as file:
+        np.save(file, to_records(df))
+    if source:
+        os.utime(tmp_fname, ns=(time.time_ns(), os.stat(source).st_mtime_ns))
+    os.replace(tmp_fname, fname)
+
+# Returns whether a day is stored, and if source is given, that file hasn't changed since the day was stored.
+def is_stored(date, processed=False, source=None):
+    fname = day_filename(date, processed)
+    if not os.path.exists(fname):
+        return False
+    return not source or os.stat(fname).st_mtime_ns == os.stat(source).st_mtime_ns
+
+# Returns the stored data of a day, or None if the day isn't stored. Only the given columns are read if columns
+# is not None; they are returned in the stored order, like pd.read_csv(..., usecols=columns). If source is given,
+# None is also returned if that file has changed since the day was stored.
+def read_stored_day(date, processed=False, columns=None, source=None):
+    if not is_stored(date, processed, source):
+        return None
+    fname = day_filename(date, processed)
+    records = np.load(fname, mmap_mode='r')
+    stored_columns = [c for c in records.dtype.names if not c.startswith(MISSING_PREFIX)]
+    if columns is not None:
+        unknown = set(columns) - set(stored_columns)
+        if unknown:
+            raise Exception(f"{fname} has no columns {', '.join(sorted(unknown))}")
+        stored_columns = [c for c in stored_columns if c in columns]
+    data = {}
+    for column in stored_columns:
+        values = records[column]
+        if values.dtype.kind == 'S':
+            values = decode(values).astype(object)
+            values[records[MISSING_PREFIX + column]] = np.nan
+        else:
+            values = np.array(values)
+        data[column] = values
+    return pd.DataFrame(data, columns=stored_columns)
+
+# Returns the data of a day like pd.read_csv of its csv file, from the store if the day is stored and its csv
+# file hasn't changed since, or is gone. Returns None if there is no data for the day.
+def load_day(date, processed=False, columns=None):
+    fname = csv_filename(date, processed)
+    has_csv = os.path.exists(fname)
+    df = read_stored_day(date, processed, columns, fname if has_csv else None)
+    if df is None and has_csv:
+        df = pd.read_csv(fname, usecols=columns)
+    return df
+
+# Returns the columns of a day that load_day would return, without reading the data. Returns [] if there is no
+# data for the day.
+def load_day_columns(date, processed=False):
+    fname = csv_filename(date, processed)
+    has_csv = os.path.exists(fname)
+    if is_stored(date, processed, fname if has_csv else None):
+        names = np.load(day_filename(date, processed), mmap_mode='r').dtype.names
+        return [name for name in names if not name.startswith(MISSING_PREFIX)]
+    if not has_csv:
+        return []
+    with open(fname, 'r', newline='', encoding='utf-8') as file:
+        return next(csv.reader(file), [])
+
+# Returns the data of all days from start_date to end_date (inclusive, e.g. '2022-09-14') as one DataFrame,
+# each day loaded by load_day. Either bound may be None.
+def read_range(start_date=None, end_date=None, processed=False, columns=None):
+    dates = sorted(set(list_dates(processed)) | set(list_csv_dates(processed)))
+    frames = [load_day(date, processed, columns) for date in dates
+              if (start_date is None or date >= start_date) and (end_date is None or date <= end_date)]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
+
+# Writes the data of a day in the store to a csv file in the same format as the collected and processed files,
+# by default in EXPORT_DIR. Raises an exception if the file exists.
+def export_csv(date, processed=False, fname=None):
+    if fname is None:
+        fname = EXPORT_DIR + date + ('_processed.csv' if processed else '.csv')
+    if os.path.exists(fname):
+        raise Exception(f"{fname} already exists")
+    df = read_stored_day(date, processed)
+    if df is None:
+        raise Exception(f"{date} is not in the store")
+    os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+    with open(fname, 'x', newline='') as file:
+        df.to_csv(file, index=False)
+    return fname
+
+# Converts the raw and processed csv files in the data directory into the store. Days that are stored and
+# whose csv file hasn't changed are skipped.
+def convert_data_dir():
+    converted = 0
+    skipped = 0
+    for processed in [False, True]:
+        for date in list_csv_dates(processed):
+            fname = csv_filename(date, processed)
+            if read_stored_day(date, processed, [], fname) is not None:
+                skipped += 1
+                continue
+            write_day(pd.read_csv(fname), date, processed, fname)
+            converted += 1
+    print(f'{converted} files converted, {skipped} up to date')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--convert", action='store_true', help="If present, convert all csv files in the data directory into the store")
+    parser.add_argument("-x", "--export", action='store_true', help="If present, export the day given by -d from the store to a csv file")
+    parser.add_argument("-d", "--date", help="The date to export, e.g. 2022-09-14")
+    parser.add_argument("-p", "--processed", action='store_true', help="If present, export processed data instead of raw data")
+    parser.add_argument("-o", "--output", help=f"Output filename of the export, must not exist. Defaults to the file of the date in {EXPORT_DIR}")
+    args = parser.parse_args()
+
+    if args.convert:
+        convert_data_dir()
+    elif args.export:
+        if not args.date:
+            raise Exception("Option -d must be specified")
+        print(export_csv(args.date, args.processed, args.output))
+    else:
+        raise Exception("Option -c or -x must be specified")
+
+if __name__ == "__main__":
+    main()
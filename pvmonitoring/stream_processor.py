@@ -0,0 +1,238 @@
+"""
+Streaming processor that computes the derived values of each sample as it arrives, instead of re-reading
+the whole day file like compute_power.process does.
+
+Rows are fed one at a time. The processor keeps a ring buffer of the last few rows and:
+    - fixes MPPT dips with the find_mppt_dips and neighbour_mean of fix_mppt_dips. A row can be fixed when
+      the next row arrives.
+    - smooths the fixed data with the smoothed_mean of the rows of the centered window, like
+      add_smoothed_data. A row can be smoothed when the row (window - 1) // 2 rows after it has been fixed.
+    - evaluates the IAM and pvwatts model for the smoothed row like compute_power, with scalar math
+      (compute_power.compute_row_power).
+So a processed row is output with a fixed lag of 1 + (window - 1) // 2 rows, 3 rows for the default window.
+The work per row doesn't depend on the length of the day. As the dip fix and the smoothing use the routines
+of the batch preprocessing on the same values, the output is equal to the processed data computed by
+compute_power.process for the same rows.
+
+Example usage: 'python stream_processor.py -d 2022-09-14 -k' replays 2022-09-14.csv and checks that the
+                   output matches compute_power.process.
+               'python stream_processor.py -t' follows today's data file as the collector appends to it
+                   and prints the measured and computed power of each processed row.
+"""
+
+import argparse
+import csv
+import math
+import os
+import time
+from collections import deque
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from constants import *
+from calibrate import read_calibrated_coefficient
+from compute_power import compute_row_power, process_df
+from site_config import Config
+from preprocess_data import SMOOTHED_COLUMNS, find_mppt_dips, neighbour_mean, smoothed_mean, window_extent
+
+# Seconds between polls of the data file in tail mode.
+TAIL_POLL_INTERVAL = 1.0
+# Columns fixed by the MPPT dip fix.
+DIP_COLUMNS = [POWER, VOLTAGE, CURRENT]
+
+# Processes the rows of one or more days. Call update() for each new row; it returns the processed rows that
+# became ready, as dicts with the columns of the processed data files. When a row of a new day arrives, the
+# remaining rows of the previous day are output first. Call flush() at the end of the data to output the
+# remaining rows.
+class StreamProcessor:
+    def __init__(self, power_coefficient, config=None, window=SMOOTH_DATA_WINDOW_SIZE):
+        self.power_coefficient = power_coefficient
+        self.config = Config() if config is None else config
+        self.window = window
+        self.after = window_extent(window)[1]
+        self.reset()
+
+    def reset(self):
+        self.date = None
+        self.raw = deque(maxlen=3)          # the last 3 raw rows, to fix the dips
+        self.fixed = deque()                # fixed rows from self.removed on, waiting to be smoothed or removed
+        self.received = 0                   # number of rows of the day received
+        self.removed = 0                    # number of fixed rows that left the window
+        self.output = 0                     # number of rows output
+
+    def update(self, row):
+        ready = []
+        date = row[TIME][:10]
+        if self.date is not None and date != self.date:
+            ready = self.flush()
+        self.date = date
+
+        self.raw.append(row)
+        self.received += 1
+        if len(self.raw) == 3:
+            # The previous row can be fixed now that the row after it has arrived.
+            self.fixed[-1] = self.fix_mppt_dip(*self.raw)
+        # The new row is kept unfixed until the row after it arrives, or it is the last row of the day.
+        self.fixed.append(dict(row))
+        return ready + self.smooth_ready_rows(final=False)
+
+    def flush(self):
+        if self.date is None:
+            return []
+        ready = self.smooth_ready_rows(final=True)
+        self.reset()
+        return ready
+
+    # Returns a copy of row, the middle one of 3 consecutive raw rows, with the MPPT dip fixed if it is one.
+    @staticmethod
+    def fix_mppt_dip(previous_row, row, next_row):
+        fixed = dict(row)
+        rows = [previous_row, row, next_row]
+        def values(column):
+            return np.array([r[column] for r in rows], dtype=float)
+        if find_mppt_dips(values(IRRADIANCE), values(POWER))[1]:
+            for column in DIP_COLUMNS:
+                fixed[column] = float(neighbour_mean(values(column))[1])
+        return fixed
+
+    # Smooths and outputs the rows whose windows are complete. Only rows that can no longer be changed by a
+    # dip fix are used: all rows but the last one, or all rows if final.
+    def smooth_ready_rows(self, final):
+        ready = []
+        available = self.received if final else self.received - 1
+        while self.output < self.received and (final or self.output + self.after < available):
+            i = self.output
+            end = min(i + self.after + 1, available)
+            start = max(0, i + self.after + 1 - self.window)
+            while self.removed < start:
+                self.fixed.popleft()
+                self.removed += 1
+            rows = [self.fixed[j - self.removed] for j in range(start, end)]
+            processed = dict(self.fixed[i - self.removed])
+            means = smoothed_mean(np.array([row[column] for column in SMOOTHED_COLUMNS], dtype=float) for row in rows)
+            for smoothed_column, mean in zip(SMOOTHED_COLUMNS.values(), means):
+                processed[smoothed_column] = float(mean)
+            ready.append(self.add_model_values(processed))
+            self.output += 1
+        return ready
+
+    def add_model_values(self, row):
+        row[IAM_FACTOR], row[PVWATTS_POWER], row[COMPUTED_POWER] = compute_row_power(
+            row[IRRADIANCE_SMOOTHED], row[TEMPERATURE_SMOOTHED], row[TIME], self.power_coefficient, self.config)
+        return row
+
+# Converts a row read by csv.DictReader to the types of the columns.
+def parse_row(row):
+    parsed = {}
+    for column, value in row.items():
+        if column == TIME:
+            parsed[column] = value
+        elif value == '':
+            parsed[column] = math.nan
+        else:
+            parsed[column] = float(value)
+    if parsed.get(TIMESTAMP) == parsed.get(TIMESTAMP):
+        parsed[TIMESTAMP] = int(parsed[TIMESTAMP])
+    return parsed
+
+# Replays a raw data file through a StreamProcessor. Returns the processed rows as a DataFrame.
+def replay(filename, power_coefficient, config=None, window=SMOOTH_DATA_WINDOW_SIZE):
+    df = pd.read_csv(DATA_FILE_RELATIVE_DIR + filename)
+    processor = StreamProcessor(power_coefficient, config, window)
+    rows = []
+    for row in df.to_dict('records'):
+        rows += processor.update(row)
+    rows += processor.flush()
+    return pd.DataFrame(rows, columns=list(df.columns) + DERIVED_DATA_COLUMN_NAMES)
+
+# Returns the columns on which the replayed output differs from compute_power.process_df.
+def check_replay(filename, power_coefficient, config=None, window=SMOOTH_DATA_WINDOW_SIZE):
+    config = Config() if config is None else config
+    expected = process_df(pd.read_csv(DATA_FILE_RELATIVE_DIR + filename), power_coefficient, config, window)
+    actual = replay(filename, power_coefficient, config, window)
+    if len(expected) != len(actual):
+        return list(expected.columns)
+    mismatched = []
+    for column in expected.columns:
+        if column == TIME:
+            if not expected[column].equals(actual[column]):
+                mismatched.append(column)
+        elif not np.array_equal(actual[column].to_numpy(dtype=float), expected[column].to_numpy(dtype=float),
+                                equal_nan=True):
+            mismatched.append(column)
+    return mismatched
+
+# Follows a data file as rows are appended to it and prints each processed row. Moves on to the next day's
+# file when it is created.
+def tail(power_coefficient):
+    processor = StreamProcessor(power_coefficient)
+    filename = None
+    file = None
+    reader = None
+    try:
+        while True:
+            today = DATA_FILE_RELATIVE_DIR + datetime.now().strftime("%Y-%m-%d.csv")
+            if today != filename and os.path.exists(today):
+                if file:
+                    file.close()
+                    for row in processor.flush():
+                        print_row(row)
+                filename = today
+                # Binary, so that the file can be seeked back by the length of a partial line.
+                file = open(filename, 'rb')
+                reader = None
+            line = file.readline() if file else b''
+            # Only complete lines are processed, the collector may be writing the current one.
+            if not line.endswith(b'\n'):
+                if line:
+                    file.seek(-len(line), os.SEEK_CUR)
+                time.sleep(TAIL_POLL_INTERVAL)
+                continue
+            line = line.decode('utf-8')
+            if reader is None:
+                reader = next(csv.reader([line]))
+                continue
+            row = parse_row(dict(zip(reader, next(csv.reader([line])))))
+            for processed in processor.update(row):
+                print_row(processed)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if file:
+            file.close()
+
+def print_row(row):
+    print(f'{row[TIME]} measured power: {row[POWER_SMOOTHED]:6.2f}W computed power: {row[COMPUTED_POWER]:6.2f}W')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--dates", default='', help="Comma separated dates of the data files to replay, e.g. 2022-09-14,2022-09-15")
+    parser.add_argument("-c", "--power_coef", type=float, help="power coefficient to adjust pvwatts power, defaults to the coefficient in config/calibration.json, like compute_power.py")
+    parser.add_argument("-k", "--check", action='store_true', help="If present, check that the replayed output matches compute_power")
+    parser.add_argument("-t", "--tail", action='store_true', help="If present, follow today's data file and print processed rows")
+    args = parser.parse_args()
+    power_coefficient = args.power_coef if args.power_coef is not None else read_calibrated_coefficient()
+
+    if args.tail:
+        tail(power_coefficient)
+        return
+    if not args.dates:
+        raise Exception("Option -d or -t must be specified")
+
+    config = Config()
+    failed = 0
+    for date in args.dates.split(','):
+        filename = date + '.csv'
+        if args.check:
+            mismatched = check_replay(filename, power_coefficient, config)
+            if mismatched:
+                failed += 1
+            print(filename, 'MISMATCH ' + str(mismatched) if mismatched else 'OK')
+        else:
+            df = replay(filename, power_coefficient, config)
+            print(df[[TIME, POWER_SMOOTHED, COMPUTED_POWER]].to_string(index=False))
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
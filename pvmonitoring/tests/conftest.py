@@ -0,0 +1,13 @@
+# The modules are scripts run from the pvmonitoring directory. The tests import them with the bundled data and
+# config directories, and a temporary cache and store, set before constants.py is imported.
+import os
+import sys
+import tempfile
+
+PVMONITORING_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PVMONITORING_DIR)
+os.environ['PVMON_DATA_DIR'] = os.path.join(PVMONITORING_DIR, 'data', '')
+os.environ['PVMON_CONFIG_DIR'] = os.path.join(PVMONITORING_DIR, 'config', '')
+_scratch_dir = tempfile.mkdtemp(prefix='pvmonitoring-tests-')
+os.environ['PVMON_CACHE_DIR'] = os.path.join(_scratch_dir, 'cache', '')
+os.environ['PVMON_STORE_DIR'] = os.path.join(_scratch_dir, 'store', '')
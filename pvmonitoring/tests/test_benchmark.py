@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+from benchmark import compare_with_baseline, generate_day
+from constants import *
+from preprocess_data import preprocess_data
+from site_config import Config
+
+def test_synthetic_day_looks_like_a_data_file():
+    df = generate_day('2022-06-21', 60, Config(), np.random.default_rng(0))
+    assert list(df.columns) == RAW_DATA_COLUMN_NAMES
+    assert len(df) == 13 * 60 + 1
+    assert df[TIME].is_monotonic_increasing
+    assert (df[IRRADIANCE] >= 0).all() and (df[POWER] >= 0).all()
+    assert df[IRRADIANCE].max() > 800
+
+    # Every MPPT sweep dips the power, and preprocessing fixes the dips.
+    noon_sweep = df[df[TIME].str[11:16] == '12:00'].index[0]
+    assert df[POWER][noon_sweep] < 0.7 * df[POWER][noon_sweep + 1]
+    fixed = preprocess_data(df.copy())
+    assert fixed[POWER][noon_sweep] > 0.9 * fixed[POWER][noon_sweep + 1]
+
+def test_synthetic_day_gaps():
+    df = generate_day('2022-06-21', 60, Config(), np.random.default_rng(0), gaps=0.2)
+    assert 0.7 * 781 < len(df) <= 0.8 * 781
+    assert pd.to_datetime(df[TIME]).diff().max() >= pd.Timedelta(minutes=5)
+
+def test_regressions_against_baseline():
+    def results(rows_per_second):
+        return {'parameters': {'days': 1}, 'stages': {'csv load': {'rows_per_second': rows_per_second}},
+                'pipeline': {'rows_per_second': 1000}}
+    assert compare_with_baseline(results(700), results(1000)) == ['csv load']
+    assert compare_with_baseline(results(900), results(1000)) == []
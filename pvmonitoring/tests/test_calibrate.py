@@ -0,0 +1,32 @@
+import pandas as pd
+import pytest
+from calibrate import CALIBRATION_COLUMNS, DayStatsCache, calibrate, linear_regression, rolling_calibrate
+from constants import *
+
+CALIBRATION_DATES = ['2022-08-30', '2022-08-31', '2022-09-01', '2022-09-02']
+
+def load_days(dates):
+    return pd.concat([pd.read_csv(DATA_FILE_RELATIVE_DIR + date + '_processed.csv', usecols=CALIBRATION_COLUMNS)
+                      for date in dates], ignore_index=True)
+
+def test_fit_from_day_stats_matches_fit_on_all_rows(tmp_path):
+    cache = DayStatsCache(str(tmp_path / 'calibration_stats.json'))
+    coefficient, stats = calibrate(CALIBRATION_DATES, cache)
+    assert coefficient == pytest.approx(linear_regression(load_days(CALIBRATION_DATES)), rel=1e-12)
+    assert stats['n'] == sum(cache.get(date + '_processed.csv')['n'] for date in CALIBRATION_DATES)
+
+def test_saved_day_stats_are_reused(tmp_path):
+    fname = str(tmp_path / 'calibration_stats.json')
+    cache = DayStatsCache(fname)
+    coefficient, _ = calibrate(CALIBRATION_DATES, cache)
+    cache.save()
+
+    reloaded = DayStatsCache(fname)
+    assert calibrate(CALIBRATION_DATES, reloaded)[0] == coefficient
+    assert not reloaded.changed
+
+def test_rolling_fit_uses_the_last_days(tmp_path):
+    cache = DayStatsCache(str(tmp_path / 'calibration_stats.json'))
+    results = rolling_calibrate(CALIBRATION_DATES, cache, 2)
+    assert [days for _, _, days in results] == [1, 2, 2, 2]
+    assert results[-1][1] == pytest.approx(linear_regression(load_days(CALIBRATION_DATES[-2:])), rel=1e-12)
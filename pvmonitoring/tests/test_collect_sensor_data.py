@@ -0,0 +1,83 @@
+import os
+import signal
+import threading
+import time
+from datetime import datetime
+import pandas as pd
+from collect_sensor_data import BufferedRowWriter, run_daemon
+from constants import *
+from sensors import ConcurrentSensorReader, FakeSensorBackend, SENSOR_TIMESTAMP_COLUMNS, VIP_SENSOR
+
+# A VIP read that takes READ_SECONDS, a good part of the sample interval.
+READ_SECONDS = 0.03
+
+class SlowVipBackend(FakeSensorBackend):
+    def get_vip(self):
+        time.sleep(READ_SECONDS)
+        return super().get_vip()
+
+class ListWriter:
+    def __init__(self):
+        self.rows = []
+
+    def write(self, dict):
+        self.rows.append(dict)
+
+    def flush(self):
+        pass
+
+def test_schedule_does_not_drift():
+    interval = 0.1
+    writer = ListWriter()
+    reader = ConcurrentSensorReader(SlowVipBackend(seed=1))
+    try:
+        samples, missed = run_daemon(reader, interval, writer, max_samples=8)
+    finally:
+        reader.close()
+    assert (samples, missed) == (8, 0)
+    times = [row[SENSOR_TIMESTAMP_COLUMNS[VIP_SENSOR]] for row in writer.rows]
+    # Taking READ_SECONDS per sample on top of the interval would put the last sample 0.21 seconds late.
+    for k, t in enumerate(times):
+        assert abs(t - times[0] - k * interval) < 0.025
+
+def test_rows_of_a_new_day_go_to_a_new_file(tmp_path):
+    # The samples are taken 0.15 and 0.05 seconds before midnight, and 0.05 and 0.15 seconds after.
+    midnight = datetime(2030, 1, 1).timestamp()
+    start = time.time()
+    reader = ConcurrentSensorReader(FakeSensorBackend(seed=1), clock=lambda: midnight - 0.15 + time.time() - start)
+    writer = BufferedRowWriter(flush_rows=100, data_dir=str(tmp_path) + '/')
+    try:
+        run_daemon(reader, 0.1, writer, max_samples=4)
+    finally:
+        reader.close()
+    first_day = pd.read_csv(tmp_path / '2029-12-31.csv')
+    second_day = pd.read_csv(tmp_path / '2030-01-01.csv')
+    assert len(first_day) == 2 and len(second_day) == 2
+    assert first_day[TIME].str.startswith('2029-12-31').all()
+    assert second_day[TIME].str.startswith('2030-01-01').all()
+
+def test_sigterm_stops_the_wait_and_flushes_the_buffered_rows(tmp_path):
+    handler = signal.getsignal(signal.SIGTERM)
+    writer = BufferedRowWriter(flush_rows=100, data_dir=str(tmp_path) + '/')
+    reader = ConcurrentSensorReader(FakeSensorBackend(seed=1))
+    threading.Timer(0.3, os.kill, (os.getpid(), signal.SIGTERM)).start()
+    start = time.monotonic()
+    try:
+        samples, _ = run_daemon(reader, 30, writer)
+    finally:
+        reader.close()
+    assert time.monotonic() - start < 5
+    assert samples == 1
+    rows = pd.concat([pd.read_csv(tmp_path / fname) for fname in os.listdir(tmp_path)])
+    assert len(rows) == 1
+    assert signal.getsignal(signal.SIGTERM) == handler
+
+def test_stop_event():
+    stop_event = threading.Event()
+    threading.Timer(0.2, stop_event.set).start()
+    reader = ConcurrentSensorReader(FakeSensorBackend(seed=1))
+    try:
+        samples, _ = run_daemon(reader, 30, stop_event=stop_event)
+    finally:
+        reader.close()
+    assert samples == 1
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+import pvlib
+from compare_models import IAM_MODELS, TEMPERATURE_MODELS, compute_variants, get_aoi, load_samples
+from constants import *
+from site_config import Config
+
+def test_broadcast_equals_a_loop_over_the_models():
+    df = load_samples(['2022-09-14', '2022-09-15'])
+    config = Config()
+    variants, computed = compute_variants(df, config, list(IAM_MODELS), list(TEMPERATURE_MODELS), 0.9)
+    assert len(variants) == len(IAM_MODELS) * len(TEMPERATURE_MODELS)
+    aoi = get_aoi(df[TIME], config)
+    irradiance = df[IRRADIANCE_SMOOTHED].to_numpy(dtype=float)
+    temperature = df[TEMPERATURE_SMOOTHED].to_numpy(dtype=float)
+    for (iam_model, temperature_model), variant in zip(variants, computed):
+        iam = np.asarray(IAM_MODELS[iam_model](aoi), dtype=float)
+        temp_cell = np.asarray(TEMPERATURE_MODELS[temperature_model](irradiance, temperature), dtype=float)
+        pvwatts_dc = pvlib.pvsystem.pvwatts_dc(iam * irradiance, temp_cell, config.pvsystem['pdc0'],
+                                               gamma_pdc=config.pvsystem['gamma_pdc'])
+        np.testing.assert_array_equal(variant, np.round(pvwatts_dc * 0.9, 2))
+
+def test_local_times_are_in_the_site_timezone():
+    pacific = Config()
+    mountain = Config()
+    mountain.timezone = 'US/Mountain'
+    time = pd.Series(pd.date_range('2022-09-14 08:00', '2022-09-14 17:00', freq='30min'))
+    # 9:00 in Denver's time zone is 8:00 in Cupertino's.
+    np.testing.assert_allclose(get_aoi(time, mountain), get_aoi(time - pd.Timedelta(hours=1), pacific))
@@ -0,0 +1,71 @@
+import json
+import os
+import shutil
+import pytest
+import calibrate
+import site_config
+from compute_power import manifest_entry, processed_filename_for, rebuild_reason
+from constants import *
+
+FILENAME = '2022-09-14.csv'
+
+# A data directory with a raw day and its processed file, a copy of the config and a calibration file, in
+# tmp_path. Returns the data directory.
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    data_dir = str(tmp_path / 'data') + '/'
+    os.makedirs(data_dir)
+    shutil.copy(DATA_FILE_RELATIVE_DIR + FILENAME, data_dir)
+    shutil.copy(DATA_FILE_RELATIVE_DIR + processed_filename_for(FILENAME), data_dir)
+    # The processed file is written after the raw one.
+    os.utime(data_dir + FILENAME, (1e9, 1e9))
+    os.utime(data_dir + processed_filename_for(FILENAME), (1.5e9, 1.5e9))
+    shutil.copy(CONFIG_FILE, tmp_path / 'config.json')
+    monkeypatch.setattr(site_config, 'CONFIG_FILE', str(tmp_path / 'config.json'))
+    monkeypatch.setattr(calibrate, 'CALIBRATION_FILE', str(tmp_path / 'calibration.json'))
+    calibrate.write_calibrated_coefficient(0.9, ['2022-09-14'])
+    return data_dir
+
+# Returns the rebuild reason of FILENAME with the current config and calibration.
+def current_reason(manifest, data_dir):
+    return rebuild_reason(FILENAME, manifest, site_config.Config().hash(), calibrate.read_calibrated_coefficient(),
+                          data_dir=data_dir)
+
+# Returns a manifest recording FILENAME as processed with the current config and calibration.
+def current_manifest():
+    return {FILENAME: manifest_entry(site_config.Config().hash(), calibrate.read_calibrated_coefficient())}
+
+def test_up_to_date(data_dir):
+    assert current_reason(current_manifest(), data_dir) is None
+    assert current_reason({}, data_dir) == 'unknown provenance'
+
+def test_config_changed(data_dir):
+    manifest = current_manifest()
+    with open(site_config.CONFIG_FILE, 'r') as file:
+        config = json.load(file)
+    config['pvsystem']['surface_tilt'] += 5
+    with open(site_config.CONFIG_FILE, 'w') as file:
+        json.dump(config, file)
+    assert current_reason(manifest, data_dir) == 'config changed'
+
+def test_calibration_changed(data_dir):
+    manifest = current_manifest()
+    calibrate.write_calibrated_coefficient(0.85, ['2022-09-14', '2022-09-15'])
+    assert current_reason(manifest, data_dir) == 'power coefficient changed'
+
+def test_grid_interval_changed(data_dir):
+    manifest = current_manifest()
+    reason = rebuild_reason(FILENAME, manifest, site_config.Config().hash(), calibrate.read_calibrated_coefficient(),
+                            grid_interval=60, data_dir=data_dir)
+    assert reason == 'grid interval changed'
+
+def test_raw_file_changed(data_dir):
+    manifest = current_manifest()
+    with open(data_dir + FILENAME, 'a') as file:
+        file.write('1663200000,2022-09-14 17:00:00,20.0,0.0,12.0,0.0,0.0\n')
+    assert current_reason(manifest, data_dir) == 'raw data changed'
+
+def test_missing_output(data_dir):
+    manifest = current_manifest()
+    os.remove(data_dir + processed_filename_for(FILENAME))
+    assert current_reason(manifest, data_dir) == 'not processed'
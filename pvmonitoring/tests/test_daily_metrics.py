@@ -0,0 +1,69 @@
+import os
+import shutil
+import pandas as pd
+import pytest
+import daily_metrics
+from constants import *
+from daily_metrics import DailyMetricsTable, MEASURED_ENERGY, SAMPLES, VERSION
+
+DATES = ['2022-09-14', '2022-12-20']
+
+# A data directory with the processed files of DATES, and the list of the dates whose metrics are computed.
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    data_dir = str(tmp_path / 'data') + '/'
+    os.makedirs(data_dir)
+    for date in DATES:
+        shutil.copy(DATA_FILE_RELATIVE_DIR + date + '_processed.csv', data_dir)
+    computed = []
+    read_day_metrics = daily_metrics.read_day_metrics
+    monkeypatch.setattr(daily_metrics, 'read_day_metrics',
+                        lambda date, data_dir: computed.append(date) or read_day_metrics(date, data_dir))
+    return data_dir, computed
+
+def test_rows_are_recomputed_when_the_file_changes(data_dir, tmp_path):
+    data_dir, computed = data_dir
+    fname = str(tmp_path / 'daily_metrics.csv')
+    table = DailyMetricsTable(fname, data_dir)
+    first = table.query()
+    table.save()
+    assert computed == DATES
+    assert first.index.tolist() == DATES
+
+    # Saved rows are not computed again.
+    table = DailyMetricsTable(fname, data_dir)
+    pd.testing.assert_frame_equal(table.query(), first)
+    assert computed == DATES
+
+    # Half of the rows are removed: the size changes.
+    path = data_dir + DATES[0] + '_processed.csv'
+    df = pd.read_csv(path)
+    df.iloc[:len(df) // 2].to_csv(path, index=False)
+    row = table.get(DATES[0])
+    assert computed == DATES + [DATES[0]]
+    assert row[SAMPLES] < first.loc[DATES[0], SAMPLES]
+    assert row[MEASURED_ENERGY] < first.loc[DATES[0], MEASURED_ENERGY]
+
+    # Only the mtime changes.
+    os.utime(data_dir + DATES[1] + '_processed.csv', ns=(10**18, 10**18))
+    assert table.get(DATES[1])[SAMPLES] == first.loc[DATES[1], SAMPLES]
+    assert computed == DATES + DATES
+    table.save()
+
+    # The processed file is removed.
+    os.remove(path)
+    table = DailyMetricsTable(fname, data_dir)
+    assert table.query().index.tolist() == [DATES[1]]
+    assert table.get(DATES[0]) is None
+    table.save()
+    assert pd.read_csv(fname)['date'].tolist() == [DATES[1]]
+
+def test_rows_of_another_version_are_recomputed(data_dir, tmp_path):
+    data_dir, computed = data_dir
+    fname = str(tmp_path / 'daily_metrics.csv')
+    table = DailyMetricsTable(fname, data_dir)
+    table.update(DATES)
+    table.rows[DATES[0]][VERSION] = daily_metrics.METRICS_VERSION - 1
+    table.save()
+    DailyMetricsTable(fname, data_dir).update(DATES)
+    assert computed == DATES + [DATES[0]]
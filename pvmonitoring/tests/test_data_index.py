@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+import pytest
+import data_index
+from constants import *
+from data_index import DataIndex, read_rows_between
+
+HEADER = f'{TIMESTAMP},{TIME},{POWER}\n'
+FIRST_TIME = datetime(2030, 1, 5, 6, 0, 0)
+
+# Returns the csv rows of n samples a minute apart, from the minute first on.
+def make_rows(n, first=0):
+    rows = ''
+    for k in range(first, first + n):
+        time = FIRST_TIME + timedelta(minutes=k)
+        rows += f'{int(time.timestamp())},{time.strftime(TIME_FORMAT)},{k * 0.5}\n'
+    return rows
+
+def time_of(minute):
+    return (FIRST_TIME + timedelta(minutes=minute)).strftime(TIME_FORMAT)
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_index, 'DATA_FILE_RELATIVE_DIR', str(tmp_path) + '/')
+    # Small ranges, so that the binary search takes several steps on a short file.
+    monkeypatch.setattr(data_index, 'MIN_SEARCH_BYTES', 64)
+    return tmp_path
+
+# Returns the minutes of the rows returned by read_rows_between.
+def minutes_between(filename, entry, start, end):
+    _, rows = read_rows_between(filename, entry, start, end)
+    return [int(float(line.split(',')[2]) * 2) for line in rows.decode('utf-8').splitlines()]
+
+def test_binary_search_boundaries(data_dir):
+    (data_dir / '2030-01-05.csv').write_text(HEADER + make_rows(500))
+    index = DataIndex(str(data_dir / 'index.json'))
+    entry = index.get('2030-01-05.csv')
+    assert (entry['rows'], entry['first'], entry['last'], entry['ascending']) == (500, time_of(0), time_of(499), True)
+    cases = [
+        (time_of(0), time_of(500)),                 # the whole file
+        ('2030-01-05 00:00:00', time_of(1)),        # from before the first row to the second
+        (time_of(250), time_of(251)),               # a single row
+        (time_of(250) + '5', time_of(253)),         # from between two rows
+        (time_of(499), '2030-01-06 00:00:00'),      # the last row
+        (time_of(100), time_of(100)),               # an empty range
+    ]
+    for start, end in cases:
+        minutes = minutes_between('2030-01-05.csv', entry, start, end)
+        # The rows returned include all the rows of the range, and at most the rows of a search range besides.
+        expected = [k for k in range(500) if start <= time_of(k) < end]
+        assert set(expected) <= set(minutes)
+        assert len(minutes) - len(expected) <= 2 * 64 // len(make_rows(1))
+
+def test_appended_rows_are_scanned_incrementally(data_dir, monkeypatch):
+    path = data_dir / '2030-01-05.csv'
+    path.write_text(HEADER + make_rows(100))
+    index = DataIndex(str(data_dir / 'index.json'))
+    index.get('2030-01-05.csv')
+    index.save()
+
+    # An incomplete last row, as the collector is writing it, is scanned once it is complete.
+    row = make_rows(1, 100)
+    with open(path, 'a') as file:
+        file.write(row[:10])
+    scans = []
+    build_entry = data_index.build_entry
+    monkeypatch.setattr(data_index, 'build_entry', lambda path, data: scans.append(path) or build_entry(path, data))
+    index = DataIndex(str(data_dir / 'index.json'))
+    assert index.get('2030-01-05.csv')['rows'] == 100
+    with open(path, 'a') as file:
+        file.write(row[10:] + make_rows(49, 101))
+    entry = index.get('2030-01-05.csv')
+    assert (entry['rows'], entry['first'], entry['last']) == (150, time_of(0), time_of(149))
+    assert {120, 121} <= set(minutes_between('2030-01-05.csv', entry, time_of(120), time_of(122)))
+    assert scans == []
+
+    # A file that was written again, not appended to, is scanned again.
+    path.write_text(HEADER + make_rows(200, 1000))
+    entry = index.get('2030-01-05.csv')
+    assert (entry['rows'], entry['first']) == (200, time_of(1000))
+    assert len(scans) == 1
+
+def test_empty_file(data_dir):
+    path = data_dir / '2030-01-05.csv'
+    path.write_text('')
+    index = DataIndex(str(data_dir / 'index.json'))
+    assert index.get('2030-01-05.csv') is None
+    path.write_text(HEADER + make_rows(3))
+    entry = index.get('2030-01-05.csv')
+    assert entry['rows'] == 3
+    # The file is emptied after it was indexed.
+    path.write_text('')
+    assert read_rows_between('2030-01-05.csv', entry, time_of(0), time_of(3)) == (b'', b'')
+    assert index.get('2030-01-05.csv') is None
+    assert '2030-01-05.csv' not in index.entries
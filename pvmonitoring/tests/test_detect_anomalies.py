@@ -0,0 +1,48 @@
+import pandas as pd
+from calibrate import list_processed_dates
+from constants import *
+from detect_anomalies import SHADING, SOILING, EVENT_COLUMNS, detect_anomalies, evaluate, load_processed_days
+from site_config import Config
+
+def make_events(*events):
+    return pd.DataFrame([{'kind': kind, 'start': pd.Timestamp(start), 'end': pd.Timestamp(end), 'duration (min)': 0,
+                          'mean ratio': 0.5, 'energy lost (Wh)': 0} for kind, start, end in events],
+                        columns=EVENT_COLUMNS)
+
+def test_evaluate_scores_each_day():
+    # The labels are soiling from 2022-09-22 to 2022-10-03, and shading on 2022-10-04 and 2022-10-05.
+    dates = [d.strftime('%Y-%m-%d') for d in pd.date_range('2022-09-18', '2022-10-05')]
+    events = make_events((SOILING, '2022-09-20 09:00', '2022-09-25 16:00'),
+                         (SHADING, '2022-10-04 13:00', '2022-10-04 14:00'))
+    scores = evaluate(events, dates)
+    # Soiling: 2022-09-22 to 25 detected, 09-20 and 21 false, 09-26 to 10-03 missed.
+    assert scores.loc[SOILING, ['tp', 'fp', 'fn']].tolist() == [4, 2, 8]
+    assert scores.loc[SOILING, 'precision'] == 0.667
+    assert scores.loc[SOILING, 'recall'] == 0.333
+    assert scores.loc[SOILING, 'f1'] == 0.444
+    assert scores.loc[SHADING, ['tp', 'fp', 'fn', 'precision', 'recall']].tolist() == [1, 0, 1, 1.0, 0.5]
+    assert scores.loc['any', ['tp', 'fp', 'fn']].tolist() == [5, 2, 9]
+
+def test_evaluate_only_scores_the_given_dates():
+    events = make_events((SOILING, '2022-09-20 09:00', '2022-09-25 16:00'))
+    scores = evaluate(events, ['2022-09-24', '2022-09-25'])
+    assert scores.loc[SOILING, ['tp', 'fp', 'fn', 'f1']].tolist() == [2, 0, 0, 1.0]
+    assert scores.loc[SHADING, 'tp'] == 0 and pd.isna(scores.loc[SHADING, 'f1'])
+
+def test_shaded_hour_is_detected():
+    df = load_processed_days(['2022-09-14'])
+    hours = df[TIME].dt.hour
+    df.loc[(hours >= 10) & (hours < 11), POWER_SMOOTHED] *= 0.4
+    events = detect_anomalies(df, Config().pvsystem['pdc0'])
+    shading = events[events['kind'] == SHADING]
+    assert len(shading) == 1
+    assert abs(shading['start'].iloc[0] - pd.Timestamp('2022-09-14 10:00')) < pd.Timedelta(minutes=10)
+    assert abs(shading['end'].iloc[0] - pd.Timestamp('2022-09-14 11:00')) < pd.Timedelta(minutes=10)
+    assert (events['kind'] != SOILING).all()
+
+def test_labelled_days_are_detected():
+    dates = list_processed_dates()
+    scores = evaluate(detect_anomalies(load_processed_days(dates), Config().pvsystem['pdc0']), dates)
+    assert scores.loc['any', 'f1'] >= 0.9
+    assert scores.loc[SOILING, 'f1'] >= 0.7
+    assert scores.loc[SHADING, 'f1'] >= 0.8
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+from constants import *
+from downsample import downsample, lttb
+
+def test_lttb_keeps_endpoints_and_extrema():
+    x = np.arange(5000, dtype=float)
+    y = np.sin(x / 800) + np.random.default_rng(1).normal(0, 0.01, len(x))
+    y[1234] = 5
+    y[3456] = -5
+    selected = lttb(x, y, 100)
+    assert len(selected) == 100
+    assert selected[0] == 0 and selected[-1] == len(x) - 1
+    assert np.all(np.diff(selected) > 0)
+    assert {1234, 3456} <= set(selected)
+
+def test_lttb_keeps_short_series():
+    x = np.arange(10, dtype=float)
+    np.testing.assert_array_equal(lttb(x, x, 10), np.arange(10))
+    np.testing.assert_array_equal(lttb(x, x, 20), np.arange(10))
+
+def test_runs_between_nan_are_downsampled_separately():
+    index = pd.date_range('2022-09-14 07:00', periods=3000, freq='10s')
+    power = pd.Series(np.linspace(0, 20, 3000), index=index)
+    # Two days of a range, with the NaN rows between them.
+    power.iloc[1000:1200] = np.nan
+    power.iloc[600] = 30
+    df = pd.DataFrame({POWER_SMOOTHED: power})
+    x, y = downsample(df, POWER_SMOOTHED, 200)
+    assert abs(len(y) - 200) <= 3
+    assert x.is_monotonic_increasing
+    # The first NaN after a run is kept, so the lines are not joined across the gap.
+    assert y.isna().sum() == 1 and pd.isna(y.loc[index[1000]])
+    # Each run keeps its first and last points.
+    assert {index[0], index[999], index[1200], index[-1]} <= set(x)
+    assert y.max() == 30
+    # The runs share the points by their lengths.
+    assert abs((x < index[1000]).sum() - 200 * 1000 / 2800) <= 2
+
+def test_short_series_is_not_downsampled():
+    df = pd.DataFrame({POWER_SMOOTHED: [1.0, np.nan, 2.0]}, index=pd.date_range('2022-09-14', periods=3, freq='min'))
+    x, y = downsample(df, POWER_SMOOTHED, 10)
+    assert len(y) == 3
@@ -0,0 +1,95 @@
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pvlib
+import pytest
+import calibrate
+import fleet
+import site_config
+import solar_position_cache
+from constants import *
+
+SITES = {'cupertino': {'latitude': 37.322998, 'longitude': -122.032181, 'altitude': 100, 'timezone': 'US/Pacific'},
+         'denver': {'latitude': 39.7392, 'longitude': -104.9903, 'altitude': 1609, 'timezone': 'US/Mountain'}}
+ARRAYS = [{'name': 'south', 'site': 'cupertino', 'surface_tilt': 0, 'surface_azimuth': 180, 'pdc0': 30, 'gamma_pdc': -0.0023},
+          {'name': 'west', 'site': 'cupertino', 'surface_tilt': 20, 'surface_azimuth': 270, 'pdc0': 30,
+           'gamma_pdc': -0.0023, 'power_coefficient': 0.8},
+          {'name': 'roof', 'site': 'denver', 'surface_tilt': 30, 'surface_azimuth': 160, 'pdc0': 45, 'gamma_pdc': -0.004}]
+
+# Points the modules at a fleet config with ARRAYS, and data and cache directories in tmp_path.
+@pytest.fixture
+def fleet_dirs(tmp_path, monkeypatch):
+    config_file = str(tmp_path / 'config.json')
+    with open(config_file, 'w') as file:
+        json.dump({'sites': SITES, 'arrays': ARRAYS}, file)
+    for module in [site_config, fleet]:
+        monkeypatch.setattr(module, 'CONFIG_FILE', config_file)
+    monkeypatch.setattr(calibrate, 'CALIBRATION_FILE', str(tmp_path / 'calibration.json'))
+    monkeypatch.setattr(fleet, 'BASE_DATA_DIR', str(tmp_path / 'data') + '/')
+    monkeypatch.setattr(fleet, 'BASE_CACHE_DIR', str(tmp_path / 'cache') + '/')
+    return tmp_path
+
+def test_config_is_the_named_or_the_first_array(fleet_dirs):
+    first = site_config.Config()
+    assert first.name == 'south'
+    assert first.pvsystem == {field: ARRAYS[0][field] for field in site_config.PVSYSTEM_FIELDS}
+    roof = site_config.Config('roof')
+    assert roof.location == {field: SITES['denver'][field] for field in site_config.LOCATION_FIELDS}
+    assert roof.timezone == 'US/Mountain'
+    assert roof.hash() != first.hash()
+    with pytest.raises(Exception):
+        site_config.Config('north')
+
+def test_calibrated_coefficient_per_array(fleet_dirs):
+    calibrate.write_calibrated_coefficient(0.9, ['2022-09-14'], array=None)
+    calibrate.write_calibrated_coefficient(0.85, ['2022-09-14'], array='south')
+    calibrate.write_calibrated_coefficient(0.7, ['2022-09-14'], array='west')
+    assert calibrate.read_calibrated_coefficient(array='south') == 0.85
+    # The power_coefficient set in config.json takes precedence over the calibrated one.
+    assert calibrate.read_calibrated_coefficient(array='west') == 0.8
+    assert calibrate.read_calibrated_coefficient(array='roof') == 0.9
+    assert calibrate.read_calibrated_coefficient(array=None) == 0.9
+
+def test_processed_days_are_recorded_per_array(fleet_dirs):
+    for name in ['south', 'west']:
+        os.makedirs(fleet_dirs / 'data' / name)
+        shutil.copy(DATA_FILE_RELATIVE_DIR + '2022-09-14.csv', fleet_dirs / 'data' / name)
+    sites, arrays = fleet.read_fleet_config()
+    cupertino = [array for array in arrays if array['site'] == 'cupertino']
+    manifests = {array['name']: {} for array in arrays}
+    assert fleet.needs_processing(cupertino, '2022-09-14', manifests)
+
+    assert fleet.process_site_day(sites['cupertino'], cupertino, '2022-09-14') == ['south', 'west']
+    fleet.record_processed_days(arrays, manifests, {'south': ['2022-09-14'], 'west': ['2022-09-14']})
+    manifests = {array['name']: fleet.load_manifest(array['manifest_file']) for array in arrays}
+    assert not fleet.needs_processing(cupertino, '2022-09-14', manifests)
+    for array in cupertino:
+        metrics = pd.read_csv(array['metrics_file'])
+        assert metrics['date'].tolist() == ['2022-09-14']
+
+    # A new calibration of one array reprocesses the day.
+    calibrate.write_calibrated_coefficient(0.85, ['2022-09-14'], array='south')
+    _, arrays = fleet.read_fleet_config()
+    assert fleet.needs_processing([array for array in arrays if array['site'] == 'cupertino'], '2022-09-14', manifests)
+
+def test_arrays_power_matches_a_loop_over_the_arrays():
+    df = pd.read_csv(DATA_FILE_RELATIVE_DIR + '2022-09-14_processed.csv')
+    dti = pd.DatetimeIndex(pd.to_datetime(df[TIME], format=TIME_FORMAT), tz='US/Pacific')
+    solar_position = pvlib.solarposition.get_solarposition(dti, SITES['cupertino']['latitude'],
+                                                           SITES['cupertino']['longitude'],
+                                                           SITES['cupertino']['altitude'])
+    zenith = solar_position['apparent_zenith'].to_numpy()
+    azimuth = solar_position['azimuth'].to_numpy()
+    irradiance = np.vstack([df[IRRADIANCE_SMOOTHED].to_numpy(dtype=float)] * len(ARRAYS))
+    temp_cell = np.vstack([df[TEMPERATURE_SMOOTHED].to_numpy(dtype=float) + 5 * i for i in range(len(ARRAYS))])
+
+    iam, pvwatts_dc = fleet.compute_arrays_power(zenith, azimuth, irradiance, temp_cell, ARRAYS)
+    for i, array in enumerate(ARRAYS):
+        aoi = pvlib.irradiance.aoi(array['surface_tilt'], array['surface_azimuth'], zenith, azimuth)
+        expected_iam = solar_position_cache.iam_model(aoi)
+        expected = pvlib.pvsystem.pvwatts_dc(expected_iam * irradiance[i], temp_cell[i], array['pdc0'],
+                                             gamma_pdc=array['gamma_pdc'])
+        np.testing.assert_allclose(iam[i], expected_iam, rtol=1e-12)
+        np.testing.assert_allclose(pvwatts_dc[i], expected, rtol=1e-12)
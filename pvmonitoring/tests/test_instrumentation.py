@@ -0,0 +1,51 @@
+import json
+import pytest
+import instrumentation
+
+@pytest.fixture
+def metrics_file(tmp_path):
+    yield str(tmp_path / 'pvmonitoring.prom')
+    instrumentation.reset()
+    instrumentation.enable()
+
+def run(metrics_file, samples):
+    instrumentation.reset()
+    instrumentation.enable(metrics_file, accumulate=True)
+    instrumentation.count('samples', samples)
+    instrumentation.set_gauge('last cron minute', samples)
+
+def read_state(metrics_file):
+    with open(metrics_file + '.state.json', 'r') as file:
+        state = json.load(file)
+    return {key[0]: value for key, value in state['counters']}, {key[0]: value for key, value in state['gauges']}
+
+def test_runs_add_to_the_counters_of_the_previous_runs(metrics_file):
+    run(metrics_file, 2)
+    instrumentation.flush()
+    run(metrics_file, 3)
+    assert instrumentation.get_gauge('last cron minute') == 3
+    instrumentation.flush()
+    # A second flush of the same run only adds what was recorded since the first.
+    instrumentation.flush()
+    counters, gauges = read_state(metrics_file)
+    assert counters == {'samples': 5}
+    assert gauges == {'last cron minute': 3}
+    with open(metrics_file, 'r') as file:
+        assert 'pvmonitoring_samples_total 5\n' in file.read()
+
+def test_overlapping_runs_keep_each_others_counts(metrics_file):
+    # Run 1 starts, run 2 starts and flushes before run 1 flushes.
+    run(metrics_file, 2)
+    recorded = instrumentation.snapshot()
+    run(metrics_file, 3)
+    instrumentation.flush()
+    instrumentation.merge(recorded)
+    instrumentation.flush()
+    assert read_state(metrics_file)[0] == {'samples': 5}
+
+def test_previous_gauges_are_loaded_by_enable(metrics_file):
+    run(metrics_file, 7)
+    instrumentation.flush()
+    instrumentation.reset()
+    instrumentation.enable(metrics_file, accumulate=True)
+    assert instrumentation.get_gauge('last cron minute') == 7
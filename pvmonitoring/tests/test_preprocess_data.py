@@ -0,0 +1,16 @@
+import pandas as pd
+import pytest
+from constants import *
+from preprocess_data import check_parity
+
+# A regular day, a day with a 57 minute gap, and a day with rows out of order and duplicated.
+PARITY_DATES = ['2022-09-01', '2022-09-14', '2022-12-21']
+
+@pytest.mark.parametrize('date', PARITY_DATES)
+def test_vectorized_preprocessing_matches_loop(date):
+    df = pd.read_csv(DATA_FILE_RELATIVE_DIR + date + '.csv')
+    assert check_parity(df) == []
+
+def test_parity_with_other_window():
+    df = pd.read_csv(DATA_FILE_RELATIVE_DIR + '2022-09-14.csv')
+    assert check_parity(df, window=3) == []
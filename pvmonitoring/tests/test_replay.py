@@ -0,0 +1,64 @@
+import os
+import time
+import pandas as pd
+import pytest
+import solar_position_cache
+from constants import *
+from replay import ReplayClock, ReplayStream, VirtualDevice, run_replay, to_local_epoch
+from sensors import ConcurrentSensorReader, FakeSensorBackend
+from site_config import Config
+
+def test_stream_skips_the_nights():
+    stream = ReplayStream(['2022-09-14.csv', '2022-09-15.csv'])
+    first_day = pd.read_csv(DATA_FILE_RELATIVE_DIR + '2022-09-14.csv').dropna(subset=[TIME]).drop_duplicates(TIME)
+    n = len(first_day)
+    assert stream.times[n - 1] == to_local_epoch([first_day[TIME].max()])[0]
+    # The first sample of the next day is replayed one sample interval after the last sample of the day.
+    assert 50 < stream.replay_times[n] - stream.replay_times[n - 1] < 70
+    assert stream.times[n] - stream.times[n - 1] > 10 * 3600
+
+def test_clock_runs_faster_over_the_samples():
+    stream = ReplayStream(['2022-09-14.csv', '2022-09-15.csv'])
+    clock = ReplayClock(stream, 1000)
+    clock.start()
+    n = 300
+    assert clock.wall_time(n) - clock.wall_start == pytest.approx((stream.replay_times[n] - stream.replay_times[0]) / 1000)
+    # Shortly after the wall time of sample n, the clock is a little after the time of sample n.
+    clock.wall_start = time.time() - (clock.wall_time(n) - clock.wall_start) - 0.001
+    assert stream.times[n] <= clock() < stream.times[n] + 5
+
+def test_replay_writes_and_processes_the_rows(tmp_path):
+    stream = ReplayStream(['2022-09-14.csv'])
+    clock = ReplayClock(stream, 3000)
+    config = Config()
+    # The solar position table is built first, so that building it doesn't hold up the replay.
+    solar_position_cache.load_table(config.location, config.pvsystem, 2022)
+    devices = [VirtualDevice(f'device-{i}', stream, clock, str(tmp_path / f'device-{i}') + '/', 50, 0.9, config)
+               for i in range(2)]
+    for device in devices:
+        os.makedirs(device.data_dir)
+    # The second device reads the fake sensors instead of the replayed data, on the replay clock.
+    devices[1].reader.close()
+    devices[1].reader = ConcurrentSensorReader(FakeSensorBackend(seed=1), clock=clock)
+    try:
+        results = run_replay(stream, devices, clock, duration=1)
+    finally:
+        for device in devices:
+            device.close()
+
+    samples = results['sample_times'] - results['dropped_sample_times']
+    assert samples > 10
+    assert results['rows_written'] == 2 * samples
+    # Every row written is processed, the last ones when the replay ends.
+    assert results['rows_processed'] == results['rows_written']
+    assert results['sensor_errors'] == 0
+    for device in devices:
+        assert len(device.filenames) == 1
+        assert len(pd.read_csv(device.filenames[0])) == samples
+
+    # The replayed rows have the values of the original samples, at the times of the original day.
+    written = pd.read_csv(devices[0].filenames[0])
+    original = pd.read_csv(DATA_FILE_RELATIVE_DIR + '2022-09-14.csv')
+    assert written[IRRADIANCE].isin(original[IRRADIANCE].round(2)).all()
+    assert written[POWER].isin(original[POWER].round(2)).all()
+    assert (written[TIME] >= original[TIME].min()).all() and (written[TIME] <= original[TIME].max()).all()
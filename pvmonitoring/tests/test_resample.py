@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+from compute_power import process_df
+from constants import *
+from daily_metrics import compute_day_metrics, read_day_metrics
+from preprocess_data import grid_window_samples
+from resample import (get_coverage, resample_day, COVERAGE, INTERPOLATED, MEASURED, MISSING, SAMPLE_FLAG,
+                      LONGEST_GAP)
+from site_config import Config
+
+# Returns a raw day with a sample every interval seconds, 2 seconds after the minute, between first and last.
+def make_day(first, last, interval=60, timezone='US/Pacific'):
+    local = pd.date_range(first, last, freq=f'{interval}s') + pd.Timedelta(seconds=2)
+    utc = local.tz_localize(timezone, nonexistent='NaT', ambiguous='NaT')
+    local = local[utc.notna()]
+    n = len(local)
+    timestamps = utc[utc.notna()].tz_convert(None).to_numpy(dtype='datetime64[s]').astype(np.int64)
+    return pd.DataFrame({TIMESTAMP: timestamps, TIME: local.strftime(TIME_FORMAT),
+                         TEMPERATURE: np.full(n, 20.0), IRRADIANCE: np.linspace(0, 900, n),
+                         VOLTAGE: np.full(n, 14.0), CURRENT: np.full(n, 1.0), POWER: np.linspace(0, 25, n)})
+
+# Returns the UTC offset, in seconds, of each grid point of a resampled day, indexed by TIME.
+def utc_offsets(resampled):
+    local = pd.to_datetime(resampled[TIME], format=TIME_FORMAT).to_numpy(dtype='datetime64[s]').astype(np.int64)
+    return pd.Series(resampled[TIMESTAMP].to_numpy() - local, index=resampled[TIME].to_numpy())
+
+def test_timestamps_on_the_day_dst_starts():
+    df = make_day('2022-03-13 00:00', '2022-03-13 23:59')
+    resampled = resample_day(df, 60, timezone='US/Pacific')
+    offsets = utc_offsets(resampled)
+    resampled = resampled.set_index(TIME)
+    assert offsets['2022-03-13 01:30:00'] == 8 * 3600
+    assert offsets['2022-03-13 12:00:00'] == 7 * 3600
+    # The hour skipped by the clocks has no samples.
+    assert (resampled.loc['2022-03-13 02:00:00':'2022-03-13 02:59:00', SAMPLE_FLAG] == MISSING).all()
+
+def test_timestamps_on_the_day_dst_ends():
+    df = make_day('2022-11-06 00:00', '2022-11-06 23:59')
+    offsets = utc_offsets(resample_day(df, 60, timezone='US/Pacific'))
+    assert offsets['2022-11-06 00:30:00'] == 7 * 3600
+    assert offsets['2022-11-06 12:00:00'] == 8 * 3600
+    # The repeated hour has no samples and is given the median offset of the day.
+    assert offsets['2022-11-06 01:30:00'] == 8 * 3600
+
+def test_gaps_are_interpolated_or_masked():
+    df = make_day('2022-09-14 08:00', '2022-09-14 10:00')
+    # A 3 minute gap is interpolated, a 20 minute gap is masked.
+    gaps = df[TIME].between('2022-09-14 08:30', '2022-09-14 08:33') | df[TIME].between('2022-09-14 09:00', '2022-09-14 09:20')
+    resampled = resample_day(df[~gaps], 60).set_index(TIME)
+    assert (resampled.loc['2022-09-14 08:30:00':'2022-09-14 08:32:00', SAMPLE_FLAG] == INTERPOLATED).all()
+    assert resampled.loc['2022-09-14 08:31:00', POWER] == pytest.approx(df.set_index(TIME)[POWER].iloc[31], abs=1e-9)
+    assert (resampled.loc['2022-09-14 09:00:00':'2022-09-14 09:19:00', SAMPLE_FLAG] == MISSING).all()
+    assert resampled.loc['2022-09-14 09:00:00':'2022-09-14 09:19:00', POWER].isna().all()
+
+@pytest.mark.parametrize('interval, samples', [(60, 5), (30, 11), (20, 15), (45, 7), (600, 1)])
+def test_grid_window_is_an_odd_number_of_samples(interval, samples):
+    assert grid_window_samples(5, interval) == samples
+
+def test_coverage_of_resample_and_daily_metrics_agree():
+    raw = pd.read_csv(DATA_FILE_RELATIVE_DIR + '2022-09-14.csv')
+    coverage = get_coverage(resample_day(raw))
+    assert coverage[COVERAGE] == pytest.approx(0.9, abs=0.001)
+    assert coverage[LONGEST_GAP] == 57
+    assert read_day_metrics('2022-09-14')[COVERAGE] == coverage[COVERAGE]
+
+    # On a day processed on a grid, only the measured points count.
+    processed = process_df(raw, 0.9, Config(), grid_interval=60)
+    time = pd.to_datetime(processed[TIME], format=TIME_FORMAT)
+    measured = processed[SAMPLE_FLAG] == MEASURED
+    metrics = compute_day_metrics(time, processed[POWER_SMOOTHED], processed[COMPUTED_POWER],
+                                  processed[IRRADIANCE_SMOOTHED], time[measured])
+    assert metrics[COVERAGE] == coverage[COVERAGE]
@@ -0,0 +1,72 @@
+import time
+import pytest
+from sensors import (ConcurrentSensorReader, FakeSensorBackend, SensorBackend, IRRADIANCE_SENSOR, TEMP_SENSOR,
+                     VIP_SENSOR)
+
+class SlowIrradianceBackend(SensorBackend):
+    def get_temp(self):
+        return 25.0
+
+    def get_vip(self):
+        return [14.0, 1.5, 21.0]
+
+    def get_irradiance(self):
+        time.sleep(0.5)
+        return 800.0
+
+class FailingVipBackend(FakeSensorBackend):
+    def get_vip(self):
+        raise OSError('i2c bus error')
+
+@pytest.fixture
+def make_reader():
+    readers = []
+    def make_reader(backend, **kwargs):
+        readers.append(ConcurrentSensorReader(backend, **kwargs))
+        return readers[-1]
+    yield make_reader
+    for reader in readers:
+        reader.close()
+
+def test_slow_sensor_times_out_without_delaying_the_others(make_reader):
+    reader = make_reader(SlowIrradianceBackend(), timeout=0.1)
+    start = time.monotonic()
+    readings = reader.read()
+    assert time.monotonic() - start < 0.4
+    assert readings[IRRADIANCE_SENSOR] == (None, None)
+    assert readings[VIP_SENSOR][0] is not None and readings[TEMP_SENSOR][0] is not None
+    assert reader.errors == {TEMP_SENSOR: 0, VIP_SENSOR: 0, IRRADIANCE_SENSOR: 1}
+    # The pending read isn't started again; its result is returned once it completes.
+    time.sleep(0.5)
+    assert reader.read()[IRRADIANCE_SENSOR][0] is not None
+    assert reader.errors[IRRADIANCE_SENSOR] == 1
+    assert reader.last_errors == {}
+
+def test_failing_sensor_is_counted(make_reader):
+    reader = make_reader(FailingVipBackend(seed=1))
+    for _ in range(2):
+        assert reader.read()[VIP_SENSOR] == (None, None)
+    assert reader.errors == {TEMP_SENSOR: 0, VIP_SENSOR: 2, IRRADIANCE_SENSOR: 0}
+    assert reader.last_errors == {VIP_SENSOR: 'i2c bus error'}
+
+def test_cached_temperature_while_converting(make_reader):
+    reader = make_reader(FakeSensorBackend(seed=1, temp_delay=0.3), timeout=1)
+    first = reader.read()[TEMP_SENSOR]
+    assert first[0] is not None
+    # The next conversion takes 0.3 seconds; the last temperature is returned without waiting for it.
+    start = time.monotonic()
+    assert reader.read()[TEMP_SENSOR] == first
+    assert time.monotonic() - start < 0.2
+    time.sleep(0.4)
+    assert reader.read()[TEMP_SENSOR] != first
+    assert reader.errors[TEMP_SENSOR] == 0
+
+def test_stale_cached_temperature_is_not_used(make_reader):
+    reader = make_reader(FakeSensorBackend(seed=1, temp_delay=0.3), timeout=0.1, temp_max_age=0)
+    assert reader.read()[TEMP_SENSOR] == (None, None)
+    time.sleep(0.3)
+    assert reader.read()[TEMP_SENSOR][0] is not None
+    time.sleep(0.05)
+    # The cached temperature is older than temp_max_age, so the reader waits for the conversion, and times out.
+    assert reader.read()[TEMP_SENSOR] == (None, None)
+    assert reader.errors[TEMP_SENSOR] == 2
@@ -0,0 +1,122 @@
+import json
+import os
+import struct
+import threading
+import urllib.error
+import urllib.request
+import numpy as np
+import pandas as pd
+import pytest
+import serve
+from calibrate import read_calibrated_coefficient
+from compute_power import manifest_entry
+from constants import *
+from site_config import Config
+
+@pytest.fixture
+def server(monkeypatch):
+    # 2022-09-14 is up to date; the other days with a raw file have no manifest entry and are out of date.
+    entry = manifest_entry(Config().hash(), read_calibrated_coefficient())
+    monkeypatch.setattr(serve, 'load_manifest', lambda: {'2022-09-14.csv': entry})
+    # The mtimes of a checkout are arbitrary, so the processed file is taken as newer than the raw file.
+    rebuild_reason = serve.rebuild_reason
+    def reason(filename, manifest, *args):
+        reason = rebuild_reason(filename, manifest, *args)
+        return None if reason == 'raw data changed' and filename in manifest else reason
+    monkeypatch.setattr(serve, 'rebuild_reason', reason)
+    serve.RequestHandler.service = serve.QueryService()
+    httpd = serve.ThreadingHTTPServer(('127.0.0.1', 0), serve.RequestHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+def test_day_json_and_binary(server):
+    status, body = get(server + '/day/2022-09-14?columns=power%20smoothed,computed%20power')
+    assert status == 200
+    response = json.loads(body)
+    df = pd.read_csv(DATA_FILE_RELATIVE_DIR + '2022-09-14_processed.csv')
+    df = df[df[TIMESTAMP].notna()]
+    assert response['columns'] == [TIMESTAMP, POWER_SMOOTHED, COMPUTED_POWER]
+    assert response['data'][COMPUTED_POWER] == [None if np.isnan(v) else v for v in df[COMPUTED_POWER]]
+
+    status, body = get(server + '/day/2022-09-14?columns=computed%20power&points=100&format=binary')
+    assert status == 200
+    header_length = struct.unpack('<I', body[:4])[0]
+    header = json.loads(body[4:4 + header_length])
+    assert header['columns'] == [TIMESTAMP, COMPUTED_POWER] and header['rows'] <= 100
+    values = np.frombuffer(body[4 + header_length:], dtype='<f8').reshape(2, header['rows'])
+    assert values[0][0] == df[TIMESTAMP].iloc[0] and values[0][-1] == df[TIMESTAMP].iloc[-1]
+    # The rows are rows of the day.
+    rows = df.set_index(TIMESTAMP).loc[values[0], COMPUTED_POWER].to_numpy()
+    np.testing.assert_array_equal(values[1], rows)
+
+def test_metrics(server):
+    status, body = get(server + '/metrics?start=2022-09-14&end=2022-09-15')
+    assert status == 200
+    data = json.loads(body)['data']
+    assert data['date'] == [20220914.0, 20220915.0]
+
+@pytest.mark.parametrize('path, status', [
+    ('/day/2030-01-01', 404),              # no data
+    ('/day/2022-12-21', 404),              # raw file only
+    ('/day/2022-09-15', 409),              # not in the manifest
+    ('/day/2022-09-14?columns=nope', 400),
+    ('/day/2022-09-14?points=0', 400),
+    ('/day/not-a-date', 400),
+    ('/nothing', 404),
+    ('/latest?format=xml', 400),
+])
+def test_errors(server, path, status):
+    response_status, body = get(server + path)
+    assert response_status == status
+    assert 'error' in json.loads(body)
+
+def test_latest_ignores_a_line_being_written(tmp_path):
+    path = tmp_path / '2030-01-01.csv'
+    path.write_text('timestamp,time,power\n1,2030-01-01 08:00:00,1.5\n2,2030-01-01 08:01:00,2.5\n3,2030-01-01 08:0')
+    assert serve.QueryService().read_latest(str(path)) == {'timestamp': 2.0, 'time': '2030-01-01 08:01:00', 'power': 2.5}
+
+def test_latest_of_a_long_file(tmp_path):
+    path = tmp_path / '2030-01-01.csv'
+    rows = ''.join(f'{i},2030-01-01 08:00:00,{i}.5\n' for i in range(1000))
+    path.write_text('timestamp,time,power\n' + rows)
+    assert serve.QueryService().read_latest(str(path))['power'] == 999.5
+
+def test_cache_evicts_the_least_recently_used(tmp_path):
+    cache = serve.FileCache(max_bytes=250)
+    builds = []
+    def build(key):
+        def build():
+            builds.append(key)
+            return key, 100, []
+        return build
+    for key in ['a', 'b', 'a', 'c']:
+        cache.get(key, build(key))
+    assert list(cache.entries) == ['a', 'c']
+    assert cache.total_bytes == 200
+    cache.get('b', build('b'))
+    assert builds == ['a', 'b', 'c', 'b']
+
+def test_cache_rebuilds_when_a_file_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(serve, 'CHECK_INTERVAL', 0)
+    path = tmp_path / 'day.csv'
+    path.write_text('1')
+    def build():
+        value = path.read_text()
+        return value, len(value), [str(path)]
+    cache = serve.FileCache(max_bytes=1000)
+    assert cache.get('day', build) == '1'
+    path.write_text('22')
+    assert cache.get('day', build) == '22'
+    os.remove(path)
+    with pytest.raises(FileNotFoundError):
+        cache.get('day', build)
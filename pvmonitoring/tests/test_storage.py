@@ -0,0 +1,73 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+import storage
+from constants import *
+from resample import SAMPLE_FLAG
+
+@pytest.mark.parametrize('date', ['2022-09-14', '2022-12-20'])
+@pytest.mark.parametrize('processed', [False, True])
+def test_csv_to_store_to_dataframe(date, processed):
+    fname = storage.csv_filename(date, processed)
+    df = pd.read_csv(fname)
+    storage.write_day(df, date, processed, fname)
+    assert_frame_equal(storage.read_stored_day(date, processed, source=fname), df)
+    assert_frame_equal(storage.load_day(date, processed), df)
+
+def test_nan_rows_and_text_columns():
+    df = pd.DataFrame({
+        TIMESTAMP: [1700000000.0, np.nan, 1700000120.0],
+        TIME: ['2030-01-05 08:00:00', '2030-01-05 08:01:00', '2030-01-05 08:02:00'],
+        POWER: [np.nan, np.nan, 12.5],
+        SAMPLE_FLAG: ['measured', np.nan, 'interpolated'],
+    })
+    storage.write_day(df, '2030-01-05')
+    stored = storage.load_day('2030-01-05')
+    assert_frame_equal(stored, df)
+    assert stored[SAMPLE_FLAG].isna().tolist() == [False, True, False]
+
+def test_selected_columns_keep_the_stored_order():
+    fname = storage.csv_filename('2022-09-14', True)
+    storage.write_day(pd.read_csv(fname), '2022-09-14', True, fname)
+    columns = [COMPUTED_POWER, TIME]
+    assert_frame_equal(storage.load_day('2022-09-14', True, columns), pd.read_csv(fname, usecols=columns))
+
+def test_partial_months():
+    # Only some days of September and October are stored, the other days are read from the csv files.
+    for date in ['2022-09-29', '2022-10-03']:
+        fname = storage.csv_filename(date, True)
+        storage.write_day(pd.read_csv(fname), date, True, fname)
+    expected = pd.concat([pd.read_csv(storage.csv_filename(date, True))
+                          for date in storage.list_csv_dates(True) if '2022-09-28' <= date <= '2022-10-03'],
+                         ignore_index=True)
+    assert_frame_equal(storage.read_range('2022-09-28', '2022-10-03', processed=True), expected)
+
+def test_day_written_again_replaces_only_that_day():
+    first = pd.DataFrame({TIME: ['2030-02-01 08:00:00'], POWER: [1.0]})
+    second = pd.DataFrame({TIME: ['2030-02-02 08:00:00'], POWER: [2.0]})
+    storage.write_day(first, '2030-02-01')
+    storage.write_day(second, '2030-02-02')
+    mtime = os.stat(storage.day_filename('2030-02-01')).st_mtime_ns
+    storage.write_day(second.assign(**{POWER: [3.0]}), '2030-02-02')
+    assert os.stat(storage.day_filename('2030-02-01')).st_mtime_ns == mtime
+    assert storage.read_range('2030-02-01', '2030-02-28')[POWER].tolist() == [1.0, 3.0]
+
+def test_changed_csv_is_read_instead_of_the_store(tmp_path):
+    source = tmp_path / 'day.csv'
+    pd.DataFrame({TIME: ['2030-03-01 08:00:00'], POWER: [1.0]}).to_csv(source, index=False)
+    storage.write_day(pd.read_csv(source), '2030-03-01', source=str(source))
+    assert storage.read_stored_day('2030-03-01', source=str(source)) is not None
+    pd.DataFrame({TIME: ['2030-03-01 08:00:00', '2030-03-01 08:01:00'], POWER: [1.0, 2.0]}).to_csv(source, index=False)
+    os.utime(source, ns=(0, os.stat(source).st_mtime_ns + 1))
+    assert storage.read_stored_day('2030-03-01', source=str(source)) is None
+
+def test_export_never_overwrites(tmp_path):
+    df = pd.DataFrame({TIME: ['2030-04-01 08:00:00'], POWER: [1.25]})
+    storage.write_day(df, '2030-04-01')
+    fname = str(tmp_path / 'export.csv')
+    storage.export_csv('2030-04-01', fname=fname)
+    assert_frame_equal(pd.read_csv(fname), df)
+    with pytest.raises(Exception):
+        storage.export_csv('2030-04-01', fname=fname)
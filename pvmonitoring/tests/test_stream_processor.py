@@ -0,0 +1,16 @@
+import math
+import pytest
+from preprocess_data import smoothed_mean
+from stream_processor import check_replay
+
+@pytest.mark.parametrize('date', ['2022-09-01', '2022-09-14', '2022-12-21'])
+def test_replay_equals_compute_power(date):
+    assert check_replay(date + '.csv', 0.9) == []
+
+def test_replay_equals_compute_power_with_other_windows():
+    for window in [3, 4, 9]:
+        assert check_replay('2022-09-14.csv', 0.9, window=window) == []
+
+def test_smoothed_mean_ignores_nan():
+    assert smoothed_mean([1.0, math.nan, 2.0]) == 1.5
+    assert math.isnan(smoothed_mean([math.nan]))